@@ -0,0 +1,72 @@
+import os
+import json
+import glob
+import math
+import argparse
+import cv2
+import numpy as np
+from pathlib import Path
+
+# monster sprites packed into a single image, so the gui opens two files instead of 712
+# the index maps every monster id to its [x, y, width, height] on the atlas
+# sprites are kept as loose files in icons/monstersprites as the source of the build step:
+#   python -m src.atlas
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+SPRITES_PATH = os.path.join(ROOT_PATH, 'icons', 'monstersprites')
+ATLAS_PATH = os.path.join(ROOT_PATH, 'icons', 'monstersprites.png')
+INDEX_PATH = os.path.join(ROOT_PATH, 'icons', 'monstersprites.json')
+
+
+def build_atlas(sprites_path = SPRITES_PATH, atlas_path = ATLAS_PATH, index_path = INDEX_PATH):
+    files = glob.glob(os.path.join(sprites_path, '*.png'))
+    sprites = {}
+    for file in files:
+        id = os.path.splitext(os.path.basename(file))[0]
+        img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError(f'Unable to open sprite: {file}')
+        # every sprite is stored as bgra
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+        elif img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        sprites[id] = img
+    if not sprites:
+        raise FileNotFoundError(f'No sprites found in: {sprites_path}')
+
+    # grid of cells as big as the biggest sprite, as square as possible
+    ids = sorted(sprites, key = lambda id: (not id.isdigit(), int(id) if id.isdigit() else 0, id))
+    cell_h = max(img.shape[0] for img in sprites.values())
+    cell_w = max(img.shape[1] for img in sprites.values())
+    cols = math.ceil(math.sqrt(len(ids)))
+    rows = math.ceil(len(ids)/cols)
+    atlas = np.zeros((rows*cell_h, cols*cell_w, 4), dtype = np.uint8)
+    index = {}
+    for i, id in enumerate(ids):
+        img = sprites[id]
+        h, w = img.shape[:2]
+        x, y = (i%cols)*cell_w, (i//cols)*cell_h
+        atlas[y:y + h, x:x + w] = img
+        index[id] = [x, y, w, h]
+
+    if not cv2.imwrite(atlas_path, atlas, [cv2.IMWRITE_PNG_COMPRESSION, 9]):
+        raise OSError(f'Unable to write atlas: {atlas_path}')
+    with open(index_path, 'w') as f:
+        json.dump(index, f, separators = (',', ':'))
+    return index
+
+
+def load_index(index_path = INDEX_PATH):
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Pack the monster sprites into a single atlas image.')
+    parser.add_argument('--sprites', default = SPRITES_PATH, help = 'folder of {id}.png sprites')
+    parser.add_argument('--atlas', default = ATLAS_PATH, help = 'atlas image to write')
+    parser.add_argument('--index', default = INDEX_PATH, help = 'atlas index to write')
+    args = parser.parse_args()
+    index = build_atlas(args.sprites, args.atlas, args.index)
+    print(f'{len(index)} sprites packed into {args.atlas}')
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import cv2
+import numpy as np
+
+import src.core as core
+import src.ocr as ocr
+import src.capture as capture
+
+# benchmarks over saved screenshots, such as the *_1_ss.png files written in debug mode
+# run from the yapec folder, e.g.:
+#   python -m src.benchmark banner DEBUG/1700000000
+#   python -m src.benchmark pipeline DEBUG/1700000000 --labels labels.json --output run.json
+#   python -m src.benchmark compare baseline.json run.json
+
+
+# nearest rank percentile, values must be sorted
+def _percentile(values, p):
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, max(0, math.ceil(p/100*len(values)) - 1))]
+
+def _summary(times):
+    times = sorted(times)
+    total = sum(times)
+    return {
+        'n': len(times),
+        'mean_ms': 1000*total/len(times) if times else 0.,
+        'p50_ms': 1000*_percentile(times, 50),
+        'p95_ms': 1000*_percentile(times, 95),
+        'p99_ms': 1000*_percentile(times, 99),
+        'max_ms': 1000*times[-1] if times else 0.,
+        'ops_per_s': len(times)/total if total else 0.
+    }
+
+def _print_summary(name, summary):
+    print(f'{name:<30} n={summary["n"]:<6} mean={summary["mean_ms"]:8.2f}ms p50={summary["p50_ms"]:8.2f}ms '
+          f'p95={summary["p95_ms"]:8.2f}ms p99={summary["p99_ms"]:8.2f}ms {summary["ops_per_s"]:9.1f}/s')
+
+# time a call and store its duration under name
+def _timed(times, name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    times.setdefault(name, []).append(time.perf_counter() - start)
+    return result
+
+# compare the banner detector against the ocr battle check on every frame
+def bench_banner(files, templates_path = None):
+    detector = core.BattleBannerDetector(templates_path)
+    detect_times = []
+    ocr_times = []
+    decided = 0
+    agreed = 0
+    for file in files:
+        img = core.CV2ImageHandler.from_file(file)
+        img_ocr = img.crop_for_ocr('battle').transform_image_for_ocr()
+
+        start = time.perf_counter()
+        banner_result = detector.detect(img_ocr.img)
+        detect_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ocr_result = img_ocr.perform_ocr()
+        ocr_times.append(time.perf_counter() - start)
+
+        ocr_started = bool(ocr_result.battle_started())
+        if banner_result is not None:
+            decided += 1
+            if banner_result.battle_started() == ocr_started and (not ocr_started or banner_result.battle_type() == ocr_result.battle_type()):
+                agreed += 1
+        elif ocr_started:
+            # same as the live loop, confirmed battles teach the detector
+            detector.learn(img_ocr.img)
+
+    print(f'frames: {len(files)}')
+    print(f'decided without ocr: {decided} ({100*decided/max(1, len(files)):.1f}%), agreeing with ocr: {agreed} ({100*agreed/max(1, decided):.1f}%)')
+    detect_summary = _summary(detect_times)
+    ocr_summary = _summary(ocr_times)
+    _print_summary('detector', detect_summary)
+    _print_summary('ocr', ocr_summary)
+    if detect_summary['mean_ms']:
+        print(f'detector is {ocr_summary["mean_ms"]/detect_summary["mean_ms"]:.0f}x faster than ocr per frame')
+    return {'detector': detect_summary, 'ocr': ocr_summary, 'decided': decided, 'agreed': agreed}
+
+
+# same steps as CV2ImageHandler.crop_for_ocr, but timing crop and rectangles separately
+def _crop_for_ocr(img, battle_type, times):
+    if battle_type == 'battle':
+        return _timed(times, 'crop_by_percentage', img.crop_by_percentage, img.SPECIAL_PERCENTAGES['battle'])
+    percentages = img.SPECIAL_PERCENTAGES[battle_type]
+    img_crop = _timed(times, 'crop_by_percentage', img.crop_by_percentage, percentages['pokemon'])
+    img_crop = img.__class__(img_crop.img.copy())
+    for perc in percentages['status'] + percentages['hpbar']:
+        img_crop = _timed(times, 'insert_black_rectangle', img_crop.insert_black_rectangle, perc)
+    return img_crop
+
+# labels file is a json object mapping frame file names to what should be read from them, e.g.
+# {"12_1_ss.png": {"battle": true, "battle_type": "horde", "pokemon": [16, 16, 16, 16, 16]},
+#  "13_1_ss.png": {"battle": false}}
+def load_labels(file_path):
+    if not file_path:
+        return {}
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+# run every pipeline stage over saved frames and time each one
+# with run_ocr False only the preprocessing stages are measured (no tesseract needed)
+def bench_pipeline(files, labels = None, run_ocr = True):
+    labels = labels or {}
+    times = {}
+    accuracy = {'battle': [0, 0], 'battle_type': [0, 0], 'pokemon': [0, 0]}
+    db_path = tempfile.mkdtemp(prefix = 'yapec_bench_')
+    db_file = os.path.join(db_path, 'bench.sqlite3')
+    core.DBHandler.setup_db(db_file)
+    hunt_id = 1
+    try:
+        with core.DBHandler(db_file) as db:
+            for file in files:
+                label = labels.get(os.path.basename(file), {})
+                img = core.CV2ImageHandler.from_file(file)
+                start = time.perf_counter()
+
+                # battle check
+                img_ocr = _timed(times, 'transform_image_for_ocr', _crop_for_ocr(img, 'battle', times).transform_image_for_ocr)
+                battle_started = None
+                battle_type = label.get('battle_type')
+                if run_ocr:
+                    ocr_result = _timed(times, 'perform_ocr', img_ocr.perform_ocr)
+                    battle_started = bool(ocr_result.battle_started())
+                    if battle_started:
+                        battle_type = battle_type or ocr_result.battle_type()
+                    if 'battle' in label:
+                        accuracy['battle'][0] += battle_started == label['battle']
+                        accuracy['battle'][1] += 1
+                    if battle_started and 'battle_type' in label:
+                        accuracy['battle_type'][0] += ocr_result.battle_type() == label['battle_type']
+                        accuracy['battle_type'][1] += 1
+
+                # pokemon read, for battle frames or frames labelled with a battle type
+                if battle_type in ['single', 'horde']:
+                    img_ocr = _timed(times, 'transform_image_for_ocr', _crop_for_ocr(img, battle_type, times).transform_image_for_ocr)
+                    if run_ocr:
+                        ocr_result = _timed(times, 'perform_ocr', img_ocr.perform_ocr)
+                        pokemon_found = _timed(times, 'extract_pokemon_from_battle', ocr_result.extract_pokemon_from_battle)
+                        if 'pokemon' in label:
+                            accuracy['pokemon'][0] += sorted(p[1] for p in pokemon_found) == sorted(label['pokemon'])
+                            accuracy['pokemon'][1] += 1
+                        if pokemon_found:
+                            _timed(times, 'DBHandler.insert_data', db.insert_data, [p + (hunt_id,) for p in pokemon_found])
+
+                times.setdefault('end_to_end', []).append(time.perf_counter() - start)
+    finally:
+        core.DBHandler.close_all()
+        shutil.rmtree(db_path, ignore_errors = True)
+
+    results = {
+        'timestamp': time.time(),
+        'frames': len(files),
+        'ocr_engine': type(ocr.get_engine()).__name__ if run_ocr else None,
+        'stages': {name: _summary(stage_times) for name, stage_times in times.items()},
+        'accuracy': {name: {'correct': c, 'total': t, 'ratio': c/t if t else None} for name, (c, t) in accuracy.items()}
+    }
+    print(f'frames: {len(files)}')
+    for name, summary in results['stages'].items():
+        _print_summary(name, summary)
+    for name, acc in results['accuracy'].items():
+        if acc['total']:
+            print(f'{name + " accuracy":<30} {acc["correct"]}/{acc["total"]} ({100*acc["ratio"]:.1f}%)')
+    return results
+
+# cost of the db work done for every encounter (insert + gui refresh) on a db with encounters rows
+# pooled reuses the session connections, reconnect opens new connections for every call like before pooling
+def bench_db(encounters = 100000, repeats = 200):
+    db_path = tempfile.mkdtemp(prefix = 'yapec_bench_')
+    db_file = os.path.join(db_path, 'bench.sqlite3')
+    core.DBHandler.setup_db(db_file)
+    hunt_id = 1
+    results = {}
+    try:
+        with core.DBHandler(db_file) as db:
+            rows = [(time.time() + i, 1 + i%600, 10, 0, 0, hunt_id) for i in range(encounters)]
+            db.insert_data(rows)
+            # modes take turns so both see the table grow the same way
+            times = {}
+            for i in range(repeats):
+                for mode in ['reconnect', 'pooled']:
+                    if mode == 'reconnect':
+                        core.DBHandler.close_all()
+                    _timed(times, f'{mode} insert_data', db.insert_data, [(time.time(), 1 + i%600, 10, 0, 0, hunt_id)])
+                    if mode == 'reconnect':
+                        core.DBHandler.close_all()
+                    _timed(times, f'{mode} get_agg_data', db.get_agg_data, hunt_id)
+            for name, stage_times in sorted(times.items()):
+                results[name] = _summary(stage_times)
+                _print_summary(name, results[name])
+    finally:
+        core.DBHandler.close_all()
+        shutil.rmtree(db_path, ignore_errors = True)
+    return results
+
+# transform_image_for_ocr as it was before working straight from BGR, kept to compare against
+# it writes over the alpha channel of the image it gets
+def _legacy_transform_image_for_ocr(img):
+    hls_img = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
+    inv_img = cv2.bitwise_not(hls_img[:, :, 2])
+    to_black_mask = cv2.inRange(inv_img, 0, 254*0.999)
+    inv_img[to_black_mask > 0] = 0
+    img[:, :, 3] = inv_img
+    img[img[:, :, 3] == 0] = [0, 0, 0, 0]
+    return img[:, :, :3]
+
+# synthetic bgra frame: random colors with some gray areas standing in for text
+def _synthetic_frame(height, width, seed = 0):
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 4), dtype = np.uint8)
+    gray = rng.integers(0, 256, (height, width), dtype = np.uint8)
+    text = rng.random((height, width)) < 0.05
+    for channel in range(3):
+        img[:, :, channel][text] = gray[text]
+    return img
+
+# time and peak memory of one call, tracemalloc sees numpy and opencv arrays
+def _measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+# legacy vs current transform_image_for_ocr on every region, at common window sizes
+# timings are measured without tracemalloc, which slows allocations down
+def bench_preprocess(sizes = None, repeats = 200):
+    sizes = sizes or {'1080p': (1080, 1920), '1440p': (1440, 2560)}
+    results = {}
+    for size_name, (height, width) in sizes.items():
+        frame = _synthetic_frame(height, width)
+        for battle_type in ['battle', 'single', 'horde']:
+            crop = core.CV2ImageHandler(frame).crop_for_ocr(battle_type)
+            # the legacy path changes its input, give it a fresh copy every time like a new screenshot would
+            crops = [crop.img.copy() for _ in range(repeats)]
+            times = {}
+            for c in crops:
+                _timed(times, 'legacy', _legacy_transform_image_for_ocr, c)
+                _timed(times, 'current', crop.transform_image_for_ocr)
+            legacy_peak = _measure(_legacy_transform_image_for_ocr, crop.img.copy())[1]
+            current_peak = _measure(crop.transform_image_for_ocr)[1]
+            name = f'{size_name} {battle_type}'
+            results[name] = {
+                'legacy': {**_summary(times['legacy']), 'peak_bytes': legacy_peak},
+                'current': {**_summary(times['current']), 'peak_bytes': current_peak}
+            }
+            for version in ['legacy', 'current']:
+                _print_summary(f'{name} {version}', results[name][version])
+            print(f'{"":<30} peak memory {legacy_peak/1024:.0f}KiB -> {current_peak/1024:.0f}KiB')
+    return results
+
+# compare two saved results, returns the stages whose p50 or p95 got slower than threshold percent
+def compare_results(old, new, threshold = 10.):
+    regressions = []
+    for name, new_summary in new['stages'].items():
+        old_summary = old['stages'].get(name)
+        if not old_summary:
+            continue
+        line = f'{name:<30}'
+        for key in ['p50_ms', 'p95_ms']:
+            change = 100*(new_summary[key] - old_summary[key])/old_summary[key] if old_summary[key] else 0.
+            line += f' {key} {old_summary[key]:8.2f} -> {new_summary[key]:8.2f} ({change:+6.1f}%)'
+            if change > threshold:
+                regressions.append((name, key, change))
+        print(line)
+    for name, new_acc in new.get('accuracy', {}).items():
+        old_acc = old.get('accuracy', {}).get(name)
+        if old_acc and old_acc['ratio'] is not None and new_acc['ratio'] is not None:
+            print(f'{name + " accuracy":<30} {100*old_acc["ratio"]:.1f}% -> {100*new_acc["ratio"]:.1f}%')
+            if new_acc['ratio'] < old_acc['ratio']:
+                regressions.append((name, 'accuracy', 100*(new_acc['ratio'] - old_acc['ratio'])))
+    return regressions
+
+def _save_results(results, file_path):
+    if file_path:
+        with open(file_path, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'YAPEC benchmarks over saved screenshots.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    banner_parser = subparsers.add_parser('banner', help = 'battle banner detector vs ocr latency per frame')
+    banner_parser.add_argument('frames', help = 'folder with saved screenshots')
+    banner_parser.add_argument('--templates', default = None, help = 'banner templates folder (default: data/templates)')
+
+    pipeline_parser = subparsers.add_parser('pipeline', help = 'latency and throughput of every pipeline stage, plus accuracy')
+    pipeline_parser.add_argument('frames', help = 'folder with saved screenshots')
+    pipeline_parser.add_argument('--labels', default = None, help = 'json file with the expected results per frame')
+    pipeline_parser.add_argument('--output', default = None, help = 'save results to this json file')
+    pipeline_parser.add_argument('--no-ocr', action = 'store_true', help = 'only measure preprocessing stages')
+
+    preprocess_parser = subparsers.add_parser('preprocess', help = 'legacy vs current transform_image_for_ocr at 1080p and 1440p')
+    preprocess_parser.add_argument('--repeats', type = int, default = 200, help = 'calls per region and size')
+    preprocess_parser.add_argument('--output', default = None, help = 'save results to this json file')
+
+    db_parser = subparsers.add_parser('db', help = 'time the db work done for every encounter')
+    db_parser.add_argument('--encounters', type = int, default = 100000, help = 'rows in the benchmark db')
+    db_parser.add_argument('--repeats', type = int, default = 200, help = 'encounters to time')
+    db_parser.add_argument('--output', default = None, help = 'save results to this json file')
+
+    compare_parser = subparsers.add_parser('compare', help = 'compare two saved pipeline results')
+    compare_parser.add_argument('old', help = 'baseline results json')
+    compare_parser.add_argument('new', help = 'new results json')
+    compare_parser.add_argument('--threshold', type = float, default = 10., help = 'allowed slowdown in percent')
+
+    args = parser.parse_args()
+    if args.command == 'banner':
+        bench_banner(capture.list_frames(args.frames), args.templates)
+    elif args.command == 'pipeline':
+        results = bench_pipeline(capture.list_frames(args.frames), load_labels(args.labels), run_ocr = not args.no_ocr)
+        _save_results(results, args.output)
+    elif args.command == 'preprocess':
+        _save_results(bench_preprocess(repeats = args.repeats), args.output)
+    elif args.command == 'db':
+        _save_results(bench_db(args.encounters, args.repeats), args.output)
+    elif args.command == 'compare':
+        with open(args.old, 'r') as f:
+            old = json.load(f)
+        with open(args.new, 'r') as f:
+            new = json.load(f)
+        regressions = compare_results(old, new, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) found')
+            sys.exit(1)
@@ -0,0 +1,247 @@
+import os
+import cv2
+import glob
+import time
+
+import src.core as core
+import src.x11 as x11
+import src.metrics as metrics
+
+# frame sources feed screenshots to the TaskManager
+# every source returns CV2ImageHandler objects with BGRA images, the same format PrintWindow gives us
+# grab takes an optional roi, percentages of the window like CV2ImageHandler.SPECIAL_PERCENTAGES
+# when given only that region is returned, with its region attribute set so it is not cropped again
+
+
+# base class for frame sources
+class FrameSource:
+    def __init__(self):
+        # game window handle, used to keep the gui on top of it. None when there is no window
+        self.hwnd = None
+
+    # next frame, or None when the source has no more frames
+    def grab(self, roi = None):
+        raise NotImplementedError('grab should be implemented on child classes.')
+
+    # minimized windows have nothing to capture
+    def is_visible(self):
+        return True
+
+    # whether the game is what the user is looking at
+    def is_foreground(self):
+        return True
+
+    # tells the source apart from the other ones of the session, shown in the gui and used to remember its hunt
+    # it must not depend on the order sources were found in, that changes from one start to the next
+    def name(self):
+        return None
+
+    def close(self):
+        pass
+
+
+# name of a game window, the title alone is the same for every client
+def _window_name(title, pid):
+    return f'{title} (pid {pid})' if pid else title
+
+
+# live capture of the game window through win32 PrintWindow
+class Win32FrameSource(FrameSource):
+    def __init__(self, pokemmo):
+        super().__init__()
+        self.pokemmo = pokemmo
+        self.hwnd = pokemmo.hwnd
+
+    @classmethod
+    def from_title(cls, title = 'pokemmo'):
+        return cls(core.PokeMMOHandler.from_title(title))
+
+    @classmethod
+    def all_from_title(cls, title = 'pokemmo'):
+        return [cls(pokemmo) for pokemmo in core.PokeMMOHandler.all_from_title(title)]
+
+    def grab(self, roi = None):
+        return self.pokemmo.take_screenshot(roi)
+
+    def is_visible(self):
+        return not core.win32gui.IsIconic(self.hwnd)
+
+    def is_foreground(self):
+        return core.win32gui.GetForegroundWindow() == self.hwnd
+
+    def name(self):
+        _, pid = core.win32process.GetWindowThreadProcessId(self.hwnd)
+        return _window_name(core.win32gui.GetWindowText(self.hwnd), pid)
+
+    def close(self):
+        self.pokemmo.close()
+
+
+# live capture of the game window on linux through the x11 mit-shm extension (see src/x11.py)
+# the x server copies only the region asked for straight into shared memory, one segment per region size
+# that is reused for every grab, so there is no per frame allocation on either side besides the frame itself
+# unlike PrintWindow, x11 only has the pixels that are on screen: the window must not be covered
+class X11FrameSource(FrameSource):
+    def __init__(self, window, display = None):
+        super().__init__()
+        self.display = display or x11.Display()
+        self.hwnd = window
+        # shared memory images by (width, height)
+        self.images = {}
+
+    @classmethod
+    def from_title(cls, title = 'pokemmo', display_name = None):
+        return cls.all_from_title(title, display_name)[0]
+
+    # one source for every game client
+    # every source has its own connection to the x server, so each client can be captured from its own thread
+    @classmethod
+    def all_from_title(cls, title = 'pokemmo', display_name = None):
+        display = x11.Display(display_name)
+        try:
+            windows = [window for window, window_title in display.windows()
+                       if window_title and core.PokeMMOHandler.normalize_title(window_title) == title]
+            # window managers may copy the title to the frame around the game, keep the outermost one
+            windows = [window for window in windows
+                       if not any(other != window and display.contains(other, window) for other in windows)]
+        finally:
+            display.close()
+        if not windows:
+            raise Exception('PokeMMO was not found.')
+        return [cls(window, x11.Display(display_name)) for window in windows]
+
+    def _image(self, attributes, width, height):
+        image = self.images.get((width, height))
+        if image is None:
+            image = self.images[(width, height)] = x11.ShmImage(self.display.display, attributes, width, height)
+        return image
+
+    @metrics.timed('yapec_screenshot_seconds', 'time to grab a screenshot of the game window')
+    def grab(self, roi = None):
+        attributes = self.display.attributes(self.hwnd)
+        if roi is None:
+            top, bottom, left, right = 0, attributes.height, 0, attributes.width
+        else:
+            top, bottom, left, right = core.CV2ImageHandler.percentage_coords(attributes.height, attributes.width, roi)
+        image = self._image(attributes, right - left, bottom - top)
+        if not image.grab(self.hwnd, left, top):
+            self.display.check('XShmGetImage')
+            raise OSError('XShmGetImage failed.')
+        # the segment is overwritten by the next grab, frames keep their own copy
+        return core.CV2ImageHandler(image.buffer.copy(), roi)
+
+    def is_visible(self):
+        return self.display.attributes(self.hwnd).map_state == x11.IS_VIEWABLE
+
+    def is_foreground(self):
+        active = self.display.active_window()
+        # without an ewmh window manager there is no way to know, assume it is
+        if active is None:
+            return True
+        # the active window may be the frame the window manager put around the game
+        return self.display.contains(active, self.hwnd)
+
+    def name(self):
+        return _window_name(self.display.window_title(self.hwnd), self.display.window_pid(self.hwnd))
+
+    def close(self):
+        for image in self.images.values():
+            image.close()
+        self.images = {}
+        self.display.close()
+
+
+# live capture of the game window on the current platform
+def live_source(title = 'pokemmo'):
+    if core.win32gui is not None:
+        return Win32FrameSource.from_title(title)
+    return X11FrameSource.from_title(title)
+
+
+# live capture of every game window open, to run several clients side by side
+def live_sources(title = 'pokemmo'):
+    if core.win32gui is not None:
+        return Win32FrameSource.all_from_title(title)
+    return X11FrameSource.all_from_title(title)
+
+
+# list saved screenshots in capture order
+# debug sessions save them as {counter}_1_ss.png, other folders fall back to any png
+def list_frames(path, pattern = '*_1_ss.png'):
+    files = glob.glob(os.path.join(path, pattern))
+    if not files:
+        files = glob.glob(os.path.join(path, '*.png'))
+    def sort_key(file):
+        prefix = os.path.basename(file).split('_')[0]
+        return (int(prefix) if prefix.isdigit() else float('inf'), file)
+    return sorted(files, key = sort_key)
+
+
+# replays a recorded session, either a folder of screenshots or a video file
+# fps controls the replay rate, 0 replays as fast as frames are requested
+class ReplayFrameSource(FrameSource):
+    def __init__(self, path, fps = 0, loop = False):
+        super().__init__()
+        self.path = path
+        self.interval = 1/fps if fps else 0
+        self.loop = loop
+        self.next_time = None
+        self.files = None
+        self.video = None
+        if os.path.isdir(path):
+            self.files = list_frames(path)
+            if not self.files:
+                raise FileNotFoundError(f'No frames found in: {path}')
+            self.position = 0
+        else:
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise FileNotFoundError(f'Unable to open video file: {path}')
+
+    # wait until the next frame is due
+    def _pace(self):
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        if self.next_time is None:
+            self.next_time = now
+        elif self.next_time > now:
+            time.sleep(self.next_time - now)
+        # do not try to catch up if the consumer fell behind
+        self.next_time = max(self.next_time, now) + self.interval
+
+    def _read(self):
+        if self.files is not None:
+            if self.position >= len(self.files):
+                if not self.loop:
+                    return None
+                self.position = 0
+            img = cv2.imread(self.files[self.position], cv2.IMREAD_UNCHANGED)
+            self.position += 1
+            return img
+        success, img = self.video.read()
+        if not success and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, img = self.video.read()
+        return img if success else None
+
+    def grab(self, roi = None):
+        self._pace()
+        img = self._read()
+        if img is None:
+            return None
+        # keep the same bgra layout as live captures
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+        elif img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        if roi is None:
+            return core.CV2ImageHandler(img)
+        return core.CV2ImageHandler(core.CV2ImageHandler(img).crop_by_percentage(roi).img, roi)
+
+    def name(self):
+        return os.path.normpath(self.path)
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
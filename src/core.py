@@ -2,41 +2,63 @@ import re
 import os
 import csv
 import cv2
+import gzip
+import json
 import time
+import ctypes
+import queue
+import shutil
 import sqlite3
-import win32ui
-import win32gui
+import functools
+import threading
+import collections
+import contextlib
 import subprocess
-import pytesseract
 import numpy as np
-import difflib as dl
 import tkinter as tk
 from pathlib import Path
-from ctypes import windll
+
+# win32 is only needed to capture the game window
+# replays and benchmarks (see src/capture.py and src/benchmark.py) also run without it
+try:
+    import win32ui
+    import win32gui
+    import win32process
+    from ctypes import windll
+except ImportError:
+    win32ui = win32gui = win32process = windll = None
 
 import src.monster_names as monsters
+import src.ocr as ocr
+import src.logger as logger
+import src.metrics as metrics
 import src.globals as gb
 
 # not sure where this should really go to resolve the path
 mn = monsters.MonsterNames.from_json(os.path.join(Path(__file__).resolve().parents[1], 'config', 'monster_names.json'))
 
-class _ImgSaveCounter:
+# intermediate arrays of transform_image_for_ocr, reused while the image size stays the same
+# one set per thread, so images can be transformed on several threads at once
+class _OCRBuffers(threading.local):
     def __init__(self):
-        self.counter = 0
+        self.shape = None
 
-    def increase(self):
-        self.counter += 1
-    
-    def to_str(self):
-        return str(self.counter)
+    def get(self, shape):
+        if shape != self.shape:
+            self.shape = shape
+            self.mask = np.empty(shape, dtype = bool)
+            self.equal = np.empty(shape, dtype = bool)
+        return self
 
-_counter = _ImgSaveCounter()
+_ocr_buffers = _OCRBuffers()
 
 class PokeMMOHandler:
 
     def __init__(self, hwnd):
         # save pokemmo window handle
         self.hwnd = hwnd
+        # screenshot buffer, created on the first screenshot
+        self.buffer = None
     
     # class method to search a window handle from a title
     @classmethod
@@ -67,15 +89,25 @@ class PokeMMOHandler:
                 raise Exception('PokeMMO was not found.')
         return cls(hwnd)
 
-    # internal class method to look for the window handle
-    @classmethod
-    def _find_pokemmo(cls, title):
-        # pokemmo is sneaky and sometimes uses cyrillic letters in its title
-        # so we overcome this by "translating" them back to latin
+    # pokemmo is sneaky and sometimes uses cyrillic letters in its title
+    # so we overcome this by "translating" them back to latin
+    @staticmethod
+    def normalize_title(title):
         cy_to_lat = {'Р': 'P', 'О': 'O', 'К': 'K', 'М': 'M', 'Е': 'E',
                      'р': 'p', 'о': 'o', 'к': 'k', 'м': 'm', 'е': 'e'}
-        cy_to_lat = str.maketrans(cy_to_lat)
+        return title.lower().translate(str.maketrans(cy_to_lat))
 
+    # one handler for every open game client, the launch prompt of from_title when there is none
+    @classmethod
+    def all_from_title(cls, title = 'pokemmo'):
+        hwnds = cls.find_windows(title)
+        if not hwnds:
+            return [cls.from_title(title)]
+        return [cls(hwnd) for hwnd in hwnds]
+
+    # window handles of every window matching title, in z order (topmost first)
+    @classmethod
+    def find_windows(cls, title):
         # get al open windows handles and titles
         list_of_windows = []
         def emu_windows_callback(hwnd, extra):
@@ -83,44 +115,114 @@ class PokeMMOHandler:
         win32gui.EnumWindows(emu_windows_callback, None)
 
         # see if any matches title
-        pokemmo_hwnd = [hwnd for hwnd, ttl in list_of_windows if title == ttl.lower().translate(cy_to_lat)]
+        return [hwnd for hwnd, ttl in list_of_windows if title == cls.normalize_title(ttl)]
+
+    # internal class method to look for the window handle
+    @classmethod
+    def _find_pokemmo(cls, title):
+        pokemmo_hwnd = cls.find_windows(title)
         # if found return first match
         if pokemmo_hwnd:
             return pokemmo_hwnd[0]
         return None
 
     # this method takes a screenshot of a hwnd ignoring other windows on top of it
-    # in simple terms it creates a new window, copies the current one, draws on the new window and screenshots that
-    # then retrieves the screenshots bits to a numpy array in opencv format
-    def take_screenshot(self):
+    # PrintWindow draws the client area into a dib section kept between calls (see _Win32CaptureBuffer)
+    # so no gdi object is created per screenshot, and only the region asked for is copied out of it
+    # roi is a list of percentages like the ones in CV2ImageHandler.SPECIAL_PERCENTAGES, None for the whole window
+    @metrics.timed('yapec_screenshot_seconds', 'time to grab a screenshot of the game window')
+    def take_screenshot(self, roi = None):
         left, top, right, bot = win32gui.GetClientRect(self.hwnd)
         width = right - left
         height = bot - top
 
-        hwnd_dc = win32gui.GetWindowDC(self.hwnd)
-        copy_dc  = win32ui.CreateDCFromHandle(hwnd_dc)
+        buffer = self.buffer
+        if buffer is None or (buffer.width, buffer.height) != (width, height):
+            if buffer is not None:
+                buffer.close()
+            self.buffer = buffer = _Win32CaptureBuffer(width, height)
 
-        bitmap_dc = copy_dc.CreateCompatibleDC()
-        bitmap = win32ui.CreateBitmap()
-        bitmap.CreateCompatibleBitmap(copy_dc, width, height)
+        result = windll.user32.PrintWindow(self.hwnd, buffer.memory_dc, 1)
+        # make sure gdi finished drawing before reading the dib memory
+        windll.gdi32.GdiFlush()
 
-        bitmap_dc.SelectObject(bitmap)
+        # the dib is overwritten by the next screenshot, frames keep their own copy
+        if roi is None:
+            return CV2ImageHandler(buffer.array.copy())
+        top, bot, left, right = CV2ImageHandler.percentage_coords(height, width, roi)
+        return CV2ImageHandler(buffer.array[top:bot, left:right].copy(), roi)
 
-        result = windll.user32.PrintWindow(self.hwnd, bitmap_dc.GetSafeHdc(), 1)
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
 
-        bitmap_info = bitmap.GetInfo()
-        bitmap_bits = bitmap.GetBitmapBits(True)
-        bitmap_np = np.fromstring(bitmap_bits, dtype = np.uint8)
-        
-        screenshot = np.reshape(bitmap_np, (bitmap_info['bmHeight'], bitmap_info['bmWidth'], 4))
 
-        win32gui.DeleteObject(bitmap.GetHandle())
-        copy_dc.DeleteDC()
-        bitmap_dc.DeleteDC()
-        win32gui.ReleaseDC(self.hwnd, hwnd_dc)
-        
-        # return custom class image handler
-        return CV2ImageHandler(screenshot)
+class _BitmapInfoHeader(ctypes.Structure):
+    _fields_ = [
+        ('biSize', ctypes.c_uint32),
+        ('biWidth', ctypes.c_int32),
+        ('biHeight', ctypes.c_int32),
+        ('biPlanes', ctypes.c_uint16),
+        ('biBitCount', ctypes.c_uint16),
+        ('biCompression', ctypes.c_uint32),
+        ('biSizeImage', ctypes.c_uint32),
+        ('biXPelsPerMeter', ctypes.c_int32),
+        ('biYPelsPerMeter', ctypes.c_int32),
+        ('biClrUsed', ctypes.c_uint32),
+        ('biClrImportant', ctypes.c_uint32)
+    ]
+
+
+# memory device context with a 32 bit top-down dib section selected into it
+# array is a numpy view of the dib pixels (bgra, the same layout GetBitmapBits gave us)
+class _Win32CaptureBuffer:
+    def __init__(self, width, height):
+        gdi32 = windll.gdi32
+        # handles are pointers, the default int return type would truncate them on 64 bits
+        gdi32.CreateCompatibleDC.restype = ctypes.c_void_p
+        gdi32.CreateCompatibleDC.argtypes = [ctypes.c_void_p]
+        gdi32.CreateDIBSection.restype = ctypes.c_void_p
+        gdi32.CreateDIBSection.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint,
+                                           ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p, ctypes.c_uint32]
+        gdi32.SelectObject.restype = ctypes.c_void_p
+        gdi32.SelectObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        gdi32.DeleteObject.argtypes = [ctypes.c_void_p]
+        gdi32.DeleteDC.argtypes = [ctypes.c_void_p]
+        windll.user32.PrintWindow.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint]
+
+        self.width = width
+        self.height = height
+        header = _BitmapInfoHeader()
+        header.biSize = ctypes.sizeof(_BitmapInfoHeader)
+        header.biWidth = width
+        # negative height makes the dib top-down, like numpy arrays
+        header.biHeight = -height
+        header.biPlanes = 1
+        header.biBitCount = 32
+
+        self.memory_dc = gdi32.CreateCompatibleDC(None)
+        bits = ctypes.c_void_p()
+        self.bitmap = gdi32.CreateDIBSection(self.memory_dc, ctypes.byref(header), 0, ctypes.byref(bits), None, 0)
+        if not self.memory_dc or not self.bitmap or not bits.value:
+            self.close()
+            raise OSError('Failed to create the screenshot buffer.')
+        self.old_bitmap = gdi32.SelectObject(self.memory_dc, self.bitmap)
+        raw = (ctypes.c_uint8*(width*height*4)).from_address(bits.value)
+        self.array = np.ctypeslib.as_array(raw).reshape(height, width, 4)
+
+    def close(self):
+        gdi32 = windll.gdi32
+        self.array = None
+        if getattr(self, 'old_bitmap', None):
+            gdi32.SelectObject(self.memory_dc, self.old_bitmap)
+            self.old_bitmap = None
+        if self.bitmap:
+            gdi32.DeleteObject(self.bitmap)
+            self.bitmap = None
+        if self.memory_dc:
+            gdi32.DeleteDC(self.memory_dc)
+            self.memory_dc = None
 
 
 # class to handle an image
@@ -143,8 +245,11 @@ class CV2ImageHandler:
         }
     }
     
-    def __init__(self, img):
+    # region is set when img is already a crop of the screen, as the percentages it was cropped with
+    # frame sources grab only the region needed when they can (see src/capture.py)
+    def __init__(self, img, region = None):
         self.img = img
+        self.region = region
     
     @classmethod
     def from_file(cls, file_path):
@@ -169,87 +274,170 @@ class CV2ImageHandler:
 
         return self.__class__(self.img[crop_size[0]:crop_size[1], crop_size[2]:crop_size[3]])
     
-    # crop image by percentage of size
-    def crop_by_percentage(self, percentages):
-        h, w, _ = self.img.shape
+    # region of the screen read for a battle type
+    @classmethod
+    def ocr_region(cls, battle_type):
+        if battle_type == 'battle':
+            return cls.SPECIAL_PERCENTAGES[battle_type]
+        return cls.SPECIAL_PERCENTAGES[battle_type]['pokemon']
 
+    # pixel coordinates [top, bottom, left, right] of percentages on an image of size (h, w)
+    # frame sources use it too, so a region grabbed from the screen is exactly the same as a crop
+    @staticmethod
+    def percentage_coords(h, w, percentages):
         if len(percentages) != 4:
             raise ValueError('percentages must have 4 values: [top, bottom, left, right].')
  
         if any([p > 1 or p < 0 for p in percentages]):
             raise ValueError('Percentages out of range, must be between 0 and 1.')
 
-        crop_size = [int(wh*perc) for wh, perc in zip([h, h, w, w], percentages)]
+        return [int(wh*perc) for wh, perc in zip([h, h, w, w], percentages)]
+
+    # crop image by percentage of size
+    def crop_by_percentage(self, percentages):
+        h, w, _ = self.img.shape
+
+        crop_size = self.percentage_coords(h, w, percentages)
         
         return self.__class__(self.img[crop_size[0]:crop_size[1], crop_size[2]:crop_size[3]])
     
     def insert_black_rectangle(self, percentages):
         h, w, _ = self.img.shape
 
-        if len(percentages) != 4:
-            raise ValueError('percentages must have 4 values: [top, bottom, left, right].')
- 
-        if any([p > 1 or p < 0 for p in percentages]):
-            raise ValueError('Percentages out of range, must be between 0 and 1.')
-        
-        coords = [int(wh*perc) for wh, perc in zip([h, h, w, w], percentages)]
+        coords = self.percentage_coords(h, w, percentages)
 
         return self.__class__(cv2.rectangle(self.img, (coords[2], coords[0]), (coords[3], coords[1]), (255, 0, 0), -1))
 
-    # apply some opencv image transformations to make it easier
-    # for tesseract to get strings
+    # keep only white/gray pixels (the game's text), everything else becomes black
+    # this used to go through HLS and keep the pixels with saturation 0, which is the same as
+    # keeping the pixels whose 3 channels are equal, so that is computed straight from BGR
+    # every intermediate array is reused between frames, only the result is a new array,
+    # and the source image is never modified
     def transform_image_for_ocr(self):
-        img_copy = self.img
-        # change to hls
-        hls_img = cv2.cvtColor(self.img, cv2.COLOR_BGR2HLS)
-        # get S channel only
-        S_channel = hls_img[:, :, 2]
-        # invert image
-        inv_img = cv2.bitwise_not(S_channel)
-        # make most of image black, except for white areas
-        to_black_mask = cv2.inRange(inv_img, 0, 254*0.999)
-        black_img = inv_img
-        black_img[to_black_mask > 0] = 0
-        # set black image as alpha channel
-        img_copy[:, :, 3] = black_img
-        # apply new alpha channel to image
-        img_copy[img_copy[:, :, 3] == 0] = [0, 0, 0, 0]
-        
-        return self.__class__(img_copy[:, :, :3])
-    
+        h, w = self.img.shape[:2]
+        buffers = _ocr_buffers.get((h, w))
+        b, g, r = self.img[:, :, 0], self.img[:, :, 1], self.img[:, :, 2]
+        np.equal(b, g, out = buffers.mask)
+        np.equal(g, r, out = buffers.equal)
+        np.logical_and(buffers.mask, buffers.equal, out = buffers.mask)
+        img_ocr = np.empty((h, w, 3), dtype = np.uint8)
+        np.multiply(self.img[:, :, :3], buffers.mask[:, :, None], out = img_ocr)
+        return self.__class__(img_ocr)
+
     # perform ocr on image using tesseract
-    def perform_ocr(self):
-        # this is the current bottleneck, since pytesseract uses I/O to pass the images to tesseract.
-        # apparently there is a way to use stdin/out but I haven't gotten around writing own code to do it
-        # for now pytesseract stays
-        # https://github.com/madmaze/pytesseract/issues/172
-        return OCRResultHandler(pytesseract.image_to_string(self.img))
+    # the engine is created once per session and kept warm between calls (see src/ocr.py)
+    # an optional ocr.OCRCache returns previous results for identical images
+    def perform_ocr(self, cache = None):
+        if cache is None:
+            return OCRResultHandler(ocr.get_engine().image_to_string(self.img))
+        key = cache.key(self.img)
+        text = cache.get(key)
+        if text is None:
+            text = ocr.get_engine().image_to_string(self.img)
+            cache.put(key, text)
+        return OCRResultHandler(text)
     
-    # wrapper to apply all steps to get ocr
-    def process_image(self, battle_type):
-        if battle_type == 'battle':
-            self.img_crop = self.crop_by_percentage(self.SPECIAL_PERCENTAGES[battle_type])
+    # crop the region of interest for a battle type
+    # pokemon crops also get status and hp bars covered since they only add noise to ocr
+    # images grabbed already cropped to the region are used as they are
+    def crop_for_ocr(self, battle_type):
+        region = self.ocr_region(battle_type)
+        if self.region == region:
+            self.img_crop = self.__class__(self.img, region)
         else:
-            self.img_crop = self.crop_by_percentage(self.SPECIAL_PERCENTAGES[battle_type]['pokemon'])
+            self.img_crop = self.crop_by_percentage(region)
+        if battle_type != 'battle':
+            # crops are views of the screenshot, copy before drawing on it
+            self.img_crop = self.__class__(self.img_crop.img.copy())
             for perc in self.SPECIAL_PERCENTAGES[battle_type]['status']:
                 self.img_crop = self.img_crop.insert_black_rectangle(perc)
             for perc in self.SPECIAL_PERCENTAGES[battle_type]['hpbar']:
                 self.img_crop = self.img_crop.insert_black_rectangle(perc)
+        return self.img_crop
+
+    # all steps before ocr
+    # if a change detector is given and the cropped region did not change since its last ocr
+    # then ocr is not needed and the result is None
+    # if a banner detector is given it decides battle checks without ocr whenever it is confident,
+    # the result being None when there is surely no battle and a BannerResult when there surely is one
+    # returns (image to ocr, None) when ocr is needed or (None, result) when it is not
+    @metrics.timed('yapec_preprocess_seconds', 'time to crop, transform and check a frame before ocr')
+    def prepare_for_ocr(self, battle_type, change_detector = None, banner_detector = None):
+        self.crop_for_ocr(battle_type)
+        if change_detector is not None and not change_detector.changed(self.img_crop.img):
+            return None, None
         self.img_ocr = self.img_crop.transform_image_for_ocr()
-        ocr_result = self.img_ocr.perform_ocr()
+        if banner_detector is not None:
+            banner_result = banner_detector.detect(self.img_ocr.img)
+            if banner_result is not None:
+                return None, banner_result if banner_result.battle_started() else None
+        return self.img_ocr, None
+
+    # wrapper to apply all steps to get ocr, see prepare_for_ocr for the detectors
+    # returns None when there was no need to ocr
+    def process_image(self, battle_type, change_detector = None, banner_detector = None):
+        img_ocr, result = self.prepare_for_ocr(battle_type, change_detector, banner_detector)
+        if img_ocr is None:
+            return result
+        ocr_result = img_ocr.perform_ocr()
+        # use confirmed battles to teach the detector how the banner looks
+        if banner_detector is not None and ocr_result.battle_started():
+            banner_detector.learn(img_ocr.img)
         return ocr_result
 
-    def log_images(self):
-        cnt = _counter.to_str()
-        cv2.imwrite(os.path.join(gb.globals.get_debug_path(), f'{cnt}_1_ss.png'), self.img)
-        if hasattr(self, 'img_crop'):
-            cv2.imwrite(os.path.join(gb.globals.get_debug_path(), f'{cnt}_2_crop.png'), self.img_crop.img)
-        if hasattr(self, 'img_ocr'):
-            cv2.imwrite(os.path.join(gb.globals.get_debug_path(), f'{cnt}_3_ocr.png'), self.img_ocr.img)
-        _counter.increase()
             
 
 
+# cheap check to know if a region of the screen changed since it was last ocr'd
+# compares a small grayscale thumbnail against the thumbnail of the last changed frame
+class FrameChangeDetector:
+
+    # thumbnail (width, height), small enough to be almost free but still catch new text
+    THUMB_SIZE = (96, 24)
+    # mean absolute difference (0-255) below which frames are considered the same
+    THRESHOLD = 1.5
+
+    def __init__(self, threshold = None, thumb_size = None):
+        self.threshold = threshold if threshold is not None else self.THRESHOLD
+        self.thumb_size = thumb_size or self.THUMB_SIZE
+        self.reference = None
+        # counters to know how many ocr calls were avoided
+        self.checked = 0
+        self.skipped = 0
+
+    def _thumbnail(self, img):
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+        return cv2.resize(img, self.thumb_size, interpolation = cv2.INTER_AREA)
+
+    def changed(self, img):
+        self.checked += 1
+        thumb = self._thumbnail(img)
+        if self.reference is not None and cv2.mean(cv2.absdiff(thumb, self.reference))[0] < self.threshold:
+            self.skipped += 1
+            return False
+        self.reference = thumb
+        return True
+
+    # forget last frame, next check is always considered a change
+    def reset(self):
+        self.reference = None
+
+    def stats(self):
+        return {'checked': self.checked, 'skipped': self.skipped, 'ocr': self.checked - self.skipped}
+
+
+# names are resolved through a fuzzy index (see monster_names.py)
+# and the same misreads come up over and over, so results are memoized
+# ids are ints like the ones the db returns, the names file keys them as strings
+@functools.lru_cache(maxsize = 4096)
+def _get_id_from_name(name):
+    closest_name = mn.closest_name(name)
+    if closest_name:
+        return int(mn.INV_MONSTER_NAMES_DICT[closest_name])
+    return 0
+
+
 # class to handle tesseract return object
 class OCRResultHandler:
     
@@ -273,15 +461,10 @@ class OCRResultHandler:
     
     # get pokemon id from its name
     def get_id_from_name(self, name):
-        if name in list(mn.INV_MONSTER_NAMES_DICT):
-            return mn.INV_MONSTER_NAMES_DICT[name]
-        # if name not exact then try to get closest match
-        closest_name = dl.get_close_matches(name, list(mn.INV_MONSTER_NAMES_DICT), n = 1, cutoff = 0.8)
-        if closest_name and closest_name in list(mn.INV_MONSTER_NAMES_DICT):
-            return mn.INV_MONSTER_NAMES_DICT[closest_name]
-        return 0
+        return _get_id_from_name(name)
 
     # extract all pokemon info
+    @metrics.timed('yapec_extract_seconds', 'time to extract pokemon from ocr text')
     def extract_pokemon_from_battle(self):
         # look for strings 'shiny', 'alpha', pokemon name and level
         # mime jr and mr mime were some exceptions to the regex
@@ -310,18 +493,287 @@ class OCRResultHandler:
         return pokemon_list
 
 
+# result of a battle check decided by the banner detector, behaves like an ocr result
+class BannerResult(OCRResultHandler):
+    def __init__(self, started, type = None):
+        super().__init__('')
+        self.started = started
+        self.type = type
+
+    def battle_started(self, pattern = None):
+        return self.started
+
+    def battle_type(self, pattern = None):
+        return self.type
+
+
+# templates of the banner words, height is the region height they were learned on, used to rescale them to
+# other window sizes, and scaled their copies rescaled so far by (name, height)
+_BannerTemplates = collections.namedtuple('_BannerTemplates', ['templates', 'height', 'scaled'])
+
+
+# detects the battle start banner ("A wild ... appeared") straight from the image prepared for ocr
+# text is white on black after transform_image_for_ocr, so:
+# - almost no white pixels means there is no text box, so surely no battle
+# - otherwise templates of the "A wild" prefix and the "horde" word are matched
+# templates are learned from the first battles confirmed by ocr and saved to disk
+# learn runs on the results thread while detect runs on the preprocess thread, so templates, the height they
+# were learned on and their rescaled copies are replaced together in a single assignment (see _BannerTemplates)
+# and detect works on the ones it found when it started
+class BattleBannerDetector:
+
+    # fraction of the region that must be text for a banner to be possible
+    MIN_INK_RATIO = 0.003
+    # template scores above HIGH are a sure match, below LOW a sure miss, in between ocr decides
+    HIGH_SCORE = 0.85
+    LOW_SCORE = 0.7
+    # padding around learned words
+    PADDING = 2
+    DEFAULT_PATH = os.path.join(Path(__file__).resolve().parents[1], 'data', 'templates')
+
+    def __init__(self, templates_path = None):
+        self.templates_path = templates_path or self.DEFAULT_PATH
+        self.index_file = os.path.join(self.templates_path, 'templates.json')
+        self.state = _BannerTemplates({'prefix': None, 'horde': None}, None, {})
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_file):
+            return 0
+        templates = {'prefix': None, 'horde': None}
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            for name in templates:
+                if name in index['files']:
+                    template = cv2.imread(os.path.join(self.templates_path, index['files'][name]), cv2.IMREAD_GRAYSCALE)
+                    if template is not None:
+                        templates[name] = template
+            height = index['height']
+        except Exception:
+            return 0
+        self.state = _BannerTemplates(templates, height, {})
+        return 1
+
+    def save(self):
+        Path(self.templates_path).mkdir(parents = True, exist_ok = True)
+        state = self.state
+        files = {}
+        for name, template in state.templates.items():
+            if template is not None:
+                files[name] = f'{name}.png'
+                cv2.imwrite(os.path.join(self.templates_path, files[name]), template)
+        with open(self.index_file, 'w') as f:
+            json.dump({'height': state.height, 'files': files}, f)
+
+    @staticmethod
+    def _binarize(img):
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY)
+        return binary
+
+    # templates resized to the current region height
+    def _template(self, state, name, height):
+        template = state.templates[name]
+        if template is None:
+            return None
+        if height == state.height:
+            return template
+        if (name, height) not in state.scaled:
+            ratio = height/state.height
+            size = (max(1, round(template.shape[1]*ratio)), max(1, round(template.shape[0]*ratio)))
+            state.scaled[(name, height)] = self._binarize(cv2.resize(template, size, interpolation = cv2.INTER_AREA))
+        return state.scaled[(name, height)]
+
+    def _score(self, state, binary, name):
+        template = self._template(state, name, binary.shape[0])
+        if template is None or template.shape[0] > binary.shape[0] or template.shape[1] > binary.shape[1]:
+            return None
+        return cv2.minMaxLoc(cv2.matchTemplate(binary, template, cv2.TM_CCOEFF_NORMED))[1]
+
+    # no text box in the region, so surely no battle on screen
+    def is_blank(self, img, binary = None):
+        binary = self._binarize(img) if binary is None else binary
+        return cv2.countNonZero(binary) < self.MIN_INK_RATIO*binary.size
+
+    # returns a BannerResult when confident, None when ocr is needed
+    def detect(self, img):
+        state = self.state
+        binary = self._binarize(img)
+        if self.is_blank(img, binary):
+            return BannerResult(False)
+        prefix_score = self._score(state, binary, 'prefix')
+        if prefix_score is None:
+            return None
+        if prefix_score < self.LOW_SCORE:
+            return BannerResult(False)
+        if prefix_score < self.HIGH_SCORE:
+            return None
+        horde_score = self._score(state, binary, 'horde')
+        if horde_score is None or self.LOW_SCORE <= horde_score < self.HIGH_SCORE:
+            return None
+        return BannerResult(True, 'horde' if horde_score >= self.HIGH_SCORE else 'single')
+
+    def needs_learning(self):
+        return any(template is None for template in self.state.templates.values())
+
+    # cut templates out of an image where ocr confirmed a battle start
+    def learn(self, img):
+        if not self.needs_learning():
+            return 0
+        try:
+            words = ocr.get_engine().image_to_words(img)
+        except Exception:
+            return 0
+        binary = self._binarize(img)
+        boxes = {}
+        texts = [text.lower().strip('!.,') for text, _ in words]
+        for i, text in enumerate(texts):
+            if text == 'a' and i + 1 < len(texts) and texts[i + 1] == 'wild' and 'prefix' not in boxes:
+                boxes['prefix'] = [words[i][1], words[i + 1][1]]
+            elif text == 'horde' and 'horde' not in boxes:
+                boxes['horde'] = [words[i][1]]
+        # new templates are built aside and published at once, detect may be running meanwhile
+        state = self.state
+        templates = dict(state.templates)
+        # templates must all come from the same region height, relearn them if the window was resized
+        if state.height is not None and state.height != binary.shape[0]:
+            if 'prefix' not in boxes:
+                return 0
+            templates = {'prefix': None, 'horde': None}
+        learned = 0
+        for name, word_boxes in boxes.items():
+            if templates[name] is not None:
+                continue
+            left = max(0, min(x for x, _, _, _ in word_boxes) - self.PADDING)
+            top = max(0, min(y for _, y, _, _ in word_boxes) - self.PADDING)
+            right = min(binary.shape[1], max(x + w for x, _, w, _ in word_boxes) + self.PADDING)
+            bottom = min(binary.shape[0], max(y + h for _, y, _, h in word_boxes) + self.PADDING)
+            if right > left and bottom > top:
+                templates[name] = binary[top:bottom, left:right].copy()
+                learned += 1
+        if learned:
+            self.state = _BannerTemplates(templates, binary.shape[0], {})
+            self.save()
+        return learned
+
+
+# connections to one db file kept open for the whole session
+# a single writer connection (sqlite only allows one writer at a time anyway) and a few reader connections,
+# which thanks to wal mode can read while the writer writes
+# sqlite3 caches prepared statements per connection, with long lived connections the fixed queries
+# of DBHandler are only prepared once
+class _ConnectionPool:
+
+    READERS = 3
+    CACHED_STATEMENTS = 256
+    PRAGMAS = [
+        # wal is stored in the db file, only the writer needs to set it
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -8192',
+        'PRAGMA mmap_size = 67108864',
+        'PRAGMA temp_store = MEMORY'
+    ]
+
+    def __init__(self, db_file, readers = None):
+        self.db_file = db_file
+        self.readers = readers or self.READERS
+        self.writer_connection = None
+        self.writer_lock = threading.Lock()
+        self.idle_readers = queue.LifoQueue()
+        self.created_readers = 0
+        self.lock = threading.Lock()
+
+    def _connect(self, read_only):
+        # connections are shared between the gui thread and the engine threads, never at the same time
+        connection = sqlite3.connect(self.db_file, check_same_thread = False, cached_statements = self.CACHED_STATEMENTS)
+        if not read_only:
+            connection.execute('PRAGMA journal_mode = WAL')
+        for pragma in self.PRAGMAS:
+            connection.execute(pragma)
+        if read_only:
+            connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    @contextlib.contextmanager
+    def writer(self):
+        with self.writer_lock:
+            if self.writer_connection is None:
+                self.writer_connection = self._connect(read_only = False)
+            yield self.writer_connection
+
+    @contextlib.contextmanager
+    def reader(self):
+        try:
+            connection = self.idle_readers.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created_readers < self.readers
+                if create:
+                    self.created_readers += 1
+            # wait for a reader to be free when all of them are in use
+            connection = self._connect(read_only = True) if create else self.idle_readers.get()
+        try:
+            yield connection
+        finally:
+            self.idle_readers.put(connection)
+
+    def close(self):
+        with self.writer_lock:
+            if self.writer_connection is not None:
+                self.writer_connection.close()
+                self.writer_connection = None
+        while True:
+            try:
+                self.idle_readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.created_readers = 0
+
+
+# one pool per db file
+class _Pools:
+    def __init__(self):
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get(self, db_file):
+        key = os.path.abspath(db_file)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = _ConnectionPool(db_file)
+            return self.pools[key]
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.close()
+
+_pools = _Pools()
+
+
 # class to handle db commands
+# handlers are cheap, connections come from the session pool (see _ConnectionPool)
 class DBHandler:
 
     # max retries for commands
     MAX_RETRIES = 3
+    # rows fetched and written at a time when exporting
+    EXPORT_CHUNK_SIZE = 5000
         
     def __init__(self, db_file):
         self.db_file = db_file
-        self.connection = sqlite3.connect(self.db_file)
-        self.cursor = self.connection.cursor()
+        self.pool = _pools.get(db_file)
+        # columns of the last fetched query
+        self.description = None
+        self.last_row_id = None
         # where to put data exports, "hardcoded" to one dir up from db_file for now
-        self.data_exports_path = os.path.join(self.db_file, 'data_exports')
+        # <root>/data/yapec.sqlite3 exports to <root>/data_exports, the folder yapec.pyw creates
+        self.data_exports_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(self.db_file))), 'data_exports')
+        self.last_export_path = None
 
     def __enter__(self):
         return self
@@ -329,9 +781,246 @@ class DBHandler:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close_connection()
     
+    # connections stay open in the pool, see close_all
     def close_connection(self):
-        self.cursor.close()
-        self.connection.close()
+        pass
+
+    # close every pooled connection, once the app is closing
+    @classmethod
+    def close_all(cls):
+        _pools.close()
+
+    # schema changes for dbs created by older versions, applied in order inside the setup transaction
+    # PRAGMA user_version keeps how many of them a db already has, so each one runs exactly once
+    MIGRATIONS = [
+        # 1: per hunt aggregates kept current by triggers, so the gui never scans encounters
+        # hunt_monster_stats has one row per hunt and monster, hunt_totals one row per hunt
+        # both are backfilled from the encounters already saved
+        [
+        '''
+            CREATE INDEX IF NOT EXISTS encounters_hunt_monster_index
+            ON encounters (hunt_id, monster_id, timestamp)
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS hunt_monster_stats (
+                hunt_id INTEGER NOT NULL,
+                monster_id INTEGER NOT NULL,
+                qty INTEGER NOT NULL,
+                qty_a INTEGER NOT NULL,
+                qty_s INTEGER NOT NULL,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (hunt_id, monster_id)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS hunt_monster_stats_last_index
+            ON hunt_monster_stats (hunt_id, last_seen DESC)
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS hunt_monster_stats_top_index
+            ON hunt_monster_stats (hunt_id, qty DESC)
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS hunt_totals (
+                hunt_id INTEGER PRIMARY KEY,
+                qty INTEGER NOT NULL
+            )
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_stats_insert
+            AFTER INSERT ON encounters
+            BEGIN
+                INSERT INTO hunt_monster_stats (hunt_id, monster_id, qty, qty_a, qty_s, last_seen)
+                VALUES (new.hunt_id, new.monster_id, 1, new.alpha, new.shiny, new.timestamp)
+                ON CONFLICT (hunt_id, monster_id) DO UPDATE SET
+                    qty = qty + 1,
+                    qty_a = qty_a + excluded.qty_a,
+                    qty_s = qty_s + excluded.qty_s,
+                    last_seen = MAX(last_seen, excluded.last_seen);
+                INSERT INTO hunt_totals (hunt_id, qty)
+                VALUES (new.hunt_id, 1)
+                ON CONFLICT (hunt_id) DO UPDATE SET qty = qty + 1;
+            END
+        ''',
+        # last_seen of the deleted encounter may have been the latest one, look it up again (index lookup)
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_stats_delete
+            AFTER DELETE ON encounters
+            BEGIN
+                UPDATE hunt_monster_stats SET
+                    qty = qty - 1,
+                    qty_a = qty_a - old.alpha,
+                    qty_s = qty_s - old.shiny,
+                    last_seen = COALESCE((
+                        SELECT MAX(timestamp) FROM encounters
+                        WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id
+                    ), last_seen)
+                WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id;
+                DELETE FROM hunt_monster_stats
+                WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id AND qty <= 0;
+                UPDATE hunt_totals SET qty = qty - 1
+                WHERE hunt_id = old.hunt_id;
+                DELETE FROM hunt_totals
+                WHERE hunt_id = old.hunt_id AND qty <= 0;
+            END
+        ''',
+        # an update is handled as the delete of the old row followed by the insert of the new one
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_stats_update
+            AFTER UPDATE OF timestamp, monster_id, shiny, alpha, hunt_id ON encounters
+            BEGIN
+                UPDATE hunt_monster_stats SET
+                    qty = qty - 1,
+                    qty_a = qty_a - old.alpha,
+                    qty_s = qty_s - old.shiny,
+                    last_seen = COALESCE((
+                        SELECT MAX(timestamp) FROM encounters
+                        WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id
+                    ), last_seen)
+                WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id;
+                DELETE FROM hunt_monster_stats
+                WHERE hunt_id = old.hunt_id AND monster_id = old.monster_id AND qty <= 0;
+                UPDATE hunt_totals SET qty = qty - 1
+                WHERE hunt_id = old.hunt_id;
+                DELETE FROM hunt_totals
+                WHERE hunt_id = old.hunt_id AND qty <= 0;
+                INSERT INTO hunt_monster_stats (hunt_id, monster_id, qty, qty_a, qty_s, last_seen)
+                VALUES (new.hunt_id, new.monster_id, 1, new.alpha, new.shiny, new.timestamp)
+                ON CONFLICT (hunt_id, monster_id) DO UPDATE SET
+                    qty = qty + 1,
+                    qty_a = qty_a + excluded.qty_a,
+                    qty_s = qty_s + excluded.qty_s,
+                    last_seen = MAX(last_seen, excluded.last_seen);
+                INSERT INTO hunt_totals (hunt_id, qty)
+                VALUES (new.hunt_id, 1)
+                ON CONFLICT (hunt_id) DO UPDATE SET qty = qty + 1;
+            END
+        ''',
+        # encounters of deleted hunts are kept, but they are not shown anywhere anymore
+        '''
+            CREATE TRIGGER IF NOT EXISTS hunts_stats_delete
+            AFTER DELETE ON hunts
+            BEGIN
+                DELETE FROM hunt_monster_stats WHERE hunt_id = old.id;
+                DELETE FROM hunt_totals WHERE hunt_id = old.id;
+            END
+        ''',
+        '''
+            DELETE FROM hunt_monster_stats
+        ''',
+        '''
+            INSERT INTO hunt_monster_stats (hunt_id, monster_id, qty, qty_a, qty_s, last_seen)
+            SELECT hunt_id, monster_id, COUNT(*), SUM(alpha), SUM(shiny), MAX(timestamp)
+            FROM encounters
+            WHERE hunt_id IN (SELECT id FROM hunts)
+            GROUP BY hunt_id, monster_id
+        ''',
+        '''
+            DELETE FROM hunt_totals
+        ''',
+        '''
+            INSERT INTO hunt_totals (hunt_id, qty)
+            SELECT hunt_id, SUM(qty)
+            FROM hunt_monster_stats
+            GROUP BY hunt_id
+        '''
+        ],
+        # 2: last encounter id exported by incremental exports, per scope (e.g. "hunt_id_1", "all")
+        [
+        '''
+            CREATE TABLE IF NOT EXISTS export_marks (
+                scope TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )
+        '''
+        ],
+        # 3: last journal record saved by the encounter writer, per journal (see src/writer.py)
+        # written in the same transaction as the encounters, so replaying a journal never saves twice
+        [
+        '''
+            CREATE TABLE IF NOT EXISTS journal_marks (
+                journal TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            )
+        '''
+        ],
+        # 4: encounters per hunt and hour (hours since epoch, utc) for the stats window, kept current by triggers
+        # days, rates and trends are computed from it (see src/stats.py), never from encounters
+        [
+        '''
+            CREATE TABLE IF NOT EXISTS hunt_hourly_stats (
+                hunt_id INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                qty INTEGER NOT NULL,
+                qty_a INTEGER NOT NULL,
+                qty_s INTEGER NOT NULL,
+                PRIMARY KEY (hunt_id, hour)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_hourly_insert
+            AFTER INSERT ON encounters
+            BEGIN
+                INSERT INTO hunt_hourly_stats (hunt_id, hour, qty, qty_a, qty_s)
+                VALUES (new.hunt_id, CAST(new.timestamp/3600 AS INTEGER), 1, new.alpha, new.shiny)
+                ON CONFLICT (hunt_id, hour) DO UPDATE SET
+                    qty = qty + 1,
+                    qty_a = qty_a + excluded.qty_a,
+                    qty_s = qty_s + excluded.qty_s;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_hourly_delete
+            AFTER DELETE ON encounters
+            BEGIN
+                UPDATE hunt_hourly_stats SET
+                    qty = qty - 1,
+                    qty_a = qty_a - old.alpha,
+                    qty_s = qty_s - old.shiny
+                WHERE hunt_id = old.hunt_id AND hour = CAST(old.timestamp/3600 AS INTEGER);
+                DELETE FROM hunt_hourly_stats
+                WHERE hunt_id = old.hunt_id AND hour = CAST(old.timestamp/3600 AS INTEGER) AND qty <= 0;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS encounters_hourly_update
+            AFTER UPDATE OF timestamp, shiny, alpha, hunt_id ON encounters
+            BEGIN
+                UPDATE hunt_hourly_stats SET
+                    qty = qty - 1,
+                    qty_a = qty_a - old.alpha,
+                    qty_s = qty_s - old.shiny
+                WHERE hunt_id = old.hunt_id AND hour = CAST(old.timestamp/3600 AS INTEGER);
+                DELETE FROM hunt_hourly_stats
+                WHERE hunt_id = old.hunt_id AND hour = CAST(old.timestamp/3600 AS INTEGER) AND qty <= 0;
+                INSERT INTO hunt_hourly_stats (hunt_id, hour, qty, qty_a, qty_s)
+                VALUES (new.hunt_id, CAST(new.timestamp/3600 AS INTEGER), 1, new.alpha, new.shiny)
+                ON CONFLICT (hunt_id, hour) DO UPDATE SET
+                    qty = qty + 1,
+                    qty_a = qty_a + excluded.qty_a,
+                    qty_s = qty_s + excluded.qty_s;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS hunts_hourly_delete
+            AFTER DELETE ON hunts
+            BEGIN
+                DELETE FROM hunt_hourly_stats WHERE hunt_id = old.id;
+            END
+        ''',
+        '''
+            DELETE FROM hunt_hourly_stats
+        ''',
+        '''
+            INSERT INTO hunt_hourly_stats (hunt_id, hour, qty, qty_a, qty_s)
+            SELECT hunt_id, CAST(timestamp/3600 AS INTEGER), COUNT(*), SUM(alpha), SUM(shiny)
+            FROM encounters
+            WHERE hunt_id IN (SELECT id FROM hunts)
+            GROUP BY hunt_id, CAST(timestamp/3600 AS INTEGER)
+        '''
+        ]
+    ]
 
     # class method to setup a db that contains all necessary tables
     @classmethod
@@ -414,10 +1103,22 @@ class DBHandler:
             tries = 0
             while tries < db.MAX_RETRIES:
                 try:
-                    for query in queries:
-                        db.cursor.execute(query)
-                    db.cursor.executemany(monster_query, list(mn.MONSTER_NAMES_DICT.items()))
-                    db.connection.commit()
+                    with db.pool.writer() as connection:
+                        try:
+                            # all or nothing, a failed migration leaves the db as it was
+                            connection.execute('BEGIN')
+                            for query in queries:
+                                connection.execute(query)
+                            connection.executemany(monster_query, list(mn.MONSTER_NAMES_DICT.items()))
+                            version = connection.execute('PRAGMA user_version').fetchone()[0]
+                            for migration in cls.MIGRATIONS[version:]:
+                                for query in migration:
+                                    connection.execute(query)
+                            connection.execute(f'PRAGMA user_version = {len(cls.MIGRATIONS)}')
+                            connection.commit()
+                        except Exception:
+                            connection.rollback()
+                            raise
                 except Exception:
                     tries += 1
                     time.sleep(1)
@@ -428,19 +1129,29 @@ class DBHandler:
                 return 0
 
     # base method to execute a dml (no fetching) query
+    # last_row_id is the rowid of the last row inserted by it, None when nothing was written
+    @metrics.timed('yapec_db_execute_seconds', 'time to run and commit a db command, retries included')
     def _execute_query(self, query, data = None, action = 'execute query'):
         tries = 0
+        self.last_row_id = None
         if gb.globals.DEBUG_MODE in [2, 4]:
             self.log_action(action, query, data)
         if gb.globals.DEBUG_MODE >= 3:
             return 1
         while tries < self.MAX_RETRIES:
             try:
-                if data:
-                    self.cursor.executemany(query, data)
-                else:
-                    self.cursor.execute(query)
-                self.connection.commit()
+                with self.pool.writer() as connection:
+                    try:
+                        if data:
+                            connection.executemany(query, data)
+                        else:
+                            connection.execute(query)
+                        last_row_id = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+                        connection.commit()
+                        self.last_row_id = last_row_id
+                    except Exception:
+                        connection.rollback()
+                        raise
             except Exception:
                 tries += 1
                 time.sleep(1)
@@ -451,17 +1162,21 @@ class DBHandler:
             return 0
     
     # base method to execute queries whose results should be fetched
+    @metrics.timed('yapec_db_query_seconds', 'time to run and fetch a db query, retries included')
     def _fetch_query(self, query, data = None, action = 'fetch query', log = True):
         tries = 0
         if gb.globals.DEBUG_MODE in [2, 4] and log:
             self.log_action(action, query, data)
         while tries < self.MAX_RETRIES:
             try:
-                if data:
-                    result = self.cursor.execute(query, data)
-                else:
-                    result = self.cursor.execute(query)
-                return result.fetchall()
+                with self.pool.reader() as connection:
+                    if data:
+                        cursor = connection.execute(query, data)
+                    else:
+                        cursor = connection.execute(query)
+                    result = cursor.fetchall()
+                    self.description = cursor.description
+                    return result
             except Exception:
                 tries += 1
                 time.sleep(1)
@@ -470,6 +1185,7 @@ class DBHandler:
             return []
 
     # insert wrapper for encounter data
+    # rows inserted together get consecutive ids ending at last_row_id
     def insert_data(self, data):
         query = '''
             INSERT INTO encounters (timestamp, monster_id, level, shiny, alpha, hunt_id)
@@ -477,6 +1193,60 @@ class DBHandler:
         '''
         return self._execute_query(query, data, 'insert data')
 
+    # insert of encounters coming from a journal (see src/writer.py), seq is the last journal record they belong to
+    # tried only once and never waits, the writer keeps the rows and decides when to try again
+    @metrics.timed('yapec_db_commit_seconds', 'time to save a group of encounters')
+    def insert_journaled_data(self, data, journal, seq):
+        query = '''
+            INSERT INTO encounters (timestamp, monster_id, level, shiny, alpha, hunt_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        '''
+        mark_query = '''
+            INSERT INTO journal_marks (journal, seq)
+            VALUES (?, ?)
+            ON CONFLICT (journal) DO UPDATE SET seq = MAX(seq, excluded.seq)
+        '''
+        self.last_row_id = None
+        if gb.globals.DEBUG_MODE in [2, 4]:
+            self.log_action('insert journaled data', query, data)
+        if gb.globals.DEBUG_MODE >= 3:
+            return 1
+        try:
+            with self.pool.writer() as connection:
+                try:
+                    connection.execute('BEGIN')
+                    connection.executemany(query, data)
+                    last_row_id = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+                    connection.execute(mark_query, (journal, seq))
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    raise
+        except Exception:
+            return 0
+        self.last_row_id = last_row_id
+        return 1
+
+    # last journal record already saved, 0 for a new journal
+    def get_journal_seq(self, journal):
+        query = '''
+            SELECT seq FROM journal_marks
+            WHERE journal = ?
+        '''
+        result = self._fetch_query(query, (journal,), 'get journal seq', log = False)
+        return result[0][0] if result else 0
+
+    # moves everything in the wal into the db file and syncs it, so it survives a power loss
+    def checkpoint(self):
+        if gb.globals.DEBUG_MODE >= 3:
+            return 1
+        try:
+            with self.pool.writer() as connection:
+                connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        except Exception:
+            return 0
+        return 1
+
     # wrappers for insert, rename, delete and get ops for profiles and hunts tables 
     def insert_profile(self, name):
         query = '''
@@ -538,60 +1308,125 @@ class DBHandler:
         return {row[0]: row[1] for row in result}
     
     # method to get agg data to display in gui
+    # reads the aggregate tables kept by triggers (see MIGRATIONS), only index lookups
     def get_agg_data(self, id):
         # we display up to last 5 encountered mons, top 5 and also total
         queries = [
         '''
-            SELECT
-                monster_id,
-                COUNT(monster_id) AS qty,
-                SUM(alpha) AS qty_a,
-                SUM(shiny) AS qty_s
-            FROM encounters
+            SELECT monster_id, qty, qty_a, qty_s
+            FROM hunt_monster_stats
             WHERE hunt_id = ?1
-            GROUP BY monster_id
-            ORDER BY MAX(timestamp) DESC
+            ORDER BY last_seen DESC
             LIMIT 5
         ''',
         '''
-            SELECT
-                monster_id,
-                COUNT(monster_id) AS qty,
-                SUM(alpha) AS qty_a,
-                SUM(shiny) AS qty_s
-            FROM encounters
+            SELECT monster_id, qty, qty_a, qty_s
+            FROM hunt_monster_stats
             WHERE hunt_id = ?1
-            GROUP BY monster_id
             ORDER BY qty DESC
             LIMIT 5
         ''',
         '''
-            SELECT
-                COUNT(*) AS qty
-            FROM encounters
+            SELECT qty
+            FROM hunt_totals
             WHERE hunt_id = ?1
         '''
         ]
         results = [self._fetch_query(query, (id,), 'get aggregated data') for query in queries]
         last = {row[0]: {'normal': row[1], 'alpha': row[2], 'shiny': row[3]} for row in results[0]}
         top = {row[0]: {'normal': row[1], 'alpha': row[2], 'shiny': row[3]} for row in results[1]}
-        total = [row[0] for row in results[2]][0]
+        # hunts without encounters have no row
+        total = results[2][0][0] if results[2] else 0
 
         return {'last': last, 'top': top, 'total': total}
     
+    # rollups of a hunt for the stats window (see src/stats.py), their size depends on hours hunted and monsters seen
+    # not on the number of encounters
+    # totals is (hours hunted, encounters, alphas, shinies, first hour, last hour)
+    # hourly has the hours since since_hour, species every monster seen
+    def get_hunt_rollups(self, id, since_hour = 0):
+        queries = [
+        '''
+            SELECT COUNT(*), COALESCE(SUM(qty), 0), COALESCE(SUM(qty_a), 0), COALESCE(SUM(qty_s), 0), MIN(hour), MAX(hour)
+            FROM hunt_hourly_stats
+            WHERE hunt_id = ?1
+        ''',
+        '''
+            SELECT hour, qty, qty_a, qty_s
+            FROM hunt_hourly_stats
+            WHERE hunt_id = ?1 AND hour >= ?2
+            ORDER BY hour
+        ''',
+        '''
+            SELECT monster_id, qty, qty_a, qty_s
+            FROM hunt_monster_stats
+            WHERE hunt_id = ?1
+        '''
+        ]
+        data = [(id,), (id, since_hour), (id,)]
+        results = [self._fetch_query(query, params, 'get hunt rollups', log = False) for query, params in zip(queries, data)]
+        return {'totals': results[0][0], 'hourly': results[1], 'species': results[2]}
+
+    # every monster of a hunt, for the gui model
+    # returns the id of the last encounter saved along with the stats, both read in the same statement
+    # so encounters after that id are exactly the ones the stats do not have yet
+    def get_hunt_stats(self, id):
+        query = '''
+            SELECT m.max_id, s.monster_id, s.qty, s.qty_a, s.qty_s, s.last_seen
+            FROM (SELECT COALESCE(MAX(id), 0) AS max_id FROM encounters) AS m
+                LEFT JOIN hunt_monster_stats AS s
+                    ON s.hunt_id = ?1
+        '''
+        result = self._fetch_query(query, (id,), 'get hunt stats')
+        if not result:
+            return 0, {}
+        stats = {row[1]: {'normal': row[2], 'alpha': row[3], 'shiny': row[4], 'last_seen': row[5]}
+                 for row in result if row[1] is not None}
+        return result[0][0], stats
+
     # base method to extract data for export op
-    def _export_data(self, type, id):
+    # rows are streamed from the cursor to the file in chunks, so memory use does not depend on the db size
+    # meant to run on a background thread, it never touches the gui:
+    # - progress is called as progress(rows written, total rows) after every chunk
+    # - cancel is a threading.Event, once set the export stops and its file is removed
+    # - incremental only exports encounters newer than the last incremental export of the same scope,
+    #   the last encounter id exported (high-water mark) is kept per scope in the export_marks table
+    # - append adds the rows to the last file exported for the scope instead of creating a new file
+    #   only with incremental, otherwise rows already in that file would be written to it again
+    # rows are written under a temp name and only added to their final file when complete
+    # every export is listed in data_exports/manifest.json (see _update_manifest)
+    # the path of the last file written is kept in last_export_path, None when there was nothing new to export
+    def _export_data(self, type, id, compress = False, progress = None, cancel = None, incremental = False, append = False):
         if type == 'hunt':
-            where = f'e.hunt_id = {id}'
-            suffix = f'hunt_id_{id}'
+            # the + keeps sqlite from using the hunt index, which would need sorting everything by id first
+            # instead rows are read in id order straight from the table and streamed as they come
+            where = '+e.hunt_id = ?'
+            total_query = 'SELECT COALESCE(SUM(qty), 0) FROM hunt_totals WHERE hunt_id = ?'
+            params = (id,)
+            scope = f'hunt_id_{id}'
         elif type == 'profile':
-            where = f'h.profile_id = {id}'
-            suffix = f'profile_id_{id}'
+            where = 'h.profile_id = ?'
+            total_query = '''
+                SELECT COALESCE(SUM(t.qty), 0)
+                FROM hunt_totals AS t
+                    JOIN hunts AS h
+                        ON t.hunt_id = h.id
+                WHERE h.profile_id = ?
+            '''
+            params = (id,)
+            scope = f'profile_id_{id}'
         elif type == 'all':
             where = '1 = 1'
-            suffix = 'all'
+            total_query = 'SELECT COUNT(*) FROM encounters'
+            params = ()
+            scope = 'all'
         else:
             raise ValueError('type should be one of "hunt", "profile" or "all".')
+        if append and not incremental:
+            raise ValueError('append needs incremental, a full export would duplicate the rows of the last file.')
+        # only encounters in (first_id, last_id] are exported, a rowid range, so incremental exports only read new rows
+        # encounters saved while exporting have greater ids and are left for the next one
+        where = f'e.id > ? AND e.id <= ? AND {where}'
         query = f'''
             SELECT
                 DATETIME(e.timestamp, "unixepoch", "localtime") AS datetime,
@@ -612,45 +1447,145 @@ class DBHandler:
                 LEFT JOIN profiles AS p
                     ON h.profile_id = p.id
             WHERE {where}
+            ORDER BY e.id
         '''
-        result = self._fetch_query(query, action = 'get data')
-        file_name = time.strftime(f"%Y_%m_%d__%H_%M_%S__{suffix}_data.csv", time.localtime())
-        file_path = os.path.join(self.data_exports_path, file_name)
+        if gb.globals.DEBUG_MODE in [2, 4]:
+            self.log_action('export data', query, (scope, incremental, append))
+        self.last_export_path = None
         Path(self.data_exports_path).mkdir(parents=True, exist_ok=True)
+        manifest = self._read_manifest()
+        extension = '.csv.gz' if compress else '.csv'
+        file_path = None
+        if append:
+            chunks = manifest['scopes'].get(scope, {}).get('chunks', [])
+            if chunks and chunks[-1]['file'].endswith(extension):
+                file_path = os.path.join(self.data_exports_path, chunks[-1]['file'])
+                file_path = file_path if os.path.isfile(file_path) else None
+        new_file = file_path is None
+        if new_file:
+            kind = 'delta' if incremental else 'data'
+            file_name = time.strftime(f"%Y_%m_%d__%H_%M_%S__{scope}_{kind}", time.localtime())
+            file_path = os.path.join(self.data_exports_path, file_name + extension)
+            # exports of the same scope within the same second
+            count = 1
+            while os.path.exists(file_path):
+                count += 1
+                file_path = os.path.join(self.data_exports_path, f'{file_name}_{count}{extension}')
+        temp_path = file_path + '.part'
         try:
-            with open(file_path, 'w', newline = '') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow([d[0] for d in self.cursor.description])
-                writer.writerows(result)
+            # a single reader for the whole export, wal keeps its view of the db while encounters keep coming
+            with self.pool.reader() as connection:
+                first_id = 0
+                if incremental:
+                    mark = connection.execute('SELECT last_id FROM export_marks WHERE scope = ?', (scope,)).fetchone()
+                    first_id = mark[0] if mark else 0
+                last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM encounters').fetchone()[0]
+                if incremental:
+                    total_query = f'''
+                        SELECT COUNT(*)
+                        FROM encounters AS e
+                            LEFT JOIN hunts AS h
+                                ON e.hunt_id = h.id
+                        WHERE {where}
+                    '''
+                    total = connection.execute(total_query, (first_id, last_id) + params).fetchone()[0]
+                    # nothing new, no empty file
+                    if not total:
+                        return 1
+                else:
+                    total = connection.execute(total_query, params).fetchone()[0]
+                cursor = connection.execute(query, (first_id, last_id) + params)
+                opener = gzip.open if compress else open
+                with opener(temp_path, 'wt', newline = '') as csv_file:
+                    writer = csv.writer(csv_file)
+                    if new_file:
+                        writer.writerow([d[0] for d in cursor.description])
+                    written = 0
+                    if progress is not None:
+                        progress(written, total)
+                    while True:
+                        if cancel is not None and cancel.is_set():
+                            break
+                        rows = cursor.fetchmany(self.EXPORT_CHUNK_SIZE)
+                        if not rows:
+                            break
+                        writer.writerows(rows)
+                        written += len(rows)
+                        if progress is not None:
+                            progress(written, max(total, written))
+                cursor.close()
+            if cancel is not None and cancel.is_set():
+                os.remove(temp_path)
+                return 0
+            if new_file:
+                os.replace(temp_path, file_path)
+            else:
+                # gzip files can be concatenated, appending works the same for both formats
+                with open(temp_path, 'rb') as temp_file, open(file_path, 'ab') as export_file:
+                    shutil.copyfileobj(temp_file, export_file)
+                os.remove(temp_path)
+            if incremental:
+                with self.pool.writer() as connection:
+                    connection.execute('''
+                        INSERT INTO export_marks (scope, last_id, updated)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT (scope) DO UPDATE SET
+                            last_id = excluded.last_id,
+                            updated = excluded.updated
+                    ''', (scope, last_id, time.time()))
+                    connection.commit()
+            self._update_manifest(manifest, scope, {
+                'file': os.path.basename(file_path),
+                'incremental': incremental,
+                'first_id': first_id + 1,
+                'last_id': last_id,
+                'rows': written,
+                'created': time.time()
+            })
         except Exception:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
             return 0
         else:
+            self.last_export_path = file_path
             return 1
 
-    # can export hunt, profile or all data
-    def export_hunt_data(self, id):
-        return self._export_data(type = 'hunt', id = id)
+    # the manifest lists every chunk of rows exported per scope, in order:
+    # {"scopes": {"hunt_id_1": {"chunks": [{"file": ..., "incremental": true, "first_id": 1, "last_id": 523, "rows": 120, "created": ...}]}}}
+    # several chunks share a file when exports are appended to it
+    # the export_marks table, not the manifest, decides what the next incremental export contains
+    def _manifest_path(self):
+        return os.path.join(self.data_exports_path, 'manifest.json')
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except Exception:
+            manifest = {}
+        manifest.setdefault('scopes', {})
+        return manifest
+
+    def _update_manifest(self, manifest, scope, chunk):
+        manifest['scopes'].setdefault(scope, {'chunks': []})['chunks'].append(chunk)
+        temp_path = self._manifest_path() + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent = 2)
+        os.replace(temp_path, self._manifest_path())
+
+    # can export hunt, profile or all data, see _export_data for the options
+    def export_hunt_data(self, id, **kwargs):
+        return self._export_data(type = 'hunt', id = id, **kwargs)
         
-    def export_profile_data(self, id):
-        return self._export_data(type = 'profile', id = id)
+    def export_profile_data(self, id, **kwargs):
+        return self._export_data(type = 'profile', id = id, **kwargs)
 
-    def export_all_data(self):
-        return self._export_data(type = 'all', id = id)
+    def export_all_data(self, **kwargs):
+        return self._export_data(type = 'all', id = None, **kwargs)
     
+    # only queued, written by the session logger thread (see src/logger.py)
     def log_action(self, action, query, data):
-        log_file_path = os.path.join(gb.globals.get_debug_path(), '0_0_session.log')
-
-        # Prepare the log entry
-        log_entry = (
-            f"{time.strftime('%Y%m%d_%H%M%S', time.localtime())} - ACTION: {action}\n"
-            f"QUERY: {query}\n"
-            f"DATA: {str(data)}\n"
-            "------------------------------------\n"
-        )
-
-        # Write the log entry to the file
-        with open(log_file_path, 'a') as log_file:
-            log_file.write(log_entry)
+        logger.logger.log(action, data, query = query)
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+import argparse
+
+import src.core as core
+
+# export encounters without the gui, e.g. from a scheduled job
+# python -m src.export data/yapec.sqlite3 --scope hunt --id 1 --incremental --append
+# files and manifest.json go to the data_exports folder one dir up from the db, see DBHandler._export_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export YAPEC encounters to csv.')
+    parser.add_argument('db', help = 'path to the database file')
+    parser.add_argument('--scope', choices = ['hunt', 'profile', 'all'], default = 'all', help = 'what to export')
+    parser.add_argument('--id', type = int, default = None, help = 'hunt or profile id')
+    parser.add_argument('--incremental', action = 'store_true', help = 'only encounters not exported by a previous incremental export')
+    parser.add_argument('--append', action = 'store_true', help = 'append to the last file exported for the scope')
+    parser.add_argument('--gzip', action = 'store_true', help = 'write .csv.gz files')
+    args = parser.parse_args()
+    if args.append and not args.incremental:
+        parser.error('--append needs --incremental, a full export would duplicate the rows of the last file')
+    if args.scope != 'all' and args.id is None:
+        parser.error('--id is needed to export a hunt or a profile')
+    if not os.path.isfile(args.db):
+        parser.error(f'database not found: {args.db}')
+
+    # brings older databases up to date (export marks)
+    core.DBHandler.setup_db(args.db)
+
+    options = {'compress': args.gzip, 'incremental': args.incremental, 'append': args.append}
+    with core.DBHandler(args.db) as db:
+        if args.scope == 'hunt':
+            result = db.export_hunt_data(args.id, **options)
+        elif args.scope == 'profile':
+            result = db.export_profile_data(args.id, **options)
+        else:
+            result = db.export_all_data(**options)
+        path = db.last_export_path
+    core.DBHandler.close_all()
+    if not result:
+        raise SystemExit('Failed to export data.')
+    print(path if path else 'No new encounters to export.')
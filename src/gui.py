@@ -1,15 +1,29 @@
 import os
 import json
 import time
-import win32gui
+import heapq
+import queue
+import threading
+import collections
 
 import tkinter as tk
+import tkinter.ttk as ttk
 from pathlib import Path
 import tkinter.messagebox as messagebox
 import tkinter.simpledialog as simpledialog
 
 import src.globals as gb
 import src.core as core
+import src.atlas as atlas
+import src.stats as stats
+import src.recorder as recorder
+import src.metrics as metrics
+import src.profiler as profiler
+
+try:
+    import win32gui
+except ImportError:
+    win32gui = None
 
 DEFAULT_FONT = ('Arial', 14)
 
@@ -86,28 +100,144 @@ def _askmultiplechoice(options_values, options_labels = None, label = None, mess
         return None
     
 
+_redraw_time = metrics.histogram('yapec_gui_redraw_seconds', 'time to patch the gui with new encounters')
+
+
+# in memory copy of the counts of the active hunt
+# loaded once from the db when the hunt is selected, then kept current with the encounters the engine publishes
+# encounters are (encounter id, row) with row in encounters column order (timestamp, monster_id, level, shiny, alpha, hunt_id)
+class HuntModel:
+    def __init__(self):
+        self.hunt_id = None
+        # id of the last encounter already counted
+        self.last_id = 0
+        self.stats = {}
+        self.total = 0
+
+    def load(self, db_file, hunt_id):
+        with core.DBHandler(db_file) as db:
+            self.last_id, self.stats = db.get_hunt_stats(hunt_id)
+        self.hunt_id = hunt_id
+        self.total = sum(qty['normal'] for qty in self.stats.values())
+
+    # returns True when the encounter changed the counts
+    def apply(self, encounter_id, row):
+        timestamp, monster_id, _, shiny, alpha, hunt_id = row
+        # keyed like the stats loaded from the db
+        monster_id = int(monster_id)
+        # other hunts, or already counted when the model was loaded
+        if hunt_id != self.hunt_id or encounter_id <= self.last_id:
+            return False
+        qty = self.stats.setdefault(monster_id, {'normal': 0, 'alpha': 0, 'shiny': 0, 'last_seen': timestamp})
+        qty['normal'] += 1
+        qty['alpha'] += alpha
+        qty['shiny'] += shiny
+        qty['last_seen'] = max(qty['last_seen'], timestamp)
+        self.total += 1
+        self.last_id = encounter_id
+        return True
+
+    # last seen and most seen monsters, only size of them are ever sorted
+    def last(self, size):
+        return dict(heapq.nlargest(size, self.stats.items(), key = lambda item: item[1]['last_seen']))
+
+    def top(self, size):
+        return dict(heapq.nlargest(size, self.stats.items(), key = lambda item: item[1]['normal']))
+
+
+# monster sprites loaded and scaled once and shared by every CountEntry
+# least recently used sprites are dropped past max_entries, widgets showing them keep their own reference
+# sprites are sliced out of the atlas (see src/atlas.py), decoded once on first use
+# the loose sprite files are only read when there is no atlas
+class SpriteCache:
+
+    MAX_ENTRIES = 128
+    # sprites are shown at 5/4 of their size
+    ZOOM = 5
+    SUBSAMPLE = 4
+
+    def __init__(self, root_path, max_entries = None, zoom = None, subsample = None):
+        self.sprites_path = os.path.join(root_path, 'icons', 'monstersprites')
+        self.atlas_path = os.path.join(root_path, 'icons', 'monstersprites.png')
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.zoom = zoom or self.ZOOM
+        self.subsample = subsample or self.SUBSAMPLE
+        self.sprites = collections.OrderedDict()
+        self.atlas = None
+        self.index = None
+        index_path = os.path.join(root_path, 'icons', 'monstersprites.json')
+        if os.path.isfile(self.atlas_path) and os.path.isfile(index_path):
+            self.index = atlas.load_index(index_path)
+
+    def _load(self, id):
+        if self.index is not None:
+            if self.atlas is None:
+                self.atlas = tk.PhotoImage(file = self.atlas_path)
+            x, y, w, h = self.index.get(str(id)) or self.index['0']
+            sprite = tk.PhotoImage(width = w, height = h)
+            sprite.tk.call(sprite, 'copy', self.atlas, '-from', x, y, x + w, y + h)
+            return sprite.zoom(self.zoom, self.zoom).subsample(self.subsample, self.subsample)
+        icon_path = os.path.join(self.sprites_path, str(id) + '.png')
+        if not os.path.isfile(icon_path):
+            icon_path = os.path.join(self.sprites_path, '0.png')
+        return tk.PhotoImage(file = icon_path).zoom(self.zoom, self.zoom).subsample(self.subsample, self.subsample)
+
+    def get(self, id):
+        key = (id, self.zoom, self.subsample)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = self.sprites[key] = self._load(id)
+            while len(self.sprites) > self.max_entries:
+                self.sprites.popitem(last = False)
+        else:
+            self.sprites.move_to_end(key)
+        return sprite
+
+    # load sprites ahead of time, e.g. every monster already seen on the active hunt
+    def warm(self, ids):
+        for id in list(ids)[:self.max_entries]:
+            self.get(id)
+
+
 # widget that contains info of one entry on a column
 # should contain pokemon sprite, encountered count and, if on, alpha and shiny count
+# entries are reused when counts change, set only touches the labels whose values changed
 class CountEntry(tk.Frame):
     def __init__(self, parent, id, qty, show_alpha_shiny = True):
         super().__init__(parent, pady = 0, borderwidth = 0)
         self.root_path = self.winfo_toplevel().root_path
-        self.icon_path = os.path.join(self.root_path, 'icons', 'monstersprites', str(id) + '.png')
-        if not os.path.isfile(self.icon_path):
-            self.icon_path = os.path.join(self.root_path, 'icons', 'monstersprites', '0.png')
-        self.img = tk.PhotoImage(file = self.icon_path).zoom(5, 5).subsample(4, 4)
+        self.show_alpha_shiny = show_alpha_shiny
+        self.id = None
+        self.texts = {}
 
         if show_alpha_shiny:
-            tk.Label(self, image = self.img, borderwidth = 0)\
-                .grid(row = 0, column = 0, rowspan = 2, padx = 0)
+            self.img_label = tk.Label(self, borderwidth = 0)
+            self.img_label.grid(row = 0, column = 0, rowspan = 2, padx = 0)
 
-            tk.Label(self, text = str(qty['normal']), font = DEFAULT_FONT, borderwidth = 0)\
-                .grid(row = 0, column = 1, pady = 0)
+            self.qty_label = tk.Label(self, font = DEFAULT_FONT, borderwidth = 0)
+            self.qty_label.grid(row = 0, column = 1, pady = 0)
 
-            tk.Label(self, text = f'A: {qty["alpha"]} | S: {qty["shiny"]}', borderwidth = 0)\
-                .grid(row = 1, column = 1, pady = 0)
+            self.as_label = tk.Label(self, borderwidth = 0)
+            self.as_label.grid(row = 1, column = 1, pady = 0)
         else:
-            tk.Label(self, image = self.img, text = str(qty['normal']), font = DEFAULT_FONT, borderwidth = 0, compound = tk.LEFT).pack()
+            self.img_label = self.qty_label = tk.Label(self, font = DEFAULT_FONT, borderwidth = 0, compound = tk.LEFT)
+            self.img_label.pack()
+            self.as_label = None
+        self.set(id, qty)
+
+    def _set_text(self, label, text):
+        if self.texts.get(label) != text:
+            label.configure(text = text)
+            self.texts[label] = text
+
+    def set(self, id, qty):
+        if id != self.id:
+            self.img = self.winfo_toplevel().sprites.get(id)
+            self.img_label.configure(image = self.img)
+            self.id = id
+        self._set_text(self.qty_label, str(qty['normal']))
+        if self.as_label is not None:
+            self._set_text(self.as_label, f'A: {qty["alpha"]} | S: {qty["shiny"]}')
 
 
 # widget that contains all CountEntries in a column format
@@ -116,10 +246,24 @@ class CountCol(tk.Frame):
     def __init__(self, parent, title, values, show_alpha_shiny = True):
         super().__init__(parent, padx = 14, borderwidth = 0, pady = 0)
         self.title = title
-        self.values = values   
+        self.show_alpha_shiny = show_alpha_shiny
+        self.entries = []
         tk.Label(self, text = title, font = DEFAULT_FONT, pady = 0, borderwidth = 0).grid(column = 0, row = 0)
+        self.update_values(values)
+
+    # reorder in place: every position keeps its widget and only gets the values now at that position
+    def update_values(self, values):
+        self.values = values
         for i, (id, qty) in enumerate(list(values.items())):
-            CountEntry(self, id, qty, show_alpha_shiny = show_alpha_shiny).grid(column = 0, row = i+1, sticky = tk.W)
+            if i < len(self.entries):
+                self.entries[i].set(id, qty)
+            else:
+                entry = CountEntry(self, id, qty, show_alpha_shiny = self.show_alpha_shiny)
+                entry.grid(column = 0, row = i+1, sticky = tk.W)
+                self.entries.append(entry)
+        for entry in self.entries[len(values):]:
+            entry.destroy()
+        self.entries = self.entries[:len(values)]
         
 
 # Menu with parent
@@ -329,32 +473,317 @@ class HuntMenu(ProfHuntMenu):
         self.winfo_toplevel().event_generate("<<HuntSelected>>")
 
 
+# window showing the progress of an export running on a background thread, with a button to cancel it
+# the thread only updates plain attributes, the window reads them with after so tk is only used from its thread
+class ExportWindow(tk.Toplevel):
+
+    POLL_MS = 100
+
+    def __init__(self, parent, db_file, type, id, compress = False, incremental = False, append = False):
+        super().__init__(parent)
+        self.title('Export')
+        self.resizable(False, False)
+        self.transient(parent)
+        self.geometry(f'+{parent.winfo_x()+50}+{parent.winfo_y()+50}')
+        self.protocol('WM_DELETE_WINDOW', self.on_cancel)
+
+        self.db_file = db_file
+        self.type = type
+        self.id = id
+        self.compress = compress
+        self.incremental = incremental
+        self.append = append
+        self.cancel_event = threading.Event()
+        self.written = 0
+        self.total = 0
+        self.result = None
+        self.file_path = None
+
+        self.label = tk.Label(self, text = 'Exporting...', padx = 10, pady = 5)
+        self.label.pack()
+        self.progress_bar = ttk.Progressbar(self, length = 250, mode = 'determinate')
+        self.progress_bar.pack(padx = 10)
+        tk.Button(self, text = 'Cancel', width = 10, command = self.on_cancel).pack(padx = 5, pady = 5)
+
+        self.thread = threading.Thread(target = self._export, daemon = True)
+        self.thread.start()
+        self.after(self.POLL_MS, self._poll)
+
+    def _progress(self, written, total):
+        self.written = written
+        self.total = total
+
+    def _export(self):
+        try:
+            options = {'compress': self.compress, 'incremental': self.incremental, 'append': self.append,
+                       'progress': self._progress, 'cancel': self.cancel_event}
+            with core.DBHandler(self.db_file) as db:
+                if self.type == 'hunt':
+                    result = db.export_hunt_data(self.id, **options)
+                elif self.type == 'profile':
+                    result = db.export_profile_data(self.id, **options)
+                else:
+                    result = db.export_all_data(**options)
+                self.file_path = db.last_export_path
+        except Exception:
+            result = 0
+        self.result = result
+
+    def _poll(self):
+        if self.thread.is_alive():
+            if self.total:
+                self.progress_bar['value'] = 100*self.written/self.total
+            self.label.configure(text = f'Exported {self.written} of {self.total} encounters...')
+            self.after(self.POLL_MS, self._poll)
+            return
+        self.destroy()
+        if self.cancel_event.is_set():
+            messagebox.showinfo(title = 'Export', message = 'Export cancelled.')
+        elif self.result and self.file_path is None:
+            messagebox.showinfo(title = 'Export', message = 'No new encounters to export.')
+        elif self.result:
+            messagebox.showinfo(title = 'Success', message = f'Successfully extracted data to {self.file_path}')
+        else:
+            messagebox.showerror(title = 'Error', message = 'Failed to extract data.')
+
+    def on_cancel(self):
+        self.cancel_event.set()
+
+
 # menu that handles all export data commands
+# exports run in the background (see ExportWindow), one at a time
 class ExportMenu(CustomMenu):
-    def __init__(self, parent):
+    def __init__(self, parent, compress = False, incremental = False, append = False):
         super().__init__(parent, tearoff = False)
+        self.export_window = None
 
         self.add_command(label = 'Hunt Data', command = lambda: self.on_export_data('hunt'))
         self.add_command(label = 'Profile Data', command = lambda: self.on_export_data('profile'))
         self.add_command(label = 'All Data', command = lambda: self.on_export_data('all'))
+        self.add_separator()
+        self.compress_var = tk.BooleanVar()
+        self.compress_var.set(compress)
+        self.add_checkbutton(label = 'Compress (gzip)', variable = self.compress_var, onvalue = True, offvalue = False)
+        # only encounters not exported yet by a previous "only new" export
+        self.incremental_var = tk.BooleanVar()
+        self.incremental_var.set(incremental)
+        self.add_checkbutton(label = 'Only New Encounters', variable = self.incremental_var, onvalue = True, offvalue = False,
+                             command = self.on_incremental_change)
+        # only with new encounters, a full export appended to the last file would repeat its rows
+        self.append_var = tk.BooleanVar()
+        self.append_var.set(append and incremental)
+        self.add_checkbutton(label = 'Append to Last File', variable = self.append_var, onvalue = True, offvalue = False)
+        self.append_index = self.index(tk.END)
+        self.on_incremental_change()
+
+    def on_incremental_change(self):
+        if not self.incremental_var.get():
+            self.append_var.set(False)
+        self.entryconfigure(self.append_index, state = tk.NORMAL if self.incremental_var.get() else tk.DISABLED)
     
     def export_data(self, type = None, ids = None):
-        with core.DBHandler(self.winfo_toplevel().db_file) as db:
-            if type == 'hunt' and id:
-                result = db.export_hunt_data(ids[0])
-            elif type == 'profile' and id:
-                result = db.export_profile_data(ids[1])
-            elif type == 'all':
-                result = db.export_all_data()
-            if result:
-                messagebox.showinfo(title = 'Success', message = f'Successfully extracted data to {db.data_exports_path}')
-            else:
-                messagebox.showerror(title = 'Error', message = 'Failed to extract data.')
+        if self.export_window is not None and self.export_window.winfo_exists():
+            messagebox.showinfo(title = 'Export', message = 'An export is already running.')
+            return 0
+        if type == 'hunt' and ids:
+            id = ids[0]
+        elif type == 'profile' and ids:
+            id = ids[1]
+        elif type == 'all':
+            id = None
+        else:
+            return 0
+        self.export_window = ExportWindow(self.winfo_toplevel(), self.winfo_toplevel().db_file_path, type, id,
+                                          compress = self.compress_var.get(),
+                                          incremental = self.incremental_var.get(),
+                                          append = self.append_var.get() and self.incremental_var.get())
+        return 1
 
     def on_export_data(self, type = None):
         self.winfo_toplevel().event_generate("<<ExportData>>", data = type)
 
 
+# statistics of the active hunt, computed from the hourly and monster rollups (see src/stats.py)
+# refreshed every REFRESH_MS, a refresh costs the same no matter how many encounters the hunt has
+class StatsWindow(tk.Toplevel):
+
+    REFRESH_MS = 5000
+    CHART_WIDTH = 288
+    CHART_HEIGHT = 60
+    # monsters listed in the distribution
+    SPECIES = 10
+
+    def __init__(self, parent, db_file, hunt_var):
+        super().__init__(parent)
+        self.title('Statistics')
+        self.resizable(False, False)
+        self.geometry(f'+{parent.winfo_x()+50}+{parent.winfo_y()+50}')
+        self.db_file = db_file
+        self.hunt_var = hunt_var
+        self.after_id = None
+
+        self.labels = {}
+        names = ['Encounters', 'Shinies', 'Alphas', 'Per Hour', 'Trend', 'Next Shiny', 'Shiny Chance']
+        for row, name in enumerate(names):
+            tk.Label(self, text = name, anchor = tk.W).grid(row = row, column = 0, sticky = tk.W, padx = 5)
+            self.labels[name] = tk.Label(self, anchor = tk.E)
+            self.labels[name].grid(row = row, column = 1, sticky = tk.E, padx = 5)
+        row = len(names)
+        self.charts = {}
+        for title in [f'Last {stats.RECENT_HOURS} Hours', f'Last {stats.RECENT_DAYS} Days']:
+            tk.Label(self, text = title, anchor = tk.W).grid(row = row, column = 0, columnspan = 2, sticky = tk.W, padx = 5)
+            self.charts[title] = tk.Canvas(self, width = self.CHART_WIDTH, height = self.CHART_HEIGHT, highlightthickness = 0)
+            self.charts[title].grid(row = row + 1, column = 0, columnspan = 2, padx = 5)
+            row += 2
+        tk.Label(self, text = 'Most Seen', anchor = tk.W).grid(row = row, column = 0, columnspan = 2, sticky = tk.W, padx = 5)
+        self.species_label = tk.Label(self, anchor = tk.W, justify = tk.LEFT, font = ('Courier', 9))
+        self.species_label.grid(row = row + 1, column = 0, columnspan = 2, sticky = tk.W, padx = 5, pady = 5)
+        self.refresh()
+
+    def _draw_bars(self, canvas, values):
+        canvas.delete('all')
+        if not len(values) or not values.max():
+            return
+        width = self.CHART_WIDTH/len(values)
+        scale = (self.CHART_HEIGHT - 1)/values.max()
+        for i, value in enumerate(values):
+            if value:
+                canvas.create_rectangle(i*width, self.CHART_HEIGHT - value*scale, (i + 1)*width - 1, self.CHART_HEIGHT,
+                                        fill = 'steel blue', width = 0)
+
+    def refresh(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+        # a day more, the first local day shown may start before its utc hours
+        since_hour = int(time.time()//stats.HOUR) - (stats.RECENT_DAYS + 1)*24
+        with core.DBHandler(self.db_file) as db:
+            rollups = db.get_hunt_rollups(self.hunt_var.get(), since_hour)
+        summary = stats.hunt_summary(rollups)
+
+        hours_to_shiny = summary['hours_to_shiny']
+        texts = {
+            'Encounters': f"{summary['total']} in {summary['hours_hunted']}h",
+            'Shinies': f"{summary['shinies']} ({summary['shiny_rate']:.3%})",
+            'Alphas': f"{summary['alphas']} ({summary['alpha_rate']:.3%})",
+            'Per Hour': f"{summary['recent_rate']:.0f} now, {summary['rate']:.0f} overall",
+            'Trend': f"{summary['rate_change']:+.0%}",
+            'Next Shiny': f'~{hours_to_shiny:.1f}h' if hours_to_shiny is not None else '-',
+            'Shiny Chance': f"{summary['shiny_chance']:.1%} (50% at {summary['encounters_to_50']})"
+        }
+        for name, text in texts.items():
+            self.labels[name].configure(text = text)
+
+        recent, daily = list(self.charts.values())
+        self._draw_bars(recent, summary['recent'])
+        self._draw_bars(daily, summary['daily'])
+
+        lines = []
+        for id, qty, share in summary['species'][:self.SPECIES]:
+            name = core.mn.MONSTER_NAMES_DICT.get(str(id), str(id))
+            lines.append(f'{name[:14]:<14} {qty:>7} {share:>6.1%}')
+        self.species_label.configure(text = '\n'.join(lines) if lines else 'No encounters yet.')
+        self.after_id = self.after(self.REFRESH_MS, self.refresh)
+
+    # the next refresh would run on a destroyed window
+    def destroy(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        super().destroy()
+
+
+# hunt of every game client when more than one is running (see manager.ClientPipeline)
+# a client follows the active hunt (0) unless a hunt is picked for it
+# rebuilt every time it opens, so it always lists the current profiles and hunts
+class ClientsMenu(CustomMenu):
+    # names are the FrameSource.name of every client, hunts the hunt picked for every name
+    def __init__(self, parent, names, hunts = None):
+        super().__init__(parent, tearoff = False, postcommand = self.update_values)
+        self.client_menus = []
+        self.names = names
+        self.hunt_vars = []
+        hunts = hunts or {}
+        for name in names:
+            var = tk.IntVar()
+            var.set(hunts.get(name, 0))
+            self.hunt_vars.append(var)
+        self.update_values()
+
+    # hunt picked for every client by name, clients on the active hunt are left out
+    def hunts(self):
+        return {name: var.get() for name, var in zip(self.names, self.hunt_vars) if var.get()}
+
+    def update_values(self):
+        self.delete(0, tk.END)
+        for client_menu in self.client_menus:
+            client_menu.destroy()
+        self.client_menus = []
+        profiles_menu = self.winfo_toplevel().profiles_menu
+        for i, var in enumerate(self.hunt_vars):
+            # a picked hunt that was deleted goes back to the active hunt
+            if var.get() and var.get() not in profiles_menu.hunts_values_flat:
+                var.set(0)
+            client_menu = CustomMenu(self, tearoff = False)
+            client_menu.add_radiobutton(label = 'Active Hunt', var = var, value = 0, command = self.on_change)
+            for profile_id, profile_name in profiles_menu.values.items():
+                client_menu.add_separator()
+                for hunt_id, hunt_name in profiles_menu.hunts_values.get(profile_id, {}).items():
+                    client_menu.add_radiobutton(label = f'{profile_name} - {hunt_name}', var = var, value = hunt_id,
+                                                command = self.on_change)
+            self.add_cascade(label = f'Client {i + 1}: {self.names[i]}', menu = client_menu)
+            self.client_menus.append(client_menu)
+
+    def on_change(self):
+        self.winfo_toplevel().event_generate('<<ClientsChange>>')
+
+
+# table of the session metrics (see src/metrics.py), durations in milliseconds
+class MetricsWindow(tk.Toplevel):
+
+    REFRESH_MS = 1000
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title('Metrics')
+        self.geometry(f'+{parent.winfo_x()+50}+{parent.winfo_y()+50}')
+        self.label = tk.Label(self, anchor = tk.W, justify = tk.LEFT, font = ('Courier', 9), padx = 5, pady = 5)
+        self.label.pack(fill = tk.BOTH)
+        self.after_id = None
+        self.refresh()
+
+    @staticmethod
+    def _ms(value):
+        return f'{value*1000:9.2f}' if value is not None else f'{"-":>9}'
+
+    def refresh(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+        snapshot = metrics.registry.snapshot()['metrics']
+        lines = [f'{"histogram":<48}{"count":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"max":>9}']
+        for name, values in snapshot.items():
+            if values['type'] != 'histogram':
+                continue
+            if name.endswith('_seconds') or '_seconds{' in name:
+                columns = ''.join(self._ms(values[key]) for key in ['p50', 'p95', 'p99', 'max'])
+            else:
+                columns = ''.join(f'{values[key]:9.1f}' if values[key] is not None else f'{"-":>9}' for key in ['p50', 'p95', 'p99', 'max'])
+            lines.append(f'{name[:47]:<48}{values["count"]:>8}{columns}')
+        lines.append('')
+        lines.append(f'{"counter":<48}{"value":>8}')
+        for name, values in snapshot.items():
+            if values['type'] == 'counter':
+                lines.append(f'{name[:47]:<48}{values["value"]:>8}')
+        self.label.configure(text = '\n'.join(lines))
+        self.after_id = self.after(self.REFRESH_MS, self.refresh)
+
+    # the next refresh would run on a destroyed window
+    def destroy(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        super().destroy()
+
+
 class ViewMenu(CustomMenu):
     def __init__(self, parent, size, start_view, show_alpha_shiny):
         super().__init__(parent, tearoff = False)
@@ -411,6 +840,12 @@ class DebugMenu(CustomMenu):
                    'Full Debug': 4
                 }
 
+    PROFILE_DURATIONS = {'30 Seconds': 30,
+                         '2 Minutes': 120,
+                         '10 Minutes': 600
+                        }
+    PROFILE_POLL_MS = 200
+
     def __init__(self, parent):
         super().__init__(parent, tearoff = False)
         self.debug_var = tk.IntVar()
@@ -418,6 +853,48 @@ class DebugMenu(CustomMenu):
         self.debug_window = None
         for k, v in self.DEBUG_MODES.items():
             self.add_radiobutton(label = k, variable = self.debug_var, value = v, command = self.on_debug_change)
+        self.add_separator()
+        # frames kept by the flight recorder in the debug modes, saved on demand (see src/recorder.py)
+        self.add_command(label = 'Save Recorded Frames', command = self.on_save_frames)
+        self.add_command(label = 'Metrics', command = self.on_metrics)
+        self.metrics_window = None
+        # sampling profile of every thread and memory growth of the running session (see src/profiler.py)
+        self.profile_menu = CustomMenu(self, tearoff = False)
+        for label, seconds in self.PROFILE_DURATIONS.items():
+            self.profile_menu.add_command(label = label, command = lambda seconds = seconds: self.on_profile(seconds))
+        self.profile_menu.add_separator()
+        self.profile_menu.add_command(label = 'Stop Profiling', command = self.on_stop_profile)
+        self.add_cascade(label = 'Profile', menu = self.profile_menu)
+
+    def on_profile(self, seconds):
+        path = profiler.profiler.start(seconds)
+        if path is None:
+            messagebox.showinfo(title = 'Debug', message = 'A profile is already running.')
+            return
+        messagebox.showinfo(title = 'Debug', message = f'Profiling for {seconds} seconds, results will be saved to {path}')
+
+    def on_stop_profile(self):
+        if not profiler.profiler.running():
+            messagebox.showinfo(title = 'Debug', message = 'No profile is running.')
+            return
+        # reports are written on the profiler thread, the gui only checks when they are done
+        self.after(self.PROFILE_POLL_MS, self._wait_profile, profiler.profiler.stop())
+
+    def _wait_profile(self, path):
+        if profiler.profiler.running():
+            self.after(self.PROFILE_POLL_MS, self._wait_profile, path)
+            return
+        messagebox.showinfo(title = 'Debug', message = f'Profile saved to {path}')
+
+    def on_metrics(self):
+        if self.metrics_window is not None and self.metrics_window.winfo_exists():
+            self.metrics_window.lift()
+            return
+        self.metrics_window = MetricsWindow(self.winfo_toplevel())
+
+    def on_save_frames(self):
+        if not recorder.recorder.dump('user'):
+            messagebox.showinfo(title = 'Debug', message = 'No new frames recorded, frames are only recorded in Soft Debug and Full Debug.')
 
     def on_debug_change(self):
         debug_mode = self.debug_var.get()
@@ -432,51 +909,69 @@ class DebugMenu(CustomMenu):
 
 
 class OptionsMenu(CustomMenu):
-    def __init__(self, parent, size, start_view, show_alpha_shiny):
+    def __init__(self, parent, size, start_view, show_alpha_shiny, export_options = None):
         super().__init__(parent, tearoff = False)
 
         self.view_menu = ViewMenu(self, size, start_view, show_alpha_shiny)
         self.add_cascade(label = 'View', menu = self.view_menu)
 
-        self.export_menu = ExportMenu(self)
+        self.export_menu = ExportMenu(self, **(export_options or {}))
         self.add_cascade(label = 'Export', menu = self.export_menu)
 
         self.debug_menu = DebugMenu(self)
         self.add_cascade(label = 'Debug', menu = self.debug_menu)
 
+        self.add_command(label = 'Statistics', command = self.on_stats)
         self.add_command(label = 'Exit', command = self.on_exit)
 
+    def on_stats(self):
+        self.winfo_toplevel().event_generate('<<ShowStats>>')
+
     def on_exit(self):
         self.winfo_toplevel().event_generate('<<Exit>>')
 
 
 # widget that contains all columns in a frame, side by side to form the gui body
 # total count is also added here
+# values come from the main window model, the body is only rebuilt when the layout changes
 class Body(tk.Frame):
     def __init__(self, parent):
         super().__init__(parent, pady = 0, borderwidth = 0)
-        self.db_file = self.winfo_toplevel().db_file_path
-        with core.DBHandler(self.db_file) as db:
-            self.values = db.get_agg_data(self.winfo_toplevel().profiles_menu.active_hunt_var.get())
+        self.model = self.winfo_toplevel().model
+        self.cols = []
 
-        size = self.winfo_toplevel().options_menu.view_menu.size_menu.size_var.get()
-        if size:
+        self.size = self.winfo_toplevel().options_menu.view_menu.size_menu.size_var.get()
+        if self.size:
             col_names = []
-            col_values = []
             if self.winfo_toplevel().options_menu.view_menu.col_menu.col_var[0].get():
                 col_names.append('Last')
-                col_values.append(dict(list(self.values['last'].items())[:size]))
             if self.winfo_toplevel().options_menu.view_menu.col_menu.col_var[1].get():
                 col_names.append('Top')
-                col_values.append(dict(list(self.values['top'].items())[:size]))
             show_alpha_shiny = self.winfo_toplevel().options_menu.view_menu.show_alpha_shiny_var.get()
-            for i, (name, values) in enumerate(zip(col_names, col_values)):
-                CountCol(self, name, values, show_alpha_shiny = show_alpha_shiny).grid(row = 0, column = i)
+            for i, name in enumerate(col_names):
+                col = CountCol(self, name, self._col_values(name), show_alpha_shiny = show_alpha_shiny)
+                col.grid(row = 0, column = i)
+                self.cols.append(col)
             col_size = len(col_names) if len(col_names) > 0 else 1
-            tk.Label(self, text = 'Total ' + str(self.values['total']), font = DEFAULT_FONT, pady = 5, borderwidth = 0, padx = 0)\
-                .grid(sticky = tk.E, columnspan = col_size, row = 1, column = 0)
+            self.total_label = tk.Label(self, text = self._total_text(), font = DEFAULT_FONT, pady = 5, borderwidth = 0, padx = 0)
+            self.total_label.grid(sticky = tk.E, columnspan = col_size, row = 1, column = 0)
         else:
-            tk.Label(self, text = 'Total ' + str(self.values['total']), font = DEFAULT_FONT, pady = 0, borderwidth = 0, padx = 0).pack(fill = tk.BOTH)
+            self.total_label = tk.Label(self, text = self._total_text(), font = DEFAULT_FONT, pady = 0, borderwidth = 0, padx = 0)
+            self.total_label.pack(fill = tk.BOTH)
+
+    def _col_values(self, name):
+        return self.model.last(self.size) if name == 'Last' else self.model.top(self.size)
+
+    def _total_text(self):
+        return 'Total ' + str(self.model.total)
+
+    # patch the widgets with the current model values
+    def update_values(self):
+        for col in self.cols:
+            col.update_values(self._col_values(col.title))
+        text = self._total_text()
+        if self.total_label.cget('text') != text:
+            self.total_label.configure(text = text)
 
 # root class
 # app root should be centered (to allow children to be centered as well)
@@ -498,6 +993,12 @@ class Root(tk.Tk):
 # it gets and saves last selected options to allow starting from previous state
 # and call the (re)creation of the menu and body
 class MainWindow(tk.Toplevel):
+
+    # how often published encounters are applied to the gui
+    ENCOUNTERS_POLL_MS = 100
+    # sprites loaded per idle callback when warming the cache
+    SPRITES_WARM_CHUNK = 8
+
     def __init__(self, root_path, db_file):
         self.root_path = root_path
         self.root = Root(root_path)
@@ -522,17 +1023,31 @@ class MainWindow(tk.Toplevel):
         self.create_menu_bar(size = self.init_values.get('size', 3),
                              start_view = self.init_values.get('cols', (True, True)),
                              start_hunt = self.init_values.get('active_hunt_id', None),
-                             show_alpha_shiny = self.init_values.get('as', True)
+                             show_alpha_shiny = self.init_values.get('as', True),
+                             export_options = {'compress': self.init_values.get('export_gzip', False),
+                                               'incremental': self.init_values.get('export_incremental', False),
+                                               'append': self.init_values.get('export_append', False)}
                             )
+        self.sprites = SpriteCache(self.root_path)
+        # counts of the active hunt, kept current by the encounters the engine publishes
+        self.model = HuntModel()
+        self.model.load(self.db_file_path, self.profiles_menu.active_hunt_var.get())
+        self.warm_sprites()
+        self.encounters_queue = queue.Queue()
+        self.clients_menu = None
         self.body = None # need this since create_body checks for body in order to recreate it
+        self.stats_window = None
         self.create_body()
-        self.bind('<<HuntSelected>>', lambda event: self.create_body())
+        self.bind('<<HuntSelected>>', lambda event: self.on_hunt_selected())
         self.bind('<<ColChange>>', lambda event: self.create_body())
         self.bind('<<SizeChange>>', lambda event: self.create_body())
         self.bind('<<ASChange>>', lambda event: self.create_body())
         cmd = self.register(lambda type: self.options_menu.export_menu.export_data(type, ids = [self.profiles_menu.active_hunt_var.get(), self.profiles_menu.active_profile_id]))
         self.tk.call('bind', self, '<<ExportData>>', cmd + ' %d')
+        self.bind('<<ShowStats>>', lambda event: self.show_stats())
+        self.bind('<<ClientsChange>>', lambda event: self.save_json())
         self.bind('<<Exit>>', lambda event: self.exit())
+        self.after(self.ENCOUNTERS_POLL_MS, self.apply_encounters)
 
     # wrappers to pass to root
     # so that root and main do the same thing at the same time
@@ -555,25 +1070,28 @@ class MainWindow(tk.Toplevel):
         y = self.winfo_y() + delta_y
         self.geometry(f'+{x}+{y}')
 
-    # make sure main is on top of desired hwnd
+    # make sure main is on top of desired hwnd, or of any of them when given a list
     def put_on_top_of_window(self, target_hwnd = None):
+        if win32gui is None:
+            return
         app_hwnd = win32gui.FindWindow(None, 'YAPEC')
         # need to check topmost like this
         # checking straight from .attributes behaves weirdly
         # seems that tkinter resets the topmost on check
         attr = iter(self.attributes())
         is_topmost = dict(zip(attr, attr))['-topmost']
-        if win32gui.GetForegroundWindow() in [target_hwnd, app_hwnd]:
+        targets = target_hwnd if isinstance(target_hwnd, (list, tuple)) else [target_hwnd]
+        if win32gui.GetForegroundWindow() in [*targets, app_hwnd]:
             if not is_topmost:
                 self.attributes('-topmost', True)
         else:
             if is_topmost:
                 self.attributes('-topmost', False)
 
-    def create_menu_bar(self, size, start_hunt, start_view, show_alpha_shiny):
+    def create_menu_bar(self, size, start_hunt, start_view, show_alpha_shiny, export_options = None):
         self.menu_bar = CustomMenu(self)
 
-        self.options_menu = OptionsMenu(self.menu_bar, size, start_view, show_alpha_shiny)
+        self.options_menu = OptionsMenu(self.menu_bar, size, start_view, show_alpha_shiny, export_options)
         self.menu_bar.add_cascade(label = 'Options', menu = self.options_menu)
 
         self.profiles_menu = ProfileMenu(self.menu_bar, start_hunt = start_hunt)
@@ -594,14 +1112,90 @@ class MainWindow(tk.Toplevel):
         self.body = new_body
         self.save_json()
 
+    # the layout stays the same for every hunt, only the values change
+    def on_hunt_selected(self):
+        self.model.load(self.db_file_path, self.profiles_menu.active_hunt_var.get())
+        self.body.update_values()
+        self.save_json()
+        self.warm_sprites()
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.refresh()
+
+    # one stats window at a time, it follows the active hunt
+    def show_stats(self):
+        if self.stats_window is not None and self.stats_window.winfo_exists():
+            self.stats_window.lift()
+            return
+        self.stats_window = StatsWindow(self, self.db_file_path, self.profiles_menu.active_hunt_var)
+
+    # load the sprites of the hunt's most seen monsters while the gui is idle, a few at a time
+    # so that they are ready when they show up on "Last"
+    def warm_sprites(self, ids = None):
+        if ids is None:
+            ids = list(self.model.top(self.sprites.max_entries))
+        if ids:
+            self.sprites.warm(ids[:self.SPRITES_WARM_CHUNK])
+            self.after_idle(self.warm_sprites, ids[self.SPRITES_WARM_CHUNK:])
+
+    # adds a menu to pick the hunt of every client, only needed when there is more than one
+    # names are the FrameSource.name of every client, hunts are remembered by name so they follow the game window
+    # and not the order windows were found in, which changes from one start to the next
+    def set_clients(self, names):
+        if len(names) < 2 or self.clients_menu is not None:
+            return
+        # two clients with the same name would share their hunt
+        names = [name if name and names[:i].count(name) == 0 else f'{name or "Client"} #{i + 1}' for i, name in enumerate(names)]
+        hunts = self.init_values.get('client_hunts')
+        # older versions saved the hunts by position, there is no telling which window they were for
+        if not isinstance(hunts, dict):
+            hunts = {}
+        self.clients_menu = ClientsMenu(self.menu_bar, names, hunts)
+        self.menu_bar.add_cascade(label = 'Clients', menu = self.clients_menu)
+        self.save_json()
+
+    # hunt the encounters of a client are saved to, called from the engine threads
+    def client_hunt(self, index):
+        if self.clients_menu is not None and index < len(self.clients_menu.hunt_vars):
+            hunt_id = self.clients_menu.hunt_vars[index].get()
+            if hunt_id:
+                return hunt_id
+        return self.profiles_menu.active_hunt_var.get()
+
+    # can be called from any thread, encounters are (encounter id, row) as saved in the db
+    def publish_encounters(self, encounters):
+        self.encounters_queue.put(encounters)
+
+    # runs on the tk thread, applies everything published since the last call and patches the body once
+    # so a burst of horde encounters is a single redraw
+    def apply_encounters(self):
+        changed = False
+        while True:
+            try:
+                encounters = self.encounters_queue.get_nowait()
+            except queue.Empty:
+                break
+            for encounter_id, row in encounters:
+                changed = self.model.apply(encounter_id, row) or changed
+        if changed:
+            with _redraw_time.time():
+                self.body.update_values()
+        self.after(self.ENCOUNTERS_POLL_MS, self.apply_encounters)
+
     # save last state of variables
+    # keys not handled by the gui (e.g. poll_min and poll_max) are kept as they are
     def save_json(self):
         self.init_values = {
+            **self.init_values,
             'size': self.options_menu.view_menu.size_menu.size_var.get(),
             'cols': [col.get() for col in self.options_menu.view_menu.col_menu.col_var],
             'as': self.options_menu.view_menu.show_alpha_shiny_var.get(),
-            'active_hunt_id': self.profiles_menu.active_hunt_var.get()
+            'active_hunt_id': self.profiles_menu.active_hunt_var.get(),
+            'export_gzip': self.options_menu.export_menu.compress_var.get(),
+            'export_incremental': self.options_menu.export_menu.incremental_var.get(),
+            'export_append': self.options_menu.export_menu.append_var.get()
         }
+        if self.clients_menu is not None:
+            self.init_values['client_hunts'] = self.clients_menu.hunts()
         max_retries = 3
         tries = 0
         while tries < max_retries:
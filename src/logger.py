@@ -0,0 +1,163 @@
+import os
+import glob
+import gzip
+import json
+import time
+import queue
+import shutil
+import argparse
+import threading
+
+import src.globals as gb
+
+# session log of the debug modes, one json object per line:
+#   {"time": 1700000000.0, "action": "battle check", "thread": "Thread-3", "data": ...}
+# log() only puts the record in a queue, a background thread turns records into json and writes them in batches
+# so logging never waits for the disk. data is kept as given until then, callers must not change it afterwards
+# the log is rotated once it reaches MAX_BYTES, rotated files are gzipped on the same thread:
+#   session.jsonl (current), session.1.jsonl.gz (newest rotated) ... session.{BACKUPS}.jsonl.gz (oldest)
+# read_records reads them all back in order, optionally only some actions:
+#   python -m src.logger DEBUG/<session> --action "battle check"
+
+LOG_NAME = 'session'
+
+
+class SessionLogger:
+
+    MAX_BYTES = 8*1024*1024
+    # rotated files kept, older ones are deleted
+    BACKUPS = 5
+    # seconds the thread waits for more records before writing what it has
+    FLUSH_INTERVAL = 0.5
+    # records written at once at most
+    MAX_BATCH = 512
+
+    def __init__(self, max_bytes = None, backups = None):
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.backups = self.BACKUPS if backups is None else backups
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.file = None
+        # folder of the open file, the session (and its debug folder) may change
+        self.path = None
+        self.written = 0
+        self.dropped = 0
+
+    def log(self, action, data = None, **fields):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target = self._run, daemon = True)
+                    self.thread.start()
+        self.queue.put({'time': time.time(), 'action': action, 'thread': threading.current_thread().name, 'data': data, **fields})
+
+    def _open(self):
+        path = gb.globals.get_debug_path()
+        if self.file is not None and path == self.path:
+            return
+        if self.file is not None:
+            self.file.close()
+        self.path = path
+        self.file = open(os.path.join(path, f'{LOG_NAME}.jsonl'), 'a', encoding = 'utf-8')
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        base = os.path.join(self.path, LOG_NAME)
+        if self.backups:
+            oldest = f'{base}.{self.backups}.jsonl.gz'
+            if os.path.exists(oldest):
+                os.remove(oldest)
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{base}.{i}.jsonl.gz'):
+                    os.replace(f'{base}.{i}.jsonl.gz', f'{base}.{i + 1}.jsonl.gz')
+            with open(f'{base}.jsonl', 'rb') as src, gzip.open(f'{base}.1.jsonl.gz.part', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(f'{base}.1.jsonl.gz.part', f'{base}.1.jsonl.gz')
+        os.remove(f'{base}.jsonl')
+        self._open()
+
+    def _write(self, records):
+        self._open()
+        lines = []
+        for record in records:
+            try:
+                lines.append(json.dumps(record, default = str))
+            except (TypeError, ValueError):
+                self.dropped += 1
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+        self.written += len(lines)
+        if self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            stop = record is None
+            records = [] if stop else [record]
+            # take whatever else is waiting, up to a batch
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while not stop and len(records) < self.MAX_BATCH:
+                try:
+                    record = self.queue.get(timeout = max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                else:
+                    records.append(record)
+            if records:
+                try:
+                    self._write(records)
+                except OSError:
+                    self.dropped += len(records)
+            if stop:
+                break
+
+    # writes everything logged so far and stops the thread, logging again starts it over
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# records of a session folder in the order they were written, rotated files included
+# actions is a name or a list of names to keep, None keeps everything
+def read_records(path = None, actions = None):
+    path = path or gb.globals.get_debug_path()
+    if isinstance(actions, str):
+        actions = [actions]
+    base = os.path.join(path, LOG_NAME)
+    rotated = sorted(glob.glob(f'{base}.*.jsonl.gz'), key = lambda file: int(file[len(base) + 1:].split('.')[0]), reverse = True)
+    files = rotated + ([f'{base}.jsonl'] if os.path.isfile(f'{base}.jsonl') else [])
+    for file in files:
+        opener = gzip.open if file.endswith('.gz') else open
+        with opener(file, 'rt', encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line cut by a kill
+                    continue
+                if actions is None or record.get('action') in actions:
+                    yield record
+
+
+# one logger for the session, shared by the engine and the db handlers
+logger = SessionLogger()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Print the records of a YAPEC session log.')
+    parser.add_argument('path', help = 'session folder, e.g. DEBUG/<session>')
+    parser.add_argument('--action', action = 'append', default = None, help = 'only records of this action, can be repeated')
+    args = parser.parse_args()
+    for record in read_records(args.path, args.action):
+        print(json.dumps(record))
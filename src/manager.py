@@ -2,93 +2,450 @@ import threading
 import queue
 import time
 import os
+import concurrent.futures as cf
 
 import src.core as core
+import src.ocr as ocr
+import src.writer as writer
+import src.recorder as recorder
+import src.logger as logger
+import src.metrics as metrics
 import src.globals as gb
 
-class TaskManager:
-    def __init__(self, pokemmo, app):
-        self.pokemmo = pokemmo
-        self.app = app
-        self.db_file = self.app.db_file_path
-        self.task_queue = queue.Queue()
-        self.threads = None
-
-    def _worker(self):
-        while True:
-            task = self.task_queue.get()
-            if task is None:
-                break
-            elif not isinstance(task, tuple) or len(task) == 0:
-                pass # wrong task type ignore
-            elif task[0] == 'battle':
-                self._process_battle()
-            elif len(task) >= 2: # we need the right amount of params
-                self._process_pokemon(task[0], task[1])
-            self.task_queue.task_done()
-
-    def _process_pokemon(self, battle_type, tries):
-        if tries < 3:
-            img = self.pokemmo.take_screenshot()
-            ocr_result = img.process_image(battle_type)
-            pokemon_found = ocr_result.extract_pokemon_from_battle()
-            if gb.globals.DEBUG_MODE:
-                if gb.globals.DEBUG_MODE >= 3:
-                    img.log_images()
-                self.log_action('ocr_result', ocr_result.result)
-                self.log_action('pokemon found', pokemon_found)
-            if pokemon_found:
-                hunt_id = self.app.profiles_menu.active_hunt_var.get()
-                pokemon_found = [pokemon_data + (hunt_id,) for pokemon_data in pokemon_found]
-                with core.DBHandler(self.db_file) as db:
-                    db.insert_data(pokemon_found)
-                # update GUI after insert
-                self.app.create_body()
-                time.sleep(1)
-                self.task_queue.put(('battle',))
+
+# ocr runs in worker processes to escape the gil
+# each worker keeps its own warm engine for its whole life (see src/ocr.py)
+def _ocr_worker_init():
+    ocr.get_engine()
+
+def _ocr_worker(img):
+    return ocr.get_engine().image_to_string(img)
+
+
+# decides how long to wait before the next capture depending on what is going on in the game
+# - game window minimized: nothing to read, wait max_interval
+# - game window not in the foreground: wait max_interval
+# - reading pokemon in a battle: base_interval, the same cadence as always
+# - right after a battle: min_interval for a while, the next encounter is likely to come soon
+# - screen not changing: back off exponentially from base_interval up to max_interval
+# - screen changing: back to base_interval
+class PollScheduler:
+
+    DEFAULT_MIN = 0.25
+    DEFAULT_BASE = 1
+    DEFAULT_MAX = 4
+    # multiplier applied to the interval on every idle frame
+    BACKOFF = 1.5
+    # seconds of fast polling once a battle is over, the next one often comes right after
+    FAST_WINDOW = 10
+
+    def __init__(self, min_interval = None, max_interval = None, base_interval = None):
+        if min_interval is None:
+            # a max below the default min only asks for faster captures
+            min_interval = self.DEFAULT_MIN if max_interval is None else min(self.DEFAULT_MIN, max_interval)
+        self.min_interval = min_interval
+        self.max_interval = max(self.DEFAULT_MAX, self.min_interval) if max_interval is None else max_interval
+        base_interval = self.DEFAULT_BASE if base_interval is None else base_interval
+        if self.min_interval > self.max_interval:
+            raise ValueError('min_interval must not be greater than max_interval.')
+        self.base_interval = min(max(base_interval, self.min_interval), self.max_interval)
+        self.idle_interval = self.base_interval
+        self.fast_until = 0
+        self.lock = threading.Lock()
+
+    # wait before the next capture
+    def next_interval(self, state, visible = True, foreground = True):
+        if not visible or not foreground:
+            return self.max_interval
+        if state[0] != 'battle':
+            return self.base_interval
+        with self.lock:
+            if time.monotonic() < self.fast_until:
+                return self.min_interval
+            return self.idle_interval
+
+    # called for every battle check, idle when the screen did not change
+    def on_frame(self, idle):
+        with self.lock:
+            if idle:
+                self.idle_interval = min(self.max_interval, self.idle_interval*self.BACKOFF)
             else:
-                time.sleep(1)
-                self.task_queue.put(('pokemon', tries + 1))
+                self.idle_interval = self.base_interval
+
+    # same settings, fresh state, every client backs off on its own
+    def copy(self):
+        return PollScheduler(self.min_interval, self.max_interval, self.base_interval)
+
+    # called once the battle is gone from the screen, not when its pokemon are read
+    def on_battle_end(self):
+        with self.lock:
+            self.fast_until = time.monotonic() + self.FAST_WINDOW
+            self.idle_interval = self.base_interval
+
+
+# one frame going through the pipeline
+class _Frame:
+    def __init__(self, img, state, version):
+        self.img = img
+        # state when the frame was captured: ('battle',) or (battle_type, tries)
+        self.state = state
+        self.version = version
+        self.captured = time.perf_counter()
+        # ocr future when ocr is needed, otherwise result is already final
+        self.future = None
+        self.result = None
+        # battle check skipped because the screen did not change
+        self.idle = False
+        # key of the image sent to ocr in the ocr cache
+        self.cache_key = None
+        # when the image was sent to the ocr pool
+        self.submitted = None
+
+
+_ocr_latency = metrics.histogram('yapec_ocr_seconds', 'time from sending an image to the ocr pool to its text')
+_ocr_cache_hits = metrics.counter('yapec_ocr_cache_hits_total', 'ocr skipped because the same image was read before')
+
+
+# the capture and detection loop of one game client
+# its stages are connected by bounded queues: capture -> preprocess -> ocr (shared pool) -> results
+# so the next frame is captured while the previous one is still being read
+# every stage runs on its own thread, a None item flowing through the queues shuts them down in order
+# frames captured before a state change (e.g. battle found) are dropped once they reach a stage
+# the battle state, detectors and scheduler belong to the client, the ocr pool and the db writer are shared
+class ClientPipeline:
+
+    # frames waiting for preprocessing, more than this blocks capture (backpressure)
+    QUEUE_SIZE = 2
+    # tries to read pokemon after a battle started
+    MAX_TRIES = 3
+
+    def __init__(self, manager, frame_source, index, scheduler = None):
+        self.manager = manager
+        self.frame_source = frame_source
+        # position of the client, the gui picks its hunt by it
+        self.index = index
+        self.scheduler = scheduler or PollScheduler()
+        # skips battle checks ocr while the battle text region stays the same
+        self.battle_gate = core.FrameChangeDetector()
+        # decides most battle checks without ocr
+        self.banner_detector = core.BattleBannerDetector()
+        # a battle whose pokemon were read is still on screen
+        self.battle_on_screen = False
+
+        self.state = ('battle',)
+        self.state_version = 0
+        self.state_lock = threading.Lock()
+
+        self.preprocess_queue = queue.Queue(maxsize = self.QUEUE_SIZE)
+        # bounded by the number of ocr workers so frames do not pile up in the pool
+        self.ocr_queue = queue.Queue(maxsize = max(1, self.manager.ocr_workers))
+        # end of the pipeline, only ever gets the final None
+        self.done_queue = queue.Queue()
+
+        # seconds from capture to result of every frame read, and from capture to saved of every encounter
+        labels = {'client': str(index)}
+        self.frame_latency = metrics.histogram('yapec_frame_latency_seconds', 'time from capture to ocr result of a frame', labels)
+        self.encounter_latency = metrics.histogram('yapec_encounter_latency_seconds', 'time from capture to saved of an encounter', labels)
+        self.frames = metrics.counter('yapec_frames_total', 'frames read', labels)
+        self.encounters = metrics.counter('yapec_encounters_total', 'encounters saved', labels)
+        self.battles = metrics.counter('yapec_battles_total', 'battles found', labels)
+        self.exhausted = metrics.counter('yapec_battle_tries_exhausted_total', 'battles where no pokemon was read after every try', labels)
+
+    def _set_state(self, state):
+        with self.state_lock:
+            self.state = state
+            self.state_version += 1
+
+    def _get_state(self):
+        with self.state_lock:
+            return self.state, self.state_version
+
+    def _is_stale(self, frame):
+        return frame.version != self.state_version
+
+    # stage 1: take screenshots at the rate the scheduler decides
+    def _capture(self):
+        stop_event = self.manager.stop_event
+        try:
+            while not stop_event.is_set():
+                state, version = self._get_state()
+                try:
+                    visible = self.frame_source.is_visible()
+                    foreground = self.frame_source.is_foreground()
+                    interval = self.scheduler.next_interval(state, visible, foreground)
+                    # a minimized window has nothing to read
+                    if not visible:
+                        stop_event.wait(interval)
+                        continue
+                    if state[0] == 'battle':
+                        self.manager.app.put_on_top_of_window(self.manager.hwnds())
+                    # only grab the region the next stage reads
+                    # unless whole screenshots are being saved, replays of debug sessions need them
+                    roi = None if gb.globals.DEBUG_MODE >= 3 else core.CV2ImageHandler.ocr_region(state[0])
+                    img = self.frame_source.grab(roi)
+                except Exception as e:
+                    self.manager._log_error(f'client {self.index} capture error', e)
+                    stop_event.wait(self.scheduler.max_interval)
+                    continue
+                # source ran out of frames (end of a replay)
+                if img is None:
+                    break
+                self.preprocess_queue.put(_Frame(img, state, version))
+                stop_event.wait(interval)
+        finally:
+            self.preprocess_queue.put(None)
+
+    # stage 2: crop and transform, skip ocr when the detectors allow it, otherwise send to the pool
+    def _preprocess(self):
+        self.manager._run_stage(f'client {self.index} preprocess', self.preprocess_queue, self._preprocess_frame, self.ocr_queue)
+
+    def _preprocess_frame(self, frame):
+        if self._is_stale(frame):
+            return
+        if frame.state[0] == 'battle':
+            skipped = self.battle_gate.skipped
+            img_ocr, frame.result = frame.img.prepare_for_ocr('battle', self.battle_gate, self.banner_detector)
+            frame.idle = self.battle_gate.skipped != skipped
         else:
-            self.task_queue.put(('battle',))
-                
-
-    def _process_battle(self):
-        tries = 0
-        self.app.put_on_top_of_window(self.pokemmo.hwnd)
-        img = self.pokemmo.take_screenshot()
-        ocr_result = img.process_image('battle')
-        battle_started = ocr_result.battle_started()
-        battle_type = ocr_result.battle_type()
+            img_ocr, frame.result = frame.img.prepare_for_ocr(frame.state[0])
+        ocr_cache = self.manager.ocr_cache
+        if img_ocr is not None and ocr_cache is not None:
+            frame.cache_key = ocr_cache.key(img_ocr.img)
+            text = ocr_cache.get(frame.cache_key)
+            if text is not None:
+                frame.result = core.OCRResultHandler(text)
+                img_ocr = None
+                _ocr_cache_hits.inc()
+        if img_ocr is not None:
+            frame.submitted = time.perf_counter()
+            frame.future = self.manager._submit(img_ocr.img)
+        self.ocr_queue.put(frame)
+
+    # stage 3: collect ocr results in capture order and move the state machine
+    def _results(self):
+        self.manager._run_stage(f'client {self.index} results', self.ocr_queue, self._handle_result, self.done_queue)
+
+    def _handle_result(self, frame):
+        if frame.future is not None:
+            try:
+                text = frame.future.result()
+                _ocr_latency.observe(time.perf_counter() - frame.submitted)
+            except Exception as e:
+                self.manager._log_error(f'client {self.index} ocr error', e)
+                text = ''
+            else:
+                if self.manager.ocr_cache is not None:
+                    self.manager.ocr_cache.put(frame.cache_key, text)
+            frame.result = core.OCRResultHandler(text)
+        self.frames.inc()
+        self.frame_latency.observe(time.perf_counter() - frame.captured)
+        # the debug modes keep the last frames in memory, only saved when something goes wrong (see src/recorder.py)
+        if gb.globals.DEBUG_MODE >= 3:
+            recorder.recorder.record(frame.img, {'client': self.index, 'state': frame.state,
+                                                 'ocr': frame.result.result if frame.result is not None else None})
+        if self._is_stale(frame):
+            return
+        if frame.state[0] == 'battle':
+            self._process_battle(frame)
+        else:
+            self._process_pokemon(frame)
+
+    def _process_battle(self, frame):
+        self.scheduler.on_frame(frame.idle)
+        # the battle text box is gone, the battle whose pokemon were read is over
+        if self.battle_on_screen and hasattr(frame.img, 'img_ocr') and self.banner_detector.is_blank(frame.img.img_ocr.img):
+            self.battle_on_screen = False
+            self.scheduler.on_battle_end()
+        # nothing changed on screen since last check or surely no battle banner
+        if frame.result is None:
+            return
+        battle_started = frame.result.battle_started()
+        battle_type = frame.result.battle_type()
         if gb.globals.DEBUG_MODE in [2, 4]: # if full log/debug
-            self.log_action('battle check', (battle_started, battle_type))
+            self.manager.log_action('battle check', (self.index, battle_started, battle_type, self.battle_gate.stats()))
         if battle_started:
-            time.sleep(1)
-            self.task_queue.put((battle_type, 0))
+            # use battles confirmed by ocr to teach the detector how the banner looks
+            if not isinstance(frame.result, core.BannerResult):
+                self.banner_detector.learn(frame.img.img_ocr.img)
+            self.battles.inc()
+            self._set_state((battle_type, 0))
+
+    def _process_pokemon(self, frame):
+        battle_type, tries = frame.state
+        pokemon_found = frame.result.extract_pokemon_from_battle()
+        if gb.globals.DEBUG_MODE:
+            self.manager.log_action('ocr_result', (self.index, frame.result.result))
+            self.manager.log_action('pokemon found', (self.index, pokemon_found))
+            # levels were read but no name matched
+            if gb.globals.DEBUG_MODE >= 3 and not pokemon_found and 'lv' in frame.result.result.lower():
+                recorder.recorder.dump('extraction failed')
+        if pokemon_found:
+            hunt_id = self.manager.app.client_hunt(self.index)
+            self.manager.writer.put([pokemon_data + (hunt_id,) for pokemon_data in pokemon_found], frame.captured, self.index)
+            self._end_battle()
+        elif tries + 1 < self.MAX_TRIES:
+            self._set_state((battle_type, tries + 1))
         else:
-            time.sleep(1)
-            self.task_queue.put(('battle',))
+            self.exhausted.inc()
+            if gb.globals.DEBUG_MODE >= 3:
+                recorder.recorder.dump('retries exhausted')
+            self._end_battle()
+
+    # pokemon read (or given up on), back to looking for the next battle
+    # the battle is still on screen though, fast polling only starts once it is over (see _process_battle)
+    def _end_battle(self):
+        self.battle_gate.reset()
+        self.battle_on_screen = True
+        self._set_state(('battle',))
 
     def start(self):
-        self.thread = threading.Thread(target=self._worker)
-        self.thread.start()
-        self.task_queue.put(('battle',))
+        self._set_state(('battle',))
+        # named so profiles and logs tell the clients apart (see src/profiler.py)
+        threads = [threading.Thread(target = target, name = f'client {self.index + 1} {target.__name__.strip("_")}', daemon = True)
+                   for target in [self._capture, self._preprocess, self._results]]
+        for thread in threads:
+            thread.start()
+        return threads
 
-    def stop(self):
-        self.task_queue.put(None)
-        self.thread.join()
+    def stats(self):
+        stats = {'client': self.index, 'frames': self.frames.value, 'encounters': self.encounters.value,
+                 'battles': self.battles.value, 'tries exhausted': self.exhausted.value, 'battle gate': self.battle_gate.stats()}
+        for name, histogram in [('frame', self.frame_latency), ('encounter', self.encounter_latency)]:
+            if histogram.count:
+                stats[f'{name} p50'] = round(histogram.percentile(0.5), 3)
+                stats[f'{name} p95'] = round(histogram.percentile(0.95), 3)
+        return stats
 
-    def log_action(self, action, data):
-        log_file_path = os.path.join(gb.globals.get_debug_path(), '0_0_session.log')
 
-        # Prepare the log entry
-        log_entry = (
-            f"{time.strftime('%Y%m%d_%H%M%S', time.localtime())} - ACTION: {action}\n"
-            f"DATA: {str(data)}\n"
-            "------------------------------------\n"
-        )
+# runs one ClientPipeline per game client, all of them sharing the ocr process pool and the db writer
+# the pool is sized to the cpu, so clients read in parallel until every core is busy
+# every client saves its encounters to the hunt the gui picked for it (see MainWindow.client_hunt)
+class TaskManager:
 
-        # Write the log entry to the file
-        with open(log_file_path, 'a') as log_file:
-            log_file.write(log_entry)
+    # frame_sources is a list of src.capture.FrameSource (or a single one), live windows or replays
+    # scheduler is a PollScheduler deciding the wait between captures, every client gets a copy of it
+    # ocr_workers is the number of ocr processes, 0 reads on a thread of this process instead
+    # ocr_cache is an optional ocr.OCRCache, loaded on start and saved on stop
+    def __init__(self, frame_sources, app, scheduler = None, ocr_workers = None, ocr_cache = None):
+        if not isinstance(frame_sources, (list, tuple)):
+            frame_sources = [frame_sources]
+        self.ocr_cache = ocr_cache
+        self.scheduler = scheduler or PollScheduler()
+        self.ocr_workers = ocr_workers if ocr_workers is not None else max(1, (os.cpu_count() or 2) - 1)
+        self.app = app
+        self.db_file = self.app.db_file_path
+        self.stop_event = threading.Event()
+        self.clients = [ClientPipeline(self, frame_source, i, self.scheduler.copy())
+                        for i, frame_source in enumerate(frame_sources)]
 
+        self.writer = writer.EncounterWriter(self.db_file, on_commit = self._saved, log = self._log_error)
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.threads = []
+        self.writer_thread = None
+        # snapshots of the metrics in the debug folder (see src/metrics.py)
+        self.exporter = metrics.Exporter()
+
+    def _create_pool(self):
+        if self.ocr_workers:
+            return cf.ProcessPoolExecutor(max_workers = self.ocr_workers, initializer = _ocr_worker_init)
+        return cf.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'ocr')
+
+    # sends an image to the shared pool
+    def _submit(self, img):
+        pool = self.pool
+        try:
+            return pool.submit(_ocr_worker, img)
+        except cf.BrokenExecutor:
+            # a worker died, start a new pool and try again once (only the first client to notice replaces it)
+            with self.pool_lock:
+                if self.pool is pool:
+                    self.pool = self._create_pool()
+                pool = self.pool
+            return pool.submit(_ocr_worker, img)
+
+    # windows of every client, the gui stays on top of any of them
+    def hwnds(self):
+        return [client.frame_source.hwnd for client in self.clients if client.frame_source.hwnd is not None]
+
+    # runs a stage: takes items from in_queue, handles them and always forwards the final None
+    # so that an error on one frame never leaves the next stages waiting forever
+    def _run_stage(self, name, in_queue, handle, out_queue):
+        try:
+            while True:
+                item = in_queue.get()
+                if item is None:
+                    break
+                try:
+                    handle(item)
+                except Exception as e:
+                    self._log_error(f'{name} error', e)
+        finally:
+            out_queue.put(None)
+
+    # db writer, called from its thread after every group commit (see src/writer.py)
+    # rows saved together get consecutive ids ending at last_row_id
+    def _saved(self, records, last_row_id):
+        now = time.perf_counter()
+        for record in records:
+            if record.captured is not None and record.tag is not None:
+                client = self.clients[record.tag]
+                client.encounters.inc(len(record.rows))
+                client.encounter_latency.observe(now - record.captured)
+                if gb.globals.DEBUG_MODE in [2, 4]:
+                    self.log_action('encounter latency', f'client {record.tag}: {now - record.captured:.3f}s')
+        # let the gui know what changed, only when something was saved (debug modes do not save)
+        if last_row_id is not None:
+            rows = [row for record in records for row in record.rows]
+            first_id = last_row_id - len(rows) + 1
+            self.app.publish_encounters([(first_id + i, row) for i, row in enumerate(rows)])
+
+    def start(self):
+        self.stop_event.clear()
+        if self.ocr_cache is not None:
+            self.ocr_cache.load()
+        self.pool = self._create_pool()
+        # saves what the last session left in the journal first
+        self.writer.open()
+        self.writer_thread = threading.Thread(target = self.writer.run, name = 'writer', daemon = True)
+        self.writer_thread.start()
+        self.threads = [thread for client in self.clients for thread in client.start()]
+        self.exporter.start()
+
+    # stop capturing, let every frame already captured go through and wait for all clients
+    # then the writer saves what is waiting and syncs the db before its thread ends
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.writer_thread is not None:
+            self.writer.queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        if self.pool is not None:
+            self.pool.shutdown(wait = True, cancel_futures = True)
+            self.pool = None
+        if self.ocr_cache is not None:
+            self.ocr_cache.save()
+        # frames already asked to be saved are written before leaving
+        recorder.recorder.close()
+        self.exporter.stop()
+        if gb.globals.DEBUG_MODE:
+            for stats in self.stats():
+                self.log_action('client stats', stats)
+            self.log_action('writer stats', self.writer.stats())
+            if self.ocr_cache is not None:
+                self.log_action('ocr cache stats', self.ocr_cache.stats())
+
+    def stats(self):
+        return [client.stats() for client in self.clients]
+
+    # errors on one frame should not stop the engine, only keep track of them when logging
+    def _log_error(self, action, error):
+        if gb.globals.DEBUG_MODE:
+            self.log_action(action, repr(error))
+
+    # only queued, written by the session logger thread (see src/logger.py)
+    def log_action(self, action, data):
+        logger.logger.log(action, data)
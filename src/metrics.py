@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import bisect
+import threading
+import functools
+
+import src.globals as gb
+
+# counters and histograms of the hot paths (capture, preprocessing, ocr, db, gui), always on
+# recording a value is a bisect and a few additions under an uncontended lock, about a microsecond
+# histograms have fixed buckets, so memory does not grow and percentiles are estimated from the buckets
+# an Exporter writes snapshots to the debug folder every INTERVAL seconds:
+#   metrics.prom in the prometheus text format (e.g. for the node exporter textfile collector)
+#   metrics.json with the same values plus p50/p95/p99, for people and scripts
+
+# bucket upper bounds for durations, 100us to ~13s doubling every time
+SECONDS_BUCKETS = [0.0001*2**i for i in range(18)]
+# bucket upper bounds for sizes (e.g. rows in a commit)
+SIZE_BUCKETS = [2**i for i in range(13)]
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Counter:
+    def __init__(self, name, help = '', labels = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, value = 1):
+        with self.lock:
+            self.value += value
+
+    def snapshot(self):
+        return {'type': 'counter', 'labels': self.labels, 'value': self.value}
+
+    def prometheus(self):
+        return [f'{self.name}{_labels_text(self.labels)} {self.value}']
+
+
+class Histogram:
+    def __init__(self, name, help = '', labels = None, buckets = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = list(buckets or SECONDS_BUCKETS)
+        # one more for values above the last bound
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    # times a block: with histogram.time(): ...
+    def time(self):
+        return _Timer(self)
+
+    # value below which a fraction q of the observations are, interpolated inside its bucket
+    # the interpolation never leaves [min, max], nothing outside of them was seen
+    def percentile(self, q, counts = None, count = None, minimum = None, maximum = None):
+        if counts is None:
+            with self.lock:
+                counts, count, minimum, maximum = list(self.counts), self.count, self.min, self.max
+        if not count:
+            return None
+        rank = q*count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                low = max(self.buckets[i - 1] if i > 0 else 0., minimum)
+                high = min(self.buckets[i], maximum) if i < len(self.buckets) else maximum
+                return low + (high - low)*(rank - seen)/bucket_count
+            seen += bucket_count
+        return maximum
+
+    def snapshot(self):
+        with self.lock:
+            counts, count, total, minimum, maximum = list(self.counts), self.count, self.sum, self.min, self.max
+        return {'type': 'histogram', 'labels': self.labels, 'count': count, 'sum': total, 'min': minimum, 'max': maximum,
+                'mean': total/count if count else None,
+                'p50': self.percentile(0.5, counts, count, minimum, maximum),
+                'p95': self.percentile(0.95, counts, count, minimum, maximum),
+                'p99': self.percentile(0.99, counts, count, minimum, maximum)}
+
+    def prometheus(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+            cumulative += bucket_count
+            labels = {**self.labels, 'le': bound if isinstance(bound, str) else f'{bound:g}'}
+            lines.append(f'{self.name}_bucket{_labels_text(labels)} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels_text(self.labels)} {total}')
+        lines.append(f'{self.name}_count{_labels_text(self.labels)} {count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ['histogram', 'start']
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+# every metric of the process by (name, labels)
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(name, help, labels, **kwargs)
+        return metric
+
+    def counter(self, name, help = '', labels = None):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help = '', labels = None, buckets = None):
+        return self._get(Histogram, name, help, labels, buckets = buckets)
+
+    def _sorted(self):
+        with self.lock:
+            return sorted(self.metrics.values(), key = lambda metric: (metric.name, sorted(metric.labels.items())))
+
+    def snapshot(self):
+        return {'time': time.time(), 'metrics': {metric.name + _labels_text(metric.labels): metric.snapshot()
+                                                 for metric in self._sorted()}}
+
+    def prometheus(self):
+        lines = []
+        described = set()
+        for metric in self._sorted():
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {"counter" if isinstance(metric, Counter) else "histogram"}')
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    # both files are replaced at once, readers never see half of them
+    def write(self, path = None):
+        path = path or gb.globals.get_debug_path()
+        for name, text in [('metrics.prom', self.prometheus()), ('metrics.json', json.dumps(self.snapshot(), indent = 1))]:
+            file_path = os.path.join(path, name)
+            with open(file_path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(file_path + '.tmp', file_path)
+
+
+registry = Registry()
+
+# shortcuts to the session registry
+def counter(name, help = '', labels = None):
+    return registry.counter(name, help, labels)
+
+def histogram(name, help = '', labels = None, buckets = None):
+    return registry.histogram(name, help, labels, buckets)
+
+
+# decorator timing every call of a function into a histogram
+def timed(name, help = ''):
+    def decorator(function):
+        metric = histogram(name, help)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# writes the registry to the debug folder every interval seconds, and once more when stopped
+class Exporter:
+
+    INTERVAL = 15
+
+    def __init__(self, interval = None, registry = registry):
+        self.interval = interval or self.INTERVAL
+        self.registry = registry
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._write()
+        self._write()
+
+    def _write(self):
+        try:
+            self.registry.write()
+        except OSError:
+            pass
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target = self._run, daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
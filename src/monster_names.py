@@ -1,16 +1,87 @@
 import json
 
 
+# edit distance between two strings (insertions, deletions and substitutions)
+def levenshtein(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+# every string obtained by deleting up to max_deletes chars from word
+def _deletes(word, max_deletes):
+    found = {word}
+    current = {word}
+    for _ in range(max_deletes):
+        current = {w[:i] + w[i + 1:] for w in current for i in range(len(w))}
+        found |= current
+    return found
+
+
+# fuzzy index over edit distance using symmetric deletes
+# two words within k edits always share a string reachable from both with up to k deletions,
+# so all deletion variants of the known words are precomputed once and a lookup only has to
+# generate the deletions of the query and check the few words they lead to
+class FuzzyIndex:
+    def __init__(self, words = None, max_distance = 2):
+        self.max_distance = max_distance
+        self.deletes = {}
+        for word in words or []:
+            self.add(word)
+
+    def add(self, word):
+        for variant in _deletes(word, self.max_distance):
+            self.deletes.setdefault(variant, set()).add(word)
+
+    # all words within max_distance of word as (distance, word), closest first
+    def search(self, word, max_distance):
+        max_distance = min(max_distance, self.max_distance)
+        candidates = set()
+        for variant in _deletes(word, max_distance):
+            candidates |= self.deletes.get(variant, set())
+        found = []
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) <= max_distance:
+                distance = levenshtein(word, candidate)
+                if distance <= max_distance:
+                    found.append((distance, candidate))
+        return sorted(found)
+
+
 class MonsterNames:
+
+    # a misread is accepted as a name if it has at most one edit every CHARS_PER_EDIT chars
+    # similar to the 0.8 ratio used with difflib before
+    CHARS_PER_EDIT = 5
+
     def __init__(self, data):
         if not isinstance(data, dict):
             raise TypeError('data must be of type dict')
         self.MONSTER_NAMES_DICT = data
         self.INV_MONSTER_NAMES_DICT = {v: k for k, v in self.MONSTER_NAMES_DICT.items()}
+        # built once, names never change during a session
+        self.name_index = FuzzyIndex(self.INV_MONSTER_NAMES_DICT)
 
     @classmethod
     def from_json(cls, file_path):
         """Initialize the instance from a JSON file."""
         with open(file_path, "r") as json_file:
             data = json.load(json_file)
-        return cls(data)
\ No newline at end of file
+        return cls(data)
+
+    # closest known name to a (possibly misread) name, None if none is close enough
+    def closest_name(self, name, max_distance = None):
+        if name in self.INV_MONSTER_NAMES_DICT:
+            return name
+        if max_distance is None:
+            max_distance = len(name)//self.CHARS_PER_EDIT
+        if max_distance <= 0:
+            return None
+        matches = self.name_index.search(name, max_distance)
+        return matches[0][1] if matches else None
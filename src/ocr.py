@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import subprocess
+import collections
+import cv2
+import pytesseract
+
+# tesserocr is optional, it binds directly to the tesseract C API
+# so the language model is loaded only once per session
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+# base class for ocr engines
+# an engine is created once per session and reused for every ocr call
+class OCREngine:
+
+    # same defaults pytesseract uses when calling the tesseract cli
+    DEFAULT_LANG = 'eng'
+    DEFAULT_PSM = 3
+
+    def __init__(self, lang = None, psm = None):
+        self.lang = lang or self.DEFAULT_LANG
+        self.psm = psm if psm is not None else self.DEFAULT_PSM
+        # engines are shared between threads, tesseract itself is not thread safe
+        self.lock = threading.Lock()
+
+    def image_to_string(self, img):
+        raise NotImplementedError('image_to_string should be implemented on child classes.')
+
+    # get every word read along with its bounding box as (text, (left, top, width, height))
+    def image_to_words(self, img):
+        raise NotImplementedError('image_to_words should be implemented on child classes.')
+
+    def close(self):
+        pass
+
+
+# engine that keeps a single tesseract api instance alive
+# images are handed over in memory, no temp files and no new processes
+class TesserocrEngine(OCREngine):
+    def __init__(self, lang = None, psm = None):
+        super().__init__(lang, psm)
+        kwargs = {'lang': self.lang, 'psm': tesserocr.PSM(self.psm)}
+        # respect the same env variable the tesseract cli uses to find its models
+        if os.environ.get('TESSDATA_PREFIX'):
+            kwargs['path'] = os.environ['TESSDATA_PREFIX']
+        self.api = tesserocr.PyTessBaseAPI(**kwargs)
+
+    # should be called while holding the lock
+    def _set_image(self, img):
+        # tesseract expects rgb, opencv gives us bgr
+        if img.ndim == 2:
+            rgb = img
+        else:
+            rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        rgb = rgb if rgb.flags['C_CONTIGUOUS'] else rgb.copy()
+        h, w = rgb.shape[:2]
+        bpp = 1 if rgb.ndim == 2 else rgb.shape[2]
+        self.api.SetImageBytes(rgb.tobytes(), w, h, bpp, w*bpp)
+
+    def image_to_string(self, img):
+        with self.lock:
+            self._set_image(img)
+            return self.api.GetUTF8Text()
+
+    def image_to_words(self, img):
+        level = tesserocr.RIL.WORD
+        words = []
+        with self.lock:
+            self._set_image(img)
+            self.api.Recognize()
+            for word in tesserocr.iterate_level(self.api.GetIterator(), level):
+                text = word.GetUTF8Text(level)
+                box = word.BoundingBox(level)
+                if text and box:
+                    words.append((text, (box[0], box[1], box[2] - box[0], box[3] - box[1])))
+        return words
+
+    def close(self):
+        with self.lock:
+            self.api.End()
+
+
+# fallback engine when tesserocr is not installed
+# still spawns tesseract for every call (the cli has no persistent mode)
+# but pipes the image through stdin/stdout instead of pytesseract's temp files
+class TesseractPipeEngine(OCREngine):
+    def __init__(self, lang = None, psm = None, cmd = None):
+        super().__init__(lang, psm)
+        # reuse whatever path the user configured for pytesseract
+        self.cmd = cmd or pytesseract.pytesseract.tesseract_cmd
+        self.args = [self.cmd, 'stdin', 'stdout', '-l', self.lang, '--psm', str(self.psm)]
+        # do not flash a console window for every call on windows
+        self.creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+
+    def _run(self, img, extra_args = None):
+        # png is lossless and cheap to encode for the small crops we ocr
+        success, buffer = cv2.imencode('.png', img)
+        if not success:
+            raise ValueError('Failed to encode image for OCR.')
+        result = subprocess.run(self.args + (extra_args or []),
+                                input = buffer.tobytes(),
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE,
+                                creationflags = self.creationflags)
+        if result.returncode != 0:
+            raise RuntimeError(f'Tesseract failed: {result.stderr.decode(errors = "ignore").strip()}')
+        return result.stdout.decode('utf-8', errors = 'ignore')
+
+    def image_to_string(self, img):
+        return self._run(img)
+
+    def image_to_words(self, img):
+        # tsv columns: level page block par line word left top width height conf text
+        words = []
+        for line in self._run(img, ['tsv']).splitlines()[1:]:
+            cols = line.split('\t')
+            if len(cols) == 12 and cols[0] == '5' and cols[11].strip():
+                words.append((cols[11], tuple(int(c) for c in cols[6:10])))
+        return words
+
+
+# settings that change what tesseract reads from the same image
+# cached results are only valid for the settings they were read with
+def settings_fingerprint(lang = None, psm = None):
+    return json.dumps({
+        'engine': 'tesserocr' if tesserocr is not None else 'tesseract',
+        'lang': lang or OCREngine.DEFAULT_LANG,
+        'psm': psm if psm is not None else OCREngine.DEFAULT_PSM
+    }, sort_keys = True)
+
+
+# lru cache of ocr results keyed by a hash of the image given to tesseract
+# bounded both by number of entries and by bytes, and can be saved between sessions
+class OCRCache:
+
+    MAX_ENTRIES = 2048
+    MAX_BYTES = 4*1024*1024
+    # rough python overhead per entry
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, file_path = None, max_entries = None, max_bytes = None, fingerprint = None):
+        self.file_path = file_path
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.fingerprint = fingerprint or settings_fingerprint()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(img):
+        digest = hashlib.blake2b(digest_size = 16)
+        digest.update(str(img.shape).encode())
+        digest.update(img.tobytes() if img.flags['C_CONTIGUOUS'] else img.copy().tobytes())
+        return digest.hexdigest()
+
+    def _entry_size(self, key, text):
+        return len(key) + len(text.encode('utf-8')) + self.ENTRY_OVERHEAD
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._entry_size(key, self.entries.pop(key))
+            self.entries[key] = text
+            self.size += self._entry_size(key, text)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                old_key, old_text = self.entries.popitem(last = False)
+                self.size -= self._entry_size(old_key, old_text)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits/lookups if lookups else 0.}
+
+    def load(self):
+        if not self.file_path or not os.path.isfile(self.file_path):
+            return 0
+        try:
+            with open(self.file_path, 'r') as f:
+                data = json.load(f)
+        except Exception:
+            return 0
+        # results read with other settings are not valid anymore
+        if data.get('fingerprint') != self.fingerprint:
+            return 0
+        for key, text in data.get('entries', []):
+            self.put(key, text)
+        return 1
+
+    def save(self):
+        if not self.file_path:
+            return 0
+        with self.lock:
+            data = {'fingerprint': self.fingerprint, 'entries': list(self.entries.items())}
+        # write to a temp file first so a crash never leaves a broken cache behind
+        temp_path = self.file_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.file_path)
+        except Exception:
+            return 0
+        return 1
+
+
+# session wide engine, created on first use
+class _EngineHolder:
+    def __init__(self):
+        self.engine = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.engine is None:
+            with self.lock:
+                if self.engine is None:
+                    self.engine = create_engine()
+        return self.engine
+
+    def close(self):
+        with self.lock:
+            if self.engine is not None:
+                self.engine.close()
+                self.engine = None
+
+_holder = _EngineHolder()
+
+# pick the fastest engine available
+def create_engine(lang = None, psm = None):
+    if tesserocr is not None:
+        try:
+            return TesserocrEngine(lang, psm)
+        except Exception:
+            # usually missing tessdata, the cli may still be properly configured
+            pass
+    return TesseractPipeEngine(lang, psm)
+
+def get_engine():
+    return _holder.get()
+
+def close_engine():
+    _holder.close()
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import threading
+import tracemalloc
+import collections
+
+import src.globals as gb
+
+# profiling of a running session, started and stopped from the debug menu
+# - a thread samples the stacks of every other thread (gui, capture, preprocess, results, writer...) every INTERVAL
+#   seconds with sys._current_frames, the threads being profiled are not slowed down besides the gil the sampler takes
+# - tracemalloc traces allocations in the meantime, its snapshots at start and stop show where memory grew
+# results go to the debug folder once the duration is over or the profile is stopped:
+#   profile_{n}/stacks.folded   one "thread;outer;...;inner count" line per stack, for flamegraph.pl or speedscope
+#   profile_{n}/top.txt         functions taking the most samples in every thread, by self and total samples
+#   profile_{n}/memory.txt      lines whose memory grew the most while profiling
+# ocr processes (see TaskManager.ocr_workers) are other processes and are not sampled
+
+
+class SamplingProfiler:
+
+    # seconds between samples, a sample takes well under a millisecond
+    INTERVAL = 0.01
+    # frames kept of every stack, the innermost ones
+    MAX_DEPTH = 64
+    # frames traced by tracemalloc for every allocation, more is slower
+    TRACE_FRAMES = 5
+    # lines in the reports
+    TOP = 30
+
+    def __init__(self, interval = None):
+        self.interval = interval or self.INTERVAL
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.profiles = 0
+        self.path = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # profiles for duration seconds, or until stop() when None
+    # returns the folder the results will be saved to, None when a profile is already running
+    def start(self, duration = None, memory = True):
+        with self.lock:
+            if self.running():
+                return None
+            self.profiles += 1
+            self.path = os.path.join(gb.globals.get_debug_path(), f'profile_{self.profiles}')
+            self.stop_event.clear()
+            self.thread = threading.Thread(target = self._run, args = (self.path, duration, memory), name = 'profiler', daemon = True)
+            self.thread.start()
+            return self.path
+
+    # asks the running profile to end, its results are saved on the profiler thread (see running())
+    # wait joins the thread, the gui must not wait: saving the reports of a long profile takes seconds
+    def stop(self, wait = False):
+        with self.lock:
+            thread = self.thread
+        if thread is None:
+            return None
+        self.stop_event.set()
+        if wait:
+            thread.join()
+        return self.path
+
+    @staticmethod
+    def _frame_name(code):
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def _sample(self, stacks, names, own_id):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            codes = []
+            while frame is not None and len(codes) < self.MAX_DEPTH:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            # outermost first
+            stacks[(thread_id, tuple(reversed(codes)))] += 1
+        # threads started while profiling
+        if len(names) != threading.active_count():
+            names.update({thread.ident: thread.name for thread in threading.enumerate()})
+
+    def _run(self, path, duration, memory):
+        own_id = threading.get_ident()
+        stacks = collections.Counter()
+        names = {}
+        # tracemalloc may already be on (e.g. PYTHONTRACEMALLOC), it is only stopped if started here
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(self.TRACE_FRAMES)
+        before = tracemalloc.take_snapshot() if memory else None
+        start = time.perf_counter()
+        deadline = start + duration if duration else None
+        samples = 0
+        while not self.stop_event.is_set():
+            self._sample(stacks, names, own_id)
+            samples += 1
+            next_sample = start + samples*self.interval
+            if deadline is not None and next_sample >= deadline:
+                break
+            # on time even when sampling was slow, late samples are skipped instead of bunched up
+            self.stop_event.wait(max(0, next_sample - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        after = tracemalloc.take_snapshot() if memory else None
+        traced = tracemalloc.get_traced_memory() if memory else None
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            os.makedirs(path, exist_ok = True)
+            self._save_stacks(path, stacks, names)
+            self._save_top(path, stacks, names, samples, elapsed)
+            if memory:
+                self._save_memory(path, before, after, traced)
+        except OSError:
+            pass
+
+    def _thread_name(self, names, thread_id):
+        return names.get(thread_id, str(thread_id)).replace(';', ',')
+
+    def _save_stacks(self, path, stacks, names):
+        with open(os.path.join(path, 'stacks.folded'), 'w') as f:
+            for (thread_id, codes), count in stacks.most_common():
+                frames = [self._thread_name(names, thread_id)] + [self._frame_name(code).replace(';', ',') for code in codes]
+                f.write(f'{";".join(frames)} {count}\n')
+
+    def _save_top(self, path, stacks, names, samples, elapsed):
+        per_thread = collections.defaultdict(lambda: (collections.Counter(), collections.Counter()))
+        for (thread_id, codes), count in stacks.items():
+            own, total = per_thread[thread_id]
+            if codes:
+                own[codes[-1]] += count
+            # recursive functions count once per sample
+            for code in set(codes):
+                total[code] += count
+        lines = [f'{samples} samples in {elapsed:.1f}s, one every {self.interval*1000:g}ms', '']
+        for thread_id, (own, total) in sorted(per_thread.items(), key = lambda item: names.get(item[0], '')):
+            lines.append(f'thread {names.get(thread_id, thread_id)}')
+            for title, counter in [('self', own), ('total', total)]:
+                lines.append(f'  {title:>8}')
+                for code, count in counter.most_common(self.TOP):
+                    lines.append(f'  {count/samples:7.1%}  {self._frame_name(code)}')
+            lines.append('')
+        with open(os.path.join(path, 'top.txt'), 'w') as f:
+            f.write('\n'.join(lines))
+
+    def _save_memory(self, path, before, after, traced):
+        # the profiler's own allocations are left out
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        before = before.filter_traces(filters)
+        after = after.filter_traces(filters)
+        current, peak = traced
+        lines = [f'traced {current/2**20:.1f} MB at the end, {peak/2**20:.1f} MB at most', '', 'grown while profiling']
+        lines.extend(f'  {stat}' for stat in after.compare_to(before, 'lineno')[:self.TOP])
+        with open(os.path.join(path, 'memory.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+# one profiler for the session, driven by the debug menu
+profiler = SamplingProfiler()
@@ -0,0 +1,166 @@
+import os
+import cv2
+import json
+import mmap
+import time
+import queue
+import threading
+import collections
+import numpy as np
+
+import src.globals as gb
+import src.logger as logger
+
+# flight recorder for the debug modes that log images (3 and 4)
+# every frame read is copied raw into a ring buffer in memory (an anonymous mmap of BUDGET bytes), oldest frames
+# are overwritten by new ones, so recording costs a memory copy per frame and never touches the disk
+# frames are only saved when something worth looking at happens (see dump), then a background thread encodes
+# the frames recorded before it as png, in the same {n}_1_ss.png layout replays read (see capture.list_frames)
+# along with an incident.json that has the state and ocr text of every frame
+
+
+# one frame in the ring, parts are (name, offset, shape, dtype) of every image copied into it
+_Entry = collections.namedtuple('_Entry', ['seq', 'start', 'end', 'parts', 'meta'])
+
+
+class FlightRecorder:
+
+    # bytes of memory kept for frames
+    BUDGET = 256*1024*1024
+    # frames saved by a dump, the last ones recorded
+    DUMP_FRAMES = 10
+    # png compression level, low since frames are big and only read by people
+    PNG_COMPRESSION = 1
+    # images of a frame and their file names, saved as {seq}_{name}.png, the layout replays read (see capture.list_frames)
+    PARTS = [('img', '1_ss'), ('img_crop', '2_crop'), ('img_ocr', '3_ocr')]
+
+    def __init__(self, budget = None, dump_frames = None):
+        self.budget = budget or self.BUDGET
+        self.dump_frames = dump_frames or self.DUMP_FRAMES
+        self.buffer = None
+        self.entries = collections.deque()
+        # next byte to write to
+        self.position = 0
+        self.seq = 0
+        # last frame already saved, frames are never saved twice
+        self.dumped_seq = 0
+        self.dumps = 0
+        self.lock = threading.Lock()
+        self.dump_queue = queue.Queue()
+        self.thread = None
+
+    # the ring is only allocated once something is recorded
+    def _open(self):
+        if self.buffer is None:
+            self.buffer = mmap.mmap(-1, self.budget)
+            self.thread = threading.Thread(target = self._run, daemon = True)
+            self.thread.start()
+
+    # space for size bytes, dropping the oldest frames that are in the way
+    def _allocate(self, size):
+        start = self.position
+        if start + size > self.budget:
+            # frames past the last one written are the oldest, the ring starts over from the beginning without them
+            while self.entries and self.entries[0].start >= self.position:
+                self.entries.popleft()
+            start = 0
+        end = start + size
+        # the oldest frame always comes right after the newest one
+        while self.entries and self.entries[0].start < end and start < self.entries[0].end:
+            self.entries.popleft()
+        self.position = end
+        return start
+
+    # img is a CV2ImageHandler, meta anything json can save (client, state, ocr text...)
+    # returns the seq of the frame, None when it does not fit in the ring
+    def record(self, img, meta = None):
+        images = [(name, getattr(img, attr).img if attr != 'img' else img.img)
+                  for attr, name in self.PARTS if attr == 'img' or hasattr(img, attr)]
+        images = [(name, np.ascontiguousarray(array)) for name, array in images]
+        size = sum(array.nbytes for _, array in images)
+        if size > self.budget:
+            return None
+        with self.lock:
+            self._open()
+            self.seq += 1
+            start = self._allocate(size)
+            parts = []
+            offset = start
+            for name, array in images:
+                self.buffer[offset:offset + array.nbytes] = array.data.cast('B')
+                parts.append((name, offset, array.shape, array.dtype.str))
+                offset += array.nbytes
+            self.entries.append(_Entry(self.seq, start, offset, parts, {'time': time.time(), **(meta or {})}))
+            return self.seq
+
+    # saves the last frames not saved yet, reason names the folder
+    # returns right away, frames are copied out of the ring and encoded on the recorder thread
+    def dump(self, reason):
+        with self.lock:
+            if self.buffer is None:
+                return 0
+            seqs = [entry.seq for entry in self.entries if entry.seq > self.dumped_seq][-self.dump_frames:]
+            if not seqs:
+                return 0
+            self.dumped_seq = seqs[-1]
+            self.dumps += 1
+            path = os.path.join(gb.globals.get_debug_path(), f'incident_{self.dumps}_{reason.replace(" ", "_")}')
+        self.dump_queue.put((path, reason, seqs))
+        return 1
+
+    # copy of a frame still in the ring, None once it was overwritten
+    def _read(self, seq):
+        with self.lock:
+            for entry in self.entries:
+                if entry.seq == seq:
+                    images = [(name, np.frombuffer(self.buffer, dtype = dtype, count = int(np.prod(shape)), offset = offset).reshape(shape).copy())
+                              for name, offset, shape, dtype in entry.parts]
+                    return images, entry.meta
+        return None
+
+    def _save(self, path, reason, seqs):
+        os.makedirs(path, exist_ok = True)
+        frames = []
+        for seq in seqs:
+            frame = self._read(seq)
+            if frame is None:
+                frames.append({'frame': seq, 'overwritten': True})
+                continue
+            images, meta = frame
+            for name, array in images:
+                cv2.imwrite(os.path.join(path, f'{seq}_{name}.png'), array, [cv2.IMWRITE_PNG_COMPRESSION, self.PNG_COMPRESSION])
+            frames.append({'frame': seq, **meta})
+        with open(os.path.join(path, 'incident.json'), 'w') as f:
+            json.dump({'reason': reason, 'time': time.time(), 'frames': frames}, f, indent = 1, default = str)
+
+    def _run(self):
+        while True:
+            item = self.dump_queue.get()
+            if item is None:
+                break
+            try:
+                self._save(*item)
+            except Exception as e:
+                # the dump is lost, at least say why
+                logger.logger.log('recorder error', repr(e), path = item[0], reason = item[1])
+
+    # waits for the dumps already asked for and frees the ring
+    def close(self):
+        if self.thread is not None:
+            self.dump_queue.put(None)
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.buffer is not None:
+                self.entries.clear()
+                self.buffer.close()
+                self.buffer = None
+
+    def stats(self):
+        with self.lock:
+            used = sum(entry.end - entry.start for entry in self.entries)
+            return {'frames': len(self.entries), 'bytes': used, 'budget': self.budget, 'recorded': self.seq, 'dumps': self.dumps}
+
+
+# one recorder for the session, shared by every client and the debug menu
+recorder = FlightRecorder()
@@ -0,0 +1,101 @@
+import time
+import numpy as np
+
+# statistics of a hunt computed from its rollups (see DBHandler.get_hunt_rollups)
+# inputs have one row per hour hunted or per monster seen, so the cost never depends on the number of encounters
+
+HOUR = 3600
+DAY = 24*HOUR
+# base shiny odds in pokemmo, one in SHINY_ODDS
+SHINY_ODDS = 30000
+# hours and days shown by the stats window
+RECENT_HOURS = 48
+RECENT_DAYS = 30
+# hours averaged by the encounter rate trend
+TREND_HOURS = 6
+
+
+# encounters per hour for every hour in [start, end), hours without encounters included
+def hourly_series(hours, qty, start, end):
+    series = np.zeros(max(0, end - start), dtype = np.int64)
+    mask = (hours >= start) & (hours < end)
+    series[hours[mask] - start] = qty[mask]
+    return series
+
+
+# encounters per local day for the days ending with the one of end_hour, days without encounters included
+# returns the first day (days since epoch) and the count of every day from it
+def daily_series(hours, qty, end_hour, days, utc_offset = None):
+    utc_offset = time.localtime().tm_gmtoff if utc_offset is None else utc_offset
+    first_day = (end_hour*HOUR + utc_offset)//DAY - days + 1
+    start_hour = (first_day*DAY - utc_offset)//HOUR
+    series = hourly_series(hours, qty, start_hour, end_hour + 1)
+    day_of_hour = (np.arange(start_hour, end_hour + 1)*HOUR + utc_offset)//DAY - first_day
+    # the first hour may start in the day before when the offset is not whole hours
+    mask = day_of_hour >= 0
+    return int(first_day), np.bincount(day_of_hour[mask], weights = series[mask], minlength = days).astype(np.int64)
+
+
+def moving_average(values, window):
+    values = np.asarray(values, dtype = np.float64)
+    if window <= 1 or len(values) < window:
+        return values
+    return np.convolve(values, np.ones(window)/window, mode = 'valid')
+
+
+# encounters needed for a probability of having seen at least one shiny
+def encounters_for_chance(chance, odds = SHINY_ODDS):
+    return np.log1p(-np.asarray(chance, dtype = np.float64))/np.log1p(-1/odds)
+
+
+# rollups is what DBHandler.get_hunt_rollups returns
+def hunt_summary(rollups, now = None, recent_hours = RECENT_HOURS, recent_days = RECENT_DAYS, trend_hours = TREND_HOURS, odds = SHINY_ODDS):
+    now = time.time() if now is None else now
+    hours_hunted, total, alphas, shinies, first_hour, last_hour = rollups['totals']
+    hourly = np.array(rollups['hourly'], dtype = np.int64).reshape(-1, 4)
+    species = np.array(rollups['species'], dtype = np.int64).reshape(-1, 4)
+
+    current_hour = int(now//HOUR)
+    recent = hourly_series(hourly[:, 0], hourly[:, 1], current_hour - recent_hours + 1, current_hour + 1)
+    # up to today like the hourly chart, days away from the game show as empty days
+    first_day, daily = daily_series(hourly[:, 0], hourly[:, 1], current_hour, recent_days)
+
+    # rates only count the hours with encounters, time away from the game does not lower them
+    # the current hour is not over yet, it only counts when there is nothing else
+    hunted = hourly[hourly[:, 1] > 0]
+    hunted = hunted[hunted[:, 0] < current_hour, 1] if (hunted[:, 0] < current_hour).any() else hunted[:, 1]
+    rate = total/hours_hunted if hours_hunted else 0.
+    trend = moving_average(hunted[-2*trend_hours:], trend_hours)
+    recent_rate = float(trend[-1]) if len(trend) else rate
+    # change of the average rate over the last trend_hours against the trend_hours before them
+    change = float(trend[-1]/trend[0] - 1) if len(hunted) >= 2*trend_hours and trend[0] else 0.
+
+    # biggest share first
+    order = np.argsort(-species[:, 1], kind = 'stable')
+    shares = species[order, 1]/total if total else np.zeros(len(order))
+
+    # encounters are independent, the expected wait for the next shiny is the same no matter how many came before
+    chance = 1 - np.exp(total*np.log1p(-1/odds))
+    half, most = encounters_for_chance([0.5, 0.9], odds)
+    return {
+        'total': int(total),
+        'alphas': int(alphas),
+        'shinies': int(shinies),
+        'alpha_rate': alphas/total if total else 0.,
+        'shiny_rate': shinies/total if total else 0.,
+        'hours_hunted': int(hours_hunted),
+        'first_seen': first_hour*HOUR if first_hour is not None else None,
+        'last_seen': last_hour*HOUR if last_hour is not None else None,
+        'rate': rate,
+        'recent_rate': recent_rate,
+        'rate_change': change,
+        'recent': recent,
+        'first_day': first_day,
+        'daily': daily,
+        'species': [(int(id), int(qty), float(share)) for (id, qty), share in zip(species[order, :2], shares)],
+        'shiny_chance': float(chance),
+        # hours to the next shiny at the recent rate, None when nothing was encountered recently
+        'hours_to_shiny': odds/recent_rate if recent_rate else None,
+        'encounters_to_50': int(np.ceil(half)),
+        'encounters_to_90': int(np.ceil(most))
+    }
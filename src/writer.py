@@ -0,0 +1,229 @@
+import os
+import re
+import json
+import time
+import queue
+import threading
+import collections
+
+import src.core as core
+import src.metrics as metrics
+import src.globals as gb
+
+
+# encounters waiting to be saved, seq is their place in the journal
+# captured is the perf_counter of the frame they were read from and tag whatever the caller uses to tell
+# where they came from (e.g. the game client), both None when replayed from the journal
+_Record = collections.namedtuple('_Record', ['seq', 'rows', 'captured', 'tag'])
+
+# seq of a journal line, read from lines cut by a kill too
+_SEQ_PATTERN = re.compile(r'\{"seq": (\d+)')
+
+_batch_rows = metrics.histogram('yapec_writer_batch_rows', 'encounters saved by a group commit', buckets = metrics.SIZE_BUCKETS)
+_commit_failures = metrics.counter('yapec_writer_commit_failures_total', 'group commits that failed and were retried')
+
+
+# write-behind buffer between the engine and the db, so a slow or locked db never holds up capture
+# - put() appends the rows to a journal file and returns, it never waits for the db
+# - a single thread saves everything waiting in one transaction (group commit)
+#   once MAX_BATCH records are waiting or MAX_DELAY seconds after the first one
+# - a failed commit keeps the rows and tries again after a growing wait, records keep coming meanwhile
+# - the journal is an append-only file of json lines next to the db, emptied whenever everything is saved
+#   the seq of the last saved record is written to the db (journal_marks) in the same transaction as the rows
+#   so records left in the journal by a crash or a hard kill are saved on the next start, exactly once
+# - a None in queue stops the thread once what is waiting is saved (see TaskManager.stop)
+# debug modes that do not save data (3 and 4) do not write a journal either
+class EncounterWriter:
+
+    # records saved in one transaction at most
+    MAX_BATCH = 64
+    # seconds to wait for more records before saving
+    MAX_DELAY = 0.25
+    # seconds between tries after a failed commit, doubled on every failure
+    RETRY_MIN = 0.5
+    RETRY_MAX = 8
+    # tries to save what is left when stopping, anything still failing stays in the journal
+    STOP_RETRIES = 3
+
+    # on_commit(records, last_row_id) is called from the writer thread after every commit
+    # log(action, data) is called for commit failures and journal errors
+    def __init__(self, db_file, on_commit = None, log = None, journal_path = None):
+        self.db_file = db_file
+        self.on_commit = on_commit
+        self.log = log
+        self.journal_path = journal_path or os.path.splitext(db_file)[0] + '_encounters.journal'
+        # key of the journal in journal_marks
+        self.journal = os.path.basename(self.journal_path)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.file = None
+        # last seq given to a record and last seq saved to the db
+        self.seq = 0
+        self.saved_seq = 0
+        self.commits = 0
+        self.saved_records = 0
+        self.saved_rows = 0
+        self.failures = 0
+
+    def _log(self, action, data):
+        if self.log is not None:
+            self.log(action, data)
+
+    # reads what a previous session left in the journal and queues what the db does not have yet
+    # must be called before put() and run()
+    def open(self):
+        if gb.globals.DEBUG_MODE >= 3:
+            return 1
+        with core.DBHandler(self.db_file) as db:
+            saved_seq = db.get_journal_seq(self.journal)
+        records = []
+        # highest seq in the journal, torn lines included, new records must not reuse it
+        last_seq = saved_seq
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut by a kill while it was being written
+                        match = _SEQ_PATTERN.match(line)
+                        if match:
+                            last_seq = max(last_seq, int(match.group(1)))
+                        continue
+                    # journals written before monster ids were ints have them as strings
+                    rows = [(timestamp, int(monster_id), *rest) for timestamp, monster_id, *rest in entry['rows']]
+                    records.append(_Record(entry['seq'], rows, None, None))
+                    last_seq = max(last_seq, entry['seq'])
+        with self.lock:
+            self.saved_seq = saved_seq
+            self.seq = last_seq
+            pending = [record for record in records if record.seq > saved_seq]
+            for record in pending:
+                self.queue.put(record)
+            # the journal starts over with only the records still to save, so new records are never
+            # appended to a torn line, which would make them unreadable as well
+            temp_path = self.journal_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for record in pending:
+                    f.write(json.dumps({'seq': record.seq, 'rows': record.rows}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.journal_path)
+            self.file = open(self.journal_path, 'a')
+        if pending:
+            self._log('journal replay', f'{len(pending)} records not saved by the last session')
+        return 1
+
+    # called by the engine for every battle with the rows to insert into encounters
+    def put(self, rows, captured = None, tag = None):
+        with self.lock:
+            self.seq += 1
+            record = _Record(self.seq, rows, captured, tag)
+            if self.file is not None:
+                try:
+                    self.file.write(json.dumps({'seq': record.seq, 'rows': rows}) + '\n')
+                    # in the os once flushed, a killed process does not lose it
+                    self.file.flush()
+                except (OSError, ValueError) as e:
+                    self._log('journal error', repr(e))
+            # queued under the lock so records are saved in seq order
+            self.queue.put(record)
+
+    def _commit(self, records):
+        rows = [row for record in records for row in record.rows]
+        with core.DBHandler(self.db_file) as db:
+            if not db.insert_journaled_data(rows, self.journal, records[-1].seq):
+                self.failures += 1
+                _commit_failures.inc()
+                self._log('writer commit failed', f'{len(records)} records waiting')
+                return 0
+            last_row_id = db.last_row_id
+        self.commits += 1
+        _batch_rows.observe(len(rows))
+        self.saved_records += len(records)
+        self.saved_rows += len(rows)
+        with self.lock:
+            self.saved_seq = records[-1].seq
+            # nothing left to replay, start the journal over
+            if self.file is not None and self.saved_seq == self.seq:
+                try:
+                    self.file.truncate(0)
+                except OSError as e:
+                    self._log('journal error', repr(e))
+        if self.on_commit is not None:
+            try:
+                self.on_commit(records, last_row_id)
+            except Exception as e:
+                self._log('writer callback error', repr(e))
+        return 1
+
+    # writer thread
+    def run(self):
+        pending = []
+        retry = self.RETRY_MIN
+        stopping = False
+        stop_tries = 0
+        while True:
+            if not pending:
+                item = self.queue.get()
+                if item is None:
+                    break
+                pending.append(item)
+            # group what arrives in the next MAX_DELAY seconds
+            deadline = time.monotonic() + self.MAX_DELAY
+            while not stopping and len(pending) < self.MAX_BATCH:
+                try:
+                    item = self.queue.get(timeout = max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                else:
+                    pending.append(item)
+            if self._commit(pending):
+                pending = []
+                retry = self.RETRY_MIN
+                if stopping:
+                    break
+                continue
+            if stopping:
+                stop_tries += 1
+                if stop_tries >= self.STOP_RETRIES:
+                    break
+                time.sleep(self.RETRY_MIN)
+                continue
+            # db busy or failing, keep taking records while waiting to try again
+            try:
+                item = self.queue.get(timeout = retry)
+            except queue.Empty:
+                pass
+            else:
+                if item is None:
+                    stopping = True
+                else:
+                    pending.append(item)
+            retry = min(retry*2, self.RETRY_MAX)
+        self._close(pending)
+
+    # syncs what is saved to disk and closes the journal, unsaved records stay in it for the next start
+    def _close(self, pending):
+        with self.lock:
+            if self.file is not None:
+                try:
+                    self.file.flush()
+                    if pending:
+                        os.fsync(self.file.fileno())
+                finally:
+                    self.file.close()
+                    self.file = None
+        if pending:
+            self._log('writer stopped', f'{len(pending)} records left in the journal')
+        if self.commits:
+            with core.DBHandler(self.db_file) as db:
+                db.checkpoint()
+
+    def stats(self):
+        with self.lock:
+            waiting = self.seq - self.saved_seq
+        return {'commits': self.commits, 'records': self.saved_records, 'rows': self.saved_rows,
+                'failures': self.failures, 'waiting': waiting}
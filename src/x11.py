@@ -0,0 +1,336 @@
+import ctypes
+import ctypes.util
+import threading
+import numpy as np
+
+# minimal xlib + mit-shm bindings to capture a window on linux
+# only what X11FrameSource (see src/capture.py) needs, loaded lazily so windows never touches them
+
+# Xlib.h / XShm.h / sys/shm.h constants
+Z_PIXMAP = 2
+IS_VIEWABLE = 2
+ALL_PLANES = 0xffffffff
+ANY_PROPERTY_TYPE = 0
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+
+class XImage(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+        ('red_mask', ctypes.c_ulong),
+        ('green_mask', ctypes.c_ulong),
+        ('blue_mask', ctypes.c_ulong),
+        ('obdata', ctypes.c_void_p),
+        # image manipulation routines, never called from python
+        ('f', ctypes.c_void_p*6)
+    ]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int)
+    ]
+
+
+class XWindowAttributes(ctypes.Structure):
+    _fields_ = [
+        ('x', ctypes.c_int),
+        ('y', ctypes.c_int),
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('border_width', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('visual', ctypes.c_void_p),
+        ('root', ctypes.c_ulong),
+        ('class', ctypes.c_int),
+        ('bit_gravity', ctypes.c_int),
+        ('win_gravity', ctypes.c_int),
+        ('backing_store', ctypes.c_int),
+        ('backing_planes', ctypes.c_ulong),
+        ('backing_pixel', ctypes.c_ulong),
+        ('save_under', ctypes.c_int),
+        ('colormap', ctypes.c_ulong),
+        ('map_installed', ctypes.c_int),
+        ('map_state', ctypes.c_int),
+        ('all_event_masks', ctypes.c_long),
+        ('your_event_mask', ctypes.c_long),
+        ('do_not_propagate_mask', ctypes.c_long),
+        ('override_redirect', ctypes.c_int),
+        ('screen', ctypes.c_void_p)
+    ]
+
+
+class XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_int),
+        ('display', ctypes.c_void_p),
+        ('resourceid', ctypes.c_ulong),
+        ('serial', ctypes.c_ulong),
+        ('error_code', ctypes.c_ubyte),
+        ('request_code', ctypes.c_ubyte),
+        ('minor_code', ctypes.c_ubyte)
+    ]
+
+
+_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(XErrorEvent))
+
+
+class _Libraries:
+    def __init__(self):
+        self.loaded = None
+
+    def _load(self):
+        names = [ctypes.util.find_library(name) for name in ['X11', 'Xext', 'c']]
+        if not all(names):
+            raise OSError('libX11, libXext and libc are needed to capture on X11.')
+        xlib, xext, libc = [ctypes.CDLL(name) for name in names]
+
+        def declare(lib, name, restype, *argtypes):
+            func = getattr(lib, name)
+            func.restype = restype
+            func.argtypes = list(argtypes)
+
+        p, ulong, c_int = ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int
+        declare(xlib, 'XOpenDisplay', p, ctypes.c_char_p)
+        declare(xlib, 'XCloseDisplay', c_int, p)
+        declare(xlib, 'XDefaultRootWindow', ulong, p)
+        declare(xlib, 'XSync', c_int, p, c_int)
+        declare(xlib, 'XFree', c_int, p)
+        declare(xlib, 'XSetErrorHandler', p, _ERROR_HANDLER)
+        declare(xlib, 'XGetWindowAttributes', c_int, p, ulong, ctypes.POINTER(XWindowAttributes))
+        declare(xlib, 'XQueryTree', c_int, p, ulong, ctypes.POINTER(ulong), ctypes.POINTER(ulong),
+                ctypes.POINTER(ctypes.POINTER(ulong)), ctypes.POINTER(ctypes.c_uint))
+        declare(xlib, 'XInternAtom', ulong, p, ctypes.c_char_p, c_int)
+        declare(xlib, 'XGetWindowProperty', c_int, p, ulong, ulong, ctypes.c_long, ctypes.c_long, c_int, ulong,
+                ctypes.POINTER(ulong), ctypes.POINTER(c_int), ctypes.POINTER(ulong), ctypes.POINTER(ulong),
+                ctypes.POINTER(ctypes.c_void_p))
+        declare(xlib, 'XFetchName', c_int, p, ulong, ctypes.POINTER(ctypes.c_char_p))
+        declare(xlib, 'XDestroyImage', c_int, ctypes.POINTER(XImage))
+        declare(xext, 'XShmQueryExtension', c_int, p)
+        declare(xext, 'XShmCreateImage', ctypes.POINTER(XImage), p, p, ctypes.c_uint, c_int, p,
+                ctypes.POINTER(XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint)
+        declare(xext, 'XShmAttach', c_int, p, ctypes.POINTER(XShmSegmentInfo))
+        declare(xext, 'XShmDetach', c_int, p, ctypes.POINTER(XShmSegmentInfo))
+        declare(xext, 'XShmGetImage', c_int, p, ulong, ctypes.POINTER(XImage), c_int, c_int, ulong)
+        declare(libc, 'shmget', c_int, c_int, ctypes.c_size_t, c_int)
+        declare(libc, 'shmat', p, c_int, p, c_int)
+        declare(libc, 'shmdt', c_int, p)
+        declare(libc, 'shmctl', c_int, c_int, c_int, p)
+        return xlib, xext, libc
+
+    def get(self):
+        if self.loaded is None:
+            self.loaded = self._load()
+        return self.loaded
+
+_libraries = _Libraries()
+
+
+# xlib has a single error handler for the whole process, shared by every Display (one per captured window) and tk
+# it is installed once and routes errors to the Display of the connection they happened on
+# errors of other connections (e.g. tk's) go to the handler that was installed before
+_displays = {}
+_error_lock = threading.Lock()
+_error_handler = None
+_previous_handler = None
+
+def _on_error(display, event):
+    target = _displays.get(display)
+    if target is not None:
+        target.last_error = event.contents.error_code
+        return 0
+    if _previous_handler is not None:
+        return _previous_handler(display, event)
+    return 0
+
+def _install_error_handler(xlib):
+    global _error_handler, _previous_handler
+    with _error_lock:
+        if _error_handler is None:
+            # keep a reference, xlib only holds a raw pointer to the callback
+            _error_handler = _ERROR_HANDLER(_on_error)
+            previous = xlib.XSetErrorHandler(_error_handler)
+            _previous_handler = _ERROR_HANDLER(previous) if previous else None
+
+
+# an xshm image backed by a shared memory segment, the x server writes the pixels straight into it
+# buffer is a numpy view of the segment, reused for every grab of the same size
+class ShmImage:
+    def __init__(self, display, attributes, width, height):
+        xlib, xext, libc = _libraries.get()
+        self.display = display
+        self.width = width
+        self.height = height
+        self.info = XShmSegmentInfo()
+        self.image = xext.XShmCreateImage(display, attributes.visual, attributes.depth, Z_PIXMAP, None,
+                                          ctypes.byref(self.info), width, height)
+        if not self.image:
+            raise OSError('XShmCreateImage failed.')
+        image = self.image.contents
+        if image.bits_per_pixel != 32:
+            xlib.XDestroyImage(self.image)
+            raise OSError(f'Unsupported pixel format: {image.bits_per_pixel} bits per pixel.')
+        size = image.bytes_per_line*image.height
+        self.info.shmid = libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if self.info.shmid < 0:
+            xlib.XDestroyImage(self.image)
+            raise OSError('shmget failed.')
+        self.info.shmaddr = libc.shmat(self.info.shmid, None, 0)
+        if self.info.shmaddr in [None, ctypes.c_void_p(-1).value]:
+            libc.shmctl(self.info.shmid, IPC_RMID, None)
+            xlib.XDestroyImage(self.image)
+            raise OSError('shmat failed.')
+        image.data = self.info.shmaddr
+        self.info.readOnly = 0
+        xext.XShmAttach(display, ctypes.byref(self.info))
+        xlib.XSync(display, 0)
+        # the segment goes away by itself once both we and the server detach from it, even after a crash
+        libc.shmctl(self.info.shmid, IPC_RMID, None)
+        # 32 bits per pixel zpixmap on little endian is bgrx, the same layout opencv uses for bgra
+        raw = (ctypes.c_uint8*size).from_address(self.info.shmaddr)
+        self.buffer = np.ctypeslib.as_array(raw).reshape(image.height, image.bytes_per_line)[:, :width*4]
+        self.buffer = self.buffer.reshape(height, width, 4)
+
+    # copy the window region at (x, y) into the buffer
+    def grab(self, window, x, y):
+        _, xext, _ = _libraries.get()
+        return xext.XShmGetImage(self.display, window, self.image, x, y, ALL_PLANES)
+
+    def close(self):
+        xlib, xext, libc = _libraries.get()
+        self.buffer = None
+        xext.XShmDetach(self.display, ctypes.byref(self.info))
+        xlib.XSync(self.display, 0)
+        # XDestroyImage frees data as well, which belongs to shmat
+        self.image.contents.data = None
+        xlib.XDestroyImage(self.image)
+        libc.shmdt(self.info.shmaddr)
+
+
+# connection to the x server with the few window queries capture needs
+# x errors (e.g. the window closed between two calls) are kept instead of killing the process
+class Display:
+    def __init__(self, name = None):
+        xlib, xext, _ = _libraries.get()
+        self.xlib = xlib
+        self.display = xlib.XOpenDisplay(name.encode() if name else None)
+        if not self.display:
+            raise OSError('Unable to open the X display, is DISPLAY set?')
+        if not xext.XShmQueryExtension(self.display):
+            xlib.XCloseDisplay(self.display)
+            raise OSError('The X server does not support MIT-SHM.')
+        self.root = xlib.XDefaultRootWindow(self.display)
+        self.last_error = None
+        _install_error_handler(xlib)
+        _displays[self.display] = self
+
+    # sync with the server and raise any error of the calls made since the last check
+    def check(self, action):
+        self.xlib.XSync(self.display, 0)
+        error, self.last_error = self.last_error, None
+        if error is not None:
+            raise OSError(f'X error {error} on {action}.')
+
+    def attributes(self, window):
+        attributes = XWindowAttributes()
+        if not self.xlib.XGetWindowAttributes(self.display, window, ctypes.byref(attributes)):
+            self.last_error = None
+            raise OSError(f'Window {window} not found.')
+        return attributes
+
+    def children(self, window):
+        root, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children, count = ctypes.POINTER(ctypes.c_ulong)(), ctypes.c_uint()
+        if not self.xlib.XQueryTree(self.display, window, ctypes.byref(root), ctypes.byref(parent),
+                                    ctypes.byref(children), ctypes.byref(count)):
+            return []
+        result = [children[i] for i in range(count.value)]
+        if children:
+            self.xlib.XFree(children)
+        return result
+
+    def _property(self, window, name, max_length = 1024):
+        atom = self.xlib.XInternAtom(self.display, name.encode(), 0)
+        actual_type, actual_format = ctypes.c_ulong(), ctypes.c_int()
+        items, remaining, data = ctypes.c_ulong(), ctypes.c_ulong(), ctypes.c_void_p()
+        status = self.xlib.XGetWindowProperty(self.display, window, atom, 0, max_length, 0, ANY_PROPERTY_TYPE,
+                                              ctypes.byref(actual_type), ctypes.byref(actual_format),
+                                              ctypes.byref(items), ctypes.byref(remaining), ctypes.byref(data))
+        if status != 0 or not data.value:
+            return None, 0
+        # 32 bit properties are returned as longs
+        item_size = {8: 1, 16: ctypes.sizeof(ctypes.c_short), 32: ctypes.sizeof(ctypes.c_long)}[actual_format.value]
+        value = ctypes.string_at(data.value, items.value*item_size)
+        self.xlib.XFree(data)
+        return value, actual_format.value
+
+    def window_title(self, window):
+        value, _ = self._property(window, '_NET_WM_NAME')
+        if value:
+            return value.decode('utf-8', errors = 'ignore')
+        name = ctypes.c_char_p()
+        if self.xlib.XFetchName(self.display, window, ctypes.byref(name)) and name.value:
+            title = name.value.decode('latin-1')
+            self.xlib.XFree(name)
+            return title
+        return ''
+
+    # every window below window (the root by default) along with its title
+    def windows(self, window = None):
+        stack = [window or self.root]
+        while stack:
+            current = stack.pop()
+            yield current, self.window_title(current)
+            stack.extend(self.children(current))
+
+    # id of the process that owns window, looked up in its children when it is a window manager frame
+    def window_pid(self, window):
+        for current, _ in self.windows(window):
+            value, actual_format = self._property(current, '_NET_WM_PID', 1)
+            if value and actual_format == 32:
+                return ctypes.c_ulong.from_buffer_copy(value[:ctypes.sizeof(ctypes.c_ulong)]).value
+        return None
+
+    # window the window manager considers active, None when there is no ewmh window manager
+    def active_window(self):
+        value, actual_format = self._property(self.root, '_NET_ACTIVE_WINDOW', 1)
+        if not value or actual_format != 32:
+            return None
+        return ctypes.c_ulong.from_buffer_copy(value[:ctypes.sizeof(ctypes.c_ulong)]).value
+
+    # whether window is ancestor of (or the same as) other, the active window is often the wm frame
+    def contains(self, window, other):
+        root, parent = ctypes.c_ulong(), ctypes.c_ulong()
+        children, count = ctypes.POINTER(ctypes.c_ulong)(), ctypes.c_uint()
+        while other and other != self.root:
+            if other == window:
+                return True
+            if not self.xlib.XQueryTree(self.display, other, ctypes.byref(root), ctypes.byref(parent),
+                                        ctypes.byref(children), ctypes.byref(count)):
+                return False
+            if children:
+                self.xlib.XFree(children)
+            other = parent.value
+        return False
+
+    def close(self):
+        if self.display:
+            _displays.pop(self.display, None)
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
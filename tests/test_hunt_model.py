@@ -0,0 +1,24 @@
+import src.core as core
+import src.gui as gui
+
+
+def test_live_encounter_counts_with_loaded_species(tmp_path):
+    db_file = str(tmp_path / 'test.sqlite3')
+    core.DBHandler.setup_db(db_file)
+    pokemon = core.OCRResultHandler('pidgey lv. 5').extract_pokemon_from_battle()
+    assert pokemon and pokemon[0][1] == 16
+    row = (*pokemon[0], 1)
+    with core.DBHandler(db_file) as db:
+        db.insert_data([row])
+
+    model = gui.HuntModel()
+    model.load(db_file, 1)
+    assert model.apply(model.last_id + 1, row)
+    # journaled rows may still carry ids as strings
+    assert model.apply(model.last_id + 1, (row[0], '16', *row[2:]))
+
+    assert list(model.stats) == [16]
+    assert model.stats[16]['normal'] == 3
+    assert model.total == 3
+    assert list(model.top(5)) == [16]
+    core.DBHandler.close_all()
@@ -0,0 +1,20 @@
+import src.metrics as metrics
+
+
+def test_single_observation_percentiles_are_the_value():
+    histogram = metrics.Histogram('rows', buckets = metrics.SIZE_BUCKETS)
+    histogram.observe(1)
+    snapshot = histogram.snapshot()
+    assert snapshot['p50'] == snapshot['p95'] == snapshot['p99'] == 1
+
+
+def test_percentiles_stay_within_min_and_max():
+    histogram = metrics.Histogram('seconds')
+    for i in range(1, 1001):
+        histogram.observe(0.3 + i/10000)
+    for q in [0, 0.01, 0.5, 0.95, 0.99, 1]:
+        assert histogram.min <= histogram.percentile(q) <= histogram.max
+
+
+def test_empty_histogram_has_no_percentiles():
+    assert metrics.Histogram('empty').percentile(0.5) is None
@@ -0,0 +1,33 @@
+import numpy as np
+
+import src.stats as stats
+
+
+def test_daily_series_ends_today_with_empty_days():
+    # encounters only 10 days ago, nothing since
+    now_hour = 500000
+    hours = np.array([now_hour - 240, now_hour - 239])
+    qty = np.array([5, 3])
+    first_day, daily = stats.daily_series(hours, qty, now_hour, 30, utc_offset = 0)
+    assert len(daily) == 30
+    assert first_day + 29 == now_hour*stats.HOUR//stats.DAY
+    assert daily.sum() == 8
+    assert daily[-1] == 0
+    assert daily[-11] == 8
+
+
+def test_daily_series_without_encounters():
+    first_day, daily = stats.daily_series(np.array([], dtype = np.int64), np.array([], dtype = np.int64), 500000, 30, utc_offset = 3600)
+    assert len(daily) == 30
+    assert daily.sum() == 0
+
+
+def test_hunt_summary_daily_chart_ends_on_now():
+    now = 500000*stats.HOUR + 60
+    rollups = {'totals': (1, 4, 0, 0, 500000 - 72, 500000 - 72),
+               'hourly': [(500000 - 72, 4, 0, 0)],
+               'species': [(16, 4, 0, 0)]}
+    summary = stats.hunt_summary(rollups, now = now)
+    assert len(summary['daily']) == stats.RECENT_DAYS
+    assert summary['daily'].sum() == 4
+    assert summary['daily'][-1] == 0
@@ -0,0 +1,84 @@
+import json
+import sqlite3
+
+import src.core as core
+import src.writer as writer
+
+
+def _row(monster_id = 16):
+    return (1700000000.0, monster_id, 5, 0, 0, 1)
+
+def _journal_line(seq, rows):
+    return json.dumps({'seq': seq, 'rows': rows}) + '\n'
+
+def _saved(db_file):
+    with sqlite3.connect(db_file) as connection:
+        return connection.execute('SELECT COUNT(*) FROM encounters').fetchone()[0]
+
+def _writer(tmp_path):
+    db_file = str(tmp_path / 'test.sqlite3')
+    core.DBHandler.setup_db(db_file)
+    return db_file, writer.EncounterWriter(db_file)
+
+def _stop(encounter_writer):
+    encounter_writer.queue.put(None)
+    encounter_writer.run()
+    core.DBHandler.close_all()
+
+
+def test_records_after_a_torn_line_survive_the_next_kill(tmp_path):
+    db_file, encounter_writer = _writer(tmp_path)
+    with open(encounter_writer.journal_path, 'w') as f:
+        f.write(_journal_line(1, [_row()]))
+        f.write('{"seq": 2, "rows": [[17000')
+    encounter_writer.open()
+    assert encounter_writer.seq == 2
+    encounter_writer.put([_row(17)])
+    # killed before anything was saved
+    encounter_writer.file.close()
+
+    encounter_writer = writer.EncounterWriter(db_file)
+    encounter_writer.open()
+    assert encounter_writer.queue.qsize() == 2
+    _stop(encounter_writer)
+    assert _saved(db_file) == 2
+
+
+def test_replay_skips_records_already_saved(tmp_path):
+    db_file, encounter_writer = _writer(tmp_path)
+    with core.DBHandler(db_file) as db:
+        assert db.insert_journaled_data([_row(), _row()], encounter_writer.journal, 2)
+    with open(encounter_writer.journal_path, 'w') as f:
+        for seq in [1, 2, 3]:
+            f.write(_journal_line(seq, [_row()]))
+    encounter_writer.open()
+    assert encounter_writer.queue.qsize() == 1
+    _stop(encounter_writer)
+    assert _saved(db_file) == 3
+
+    # saved once, nothing left to replay
+    encounter_writer = writer.EncounterWriter(db_file)
+    encounter_writer.open()
+    assert encounter_writer.queue.qsize() == 0
+    _stop(encounter_writer)
+    assert _saved(db_file) == 3
+
+
+def test_failed_commit_is_retried(tmp_path, monkeypatch):
+    db_file, encounter_writer = _writer(tmp_path)
+    encounter_writer.RETRY_MIN = 0.01
+    insert = core.DBHandler.insert_journaled_data
+    calls = []
+    def flaky_insert(self, *args):
+        calls.append(args)
+        return 0 if len(calls) == 1 else insert(self, *args)
+    monkeypatch.setattr(core.DBHandler, 'insert_journaled_data', flaky_insert)
+
+    encounter_writer.open()
+    encounter_writer.put([_row()])
+    _stop(encounter_writer)
+    assert encounter_writer.failures == 1
+    assert len(calls) == 2
+    assert _saved(db_file) == 1
+    with open(encounter_writer.journal_path) as f:
+        assert f.read() == ''
@@ -1,8 +1,9 @@
 import os
 import time
+import argparse
 import tkinter as tk
 from pathlib import Path
-from src import gui, core, manager, globals as gb
+from src import gui, core, manager, capture, ocr, logger, profiler, globals as gb
 
 def create_paths(root):
     paths = [
@@ -27,8 +28,9 @@ def check_paths_and_files(root):
             'data',
             'data_exports',
             'icons',
-            os.path.join('icons', 'monstersprites'),
-            os.path.join('icons', 'monstersprites', '0.png'),
+            # sprites are read from the atlas, icons/monstersprites is only needed to rebuild it (see src/atlas.py)
+            os.path.join('icons', 'monstersprites.png'),
+            os.path.join('icons', 'monstersprites.json'),
             os.path.join('icons', 'logo.ico')
             ]
     for path in paths:
@@ -37,23 +39,57 @@ def check_paths_and_files(root):
             return 0
     return 1
 
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Yet Another PokeMMO Encounter Counter')
+    # replays allow running the whole pipeline on recorded sessions, also outside windows
+    parser.add_argument('--replay', nargs = '+', default = None, help = 'folders of saved screenshots or video files to use instead of the game windows, one client each')
+    parser.add_argument('--fps', type = float, default = 0, help = 'replay rate in frames per second, 0 is as fast as possible')
+    parser.add_argument('--db', default = 'yapec.sqlite3', help = 'database file name inside the data folder')
+    # also configurable as "poll_min" and "poll_max" in config/init.json
+    parser.add_argument('--poll-min', type = float, default = None, help = 'shortest wait between captures in seconds')
+    parser.add_argument('--poll-max', type = float, default = None, help = 'longest wait between captures in seconds')
+    return parser.parse_args()
+
 if __name__ == '__main__':
 
+    args = parse_args()
     root_path = str(Path(__file__).parent)
     _ = create_paths(root_path)
     result = check_paths_and_files(root_path)
     if result != 1:
         exit()
 
-    db_file = 'yapec.sqlite3'
+    db_file = args.db
     gb.globals.update_session_id(str(int(time.time())))
     core.DBHandler.setup_db(os.path.join(root_path, 'data', db_file))
 
     app = gui.MainWindow(root_path, db_file)
-    pokemmo = core.PokeMMOHandler.from_title()
-    tm = manager.TaskManager(pokemmo, app)
+    if args.replay:
+        # the replay source sets the pace
+        frame_sources = [capture.ReplayFrameSource(replay, fps = args.fps) for replay in args.replay]
+        scheduler = manager.PollScheduler(min_interval = 0, max_interval = 0, base_interval = 0)
+    else:
+        # win32 window capture on windows, x11 shared memory capture on linux
+        # one source for every game client open
+        frame_sources = capture.live_sources()
+        poll_min = args.poll_min if args.poll_min is not None else app.init_values.get('poll_min')
+        poll_max = args.poll_max if args.poll_max is not None else app.init_values.get('poll_max')
+        scheduler = manager.PollScheduler(min_interval = poll_min, max_interval = poll_max)
+    # identical text boxes are read only once, can be turned off with "ocr_cache": false in config/init.json
+    ocr_cache = None
+    if app.init_values.get('ocr_cache', True):
+        ocr_cache = ocr.OCRCache(os.path.join(root_path, 'data', 'ocr_cache.json'))
+    app.set_clients([frame_source.name() for frame_source in frame_sources])
+    tm = manager.TaskManager(frame_sources, app, scheduler = scheduler, ocr_cache = ocr_cache)
     tm.start()
 
     app.mainloop()
 
+    # a profile still running is cut short and saved
+    profiler.profiler.stop(wait = True)
     tm.stop()
+    for frame_source in frame_sources:
+        frame_source.close()
+    ocr.close_engine()
+    core.DBHandler.close_all()
+    logger.logger.close()